@@ -11,15 +11,29 @@ import logging
 import sqlite3
 import json
 import random
-import string
 import asyncio
 import hashlib
-from datetime import datetime, timedelta
+import time
+import tempfile
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, time as dt_time
 from io import BytesIO
+from collections import OrderedDict
 from typing import Dict, List, Optional, Tuple, Any
 from enum import Enum
 import traceback
 import re
+import math
+import bisect
+import heapq
+import csv
+import struct
+import zlib
+import gzip
+import signal
+import socket
 from decimal import Decimal, ROUND_HALF_UP
 
 # مكتبات التليجرام
@@ -31,12 +45,15 @@ try:
     from telegram.ext import (
         Application, CommandHandler, MessageHandler,
         CallbackQueryHandler, filters, ContextTypes,
-        ConversationHandler
+        ConversationHandler, TypeHandler
     )
-    from telegram.error import TelegramError, BadRequest
+    from telegram.error import (
+        TelegramError, BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
+    )
+    from telegram.helpers import escape_markdown
 except ImportError:
     print("❌ يرجى تثبيت مكتبة python-telegram-bot:")
-    print("pip install python-telegram-bot[job-queue]==20.7")
+    print("pip install python-telegram-bot[job-queue,webhooks]==20.7")
     sys.exit(1)
 
 # مكتبات PDF
@@ -57,12 +74,39 @@ try:
 except ImportError:
     print("⚠️  بعض المكتبات المساعدة غير مثبتة")
 
+# خادم webhook من المكتبة (python-telegram-bot[webhooks])، مطلوب فقط عند WEBHOOK_URL
+try:
+    import httpx
+    import tornado.web
+    from tornado.httpserver import HTTPServer
+    from telegram.ext._utils.webhookhandler import WebhookAppClass, WebhookServer
+    WEBHOOK_AVAILABLE = True
+except ImportError:
+    WEBHOOK_AVAILABLE = False
+
 # ==================== الإعدادات والتكوين ====================
 class Config:
     """إعدادات البوت"""
     # التوكن والإدارة
     BOT_TOKEN = os.getenv("BOT_TOKEN", "7096820738:AAGe56KhU5HkIKGfP_T3sWLL1N7y8W4j0dY")
     ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "524892378").split(",")] if os.getenv("ADMIN_IDS") else [524892378]
+    # عنوان Bot API (يغير للقياس على خادم وهمي محلي)
+    TELEGRAM_API = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+    
+    # استقبال التحديثات: webhook عند تعيين WEBHOOK_URL، وإلا polling
+    WEBHOOK = {
+        "url": os.getenv("WEBHOOK_URL", "").rstrip("/"),  # العنوان العام مثل https://bot.up.railway.app
+        "listen": os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+        "port": int(os.getenv("PORT", "8080")),
+        "path": os.getenv("WEBHOOK_PATH", "telegram"),
+        # تيليجرام يرسله في X-Telegram-Bot-Api-Secret-Token (أحرف وأرقام و_- فقط)
+        "secret_token": os.getenv("WEBHOOK_SECRET", hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]),
+        "max_connections": int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")),  # 1-100 اتصال متزامن من تيليجرام
+        # تيليجرام يحتفظ بما وصل أثناء إعادة النشر؛ حذفه عند الإقلاع يضيع نافذة إعادة التشغيل
+        "drop_pending_updates": os.getenv("WEBHOOK_DROP_PENDING", "0") == "1",
+        "health_path": "/health"
+    }
+    ALLOWED_UPDATES = ["message", "callback_query"]
     
     # إعدادات النقاط
     POINTS = {
@@ -125,7 +169,9 @@ class Config:
         "max_requests_per_minute": 60,
         "ban_threshold": 100,
         "max_file_uploads": 10,
-        "allowed_commands_per_hour": 100
+        "allowed_commands_per_hour": 100,
+        # مفتاح تشفير أكواد الإحالة (تغييره لا يبطل الأكواد المحفوظة، فقط يغير الأكواد الجديدة)
+        "referral_secret": os.getenv("REFERRAL_SECRET", BOT_TOKEN)
     }
     
     # المسارات
@@ -136,6 +182,84 @@ class Config:
         "logs": "logs/"
     }
     
+    # تقسيم المستخدمين وسجلاتهم على عدة ملفات (1 = ملف واحد بدون تقسيم)
+    SHARDING = {
+        "shards": int(os.getenv("DB_SHARDS", "1")),
+        "path": "malik_bot.shard{index}.db"
+    }
+    
+    # إعدادات قاعدة البيانات
+    DATABASE = {
+        "executor_workers": 1,  # خيوط تنفيذ الاستعلامات (اتصال SQLite واحد)
+        "busy_timeout": 30,  # مهلة انتظار القفل بالثواني
+        "page_size": 1000  # صفوف كل صفحة عند المرور على كل المستخدمين
+    }
+    
+    # النسخ الاحتياطي
+    BACKUP = {
+        "interval": 3600,  # نسخة كل ساعة
+        "pages_per_step": 256,  # صفحات تنسخ في كل خطوة (القفل يحرر بين الخطوات)
+        "step_pause": 0.005,  # استراحة بين الخطوات بالثواني
+        # عدد النسخ المحفوظة لكل مستوى (أحدث نسخة في كل ساعة/يوم/أسبوع)
+        "keep": {"hourly": 24, "daily": 7, "weekly": 4}
+    }
+    
+    # ذاكرة مؤقتة لصفوف المستخدمين
+    USER_CACHE = {
+        "max_size": 10000,  # أقصى عدد مستخدمين في الذاكرة
+        "ttl": 300  # صلاحية الصف بالثواني
+    }
+    
+    # محرك عرض الإعلانات في الذاكرة
+    AD_ENGINE = {
+        "sample_attempts": 8,  # محاولات السحب العشوائي قبل الفحص الكامل
+        "max_tracked_users": 50000,  # أقصى عدد مستخدمين في سجل المشاهدات الأخيرة
+        "flush_interval": 1.0  # حفظ مشاهدات ونقرات الإعلانات المجمعة كل ثانية
+    }
+    
+    # الإحصائيات اليومية (عدادات في الذاكرة)
+    STATS = {
+        "flush_interval": 60,  # حفظ العدادات في جدول statistics كل دقيقة
+        "reconcile_time": dt_time(hour=3, minute=30)  # إعادة الحساب الدقيق يومياً
+    }
+    
+    # الاحتفاظ بالسجلات الخام وضغطها
+    RETENTION = {
+        "horizon_days": 90,  # السجلات الأقدم تُجمع في جداول يومية ثم تُحذف
+        "chunk_size": 500,  # عدد الصفوف المحذوفة في كل معاملة قصيرة
+        "chunk_pause": 0.05,  # استراحة بين الدفعات لإفساح المجال للمعالجات
+        "vacuum_pages": 1000,  # صفحات تُعاد للنظام في كل خطوة incremental_vacuum
+        "run_time": dt_time(hour=4, minute=0),
+        "archive_dir": "backups/archive/",  # ملفات الأرشيف الشهرية (غير قابلة للتعديل)
+        "archive_fetch": 5000  # صفوف تُقرأ من القاعدة في كل دفعة أثناء الأرشفة
+    }
+    
+    # قياس زمن الاستعلامات
+    PROFILING = {
+        "enabled": True,
+        "slow_query_ms": 50,  # الاستعلامات الأبطأ تسجل مع خطة التنفيذ
+        "top_n": 10
+    }
+    
+    # الإعلان الجماعي (حد تيليجرام ~30 رسالة/ثانية للبوت كله)
+    BROADCAST = {
+        "rate": 30,  # رسائل في الثانية (دلو رموز عام)
+        "burst": 1,  # بلا دفعات فوق المعدل: لا تتجاوز أي ثانية الحد
+        "concurrency": 16,  # طلبات متزامنة تغطي زمن الشبكة
+        "max_retries": 3,  # إعادات أخطاء الشبكة لكل مستلم
+        "retry_base": 1.0,  # تأخير أول إعادة بالثواني (يتضاعف)
+        "progress_interval": 5,  # تحديث رسالة التقدم بالثواني
+        "claim_chunk": 64,  # مستلمون يحجزون في كل معاملة قبل إرسالهم
+        "checkpoint_interval": 1.0,  # حفظ النتائج والمؤشر بالثواني
+        "stop_timeout": 10  # انتظار الطلبات الجارية عند الإيقاف
+    }
+    
+    # تجميع كتابات دفتر النقاط (group commit)
+    LEDGER = {
+        "max_batch": 256,  # أقصى عدد عمليات في المعاملة الواحدة
+        "max_delay": 0.005  # أقصى انتظار لتجميع الدفعة بالثواني
+    }
+    
     # الإعلانات
     ADS = [
         {
@@ -209,29 +333,1029 @@ class Logger:
 
 logger = Logger()
 
+# ==================== وحدة النقاط ====================
+# الأرصدة والمبالغ تخزن أعداداً صحيحة بوحدة 1/1000 نقطة، فتكون المجاميع دقيقة
+MILLI_POINTS = 1000
+
+def to_milli(points) -> int:
+    """تحويل قيمة بالنقاط (من الإعدادات أو الإدخال) إلى ملّي-نقاط"""
+    return int((Decimal(str(points)) * MILLI_POINTS).to_integral_value(ROUND_HALF_UP))
+
+def format_points(milli: int) -> str:
+    """عرض ملّي-نقاط بالنقاط دون أصفار زائدة (12500 -> 12.5)"""
+    text = f"{Decimal(int(milli or 0)) / MILLI_POINTS:,.3f}"
+    return text.rstrip("0").rstrip(".")
+
+# ==================== هوية البوت ====================
+class BotIdentity:
+    """هوية البوت تجلب مرة واحدة عند البدء (post_init) وتشترك فيها المعالجات
+    
+    روابط الإحالة تبنى من بادئة محسوبة مسبقاً بدل طلب getMe عند كل عرض.
+    """
+    
+    def __init__(self):
+        self.id: Optional[int] = None
+        self.username: Optional[str] = None
+        self.link_prefix: Optional[str] = None
+    
+    def load(self, user):
+        """تعيين الهوية من كائن User الخاص بالبوت"""
+        self.id = user.id
+        self.username = user.username
+        self.link_prefix = f"https://t.me/{user.username}?start="
+    
+    def referral_link(self, referral_code: str) -> Optional[str]:
+        """رابط t.me للإحالة (None قبل تحميل الهوية)"""
+        return f"{self.link_prefix}{referral_code}" if self.link_prefix else None
+
+bot_identity = BotIdentity()
+
 # ==================== قاعدة البيانات المتقدمة ====================
+class UserCache:
+    """ذاكرة مؤقتة LRU محدودة الحجم مع مدة صلاحية لصفوف المستخدمين
+    
+    تُحدَّث مباشرة (write-through) من عمليات الكتابة في Database حتى لا
+    يعود جدول users إلى المسار الساخن في التفاعلات المتكررة.
+    """
+    
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._rows: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id: int) -> Optional[Dict]:
+        """نسخة من الصف المخزن أو None"""
+        with self._lock:
+            entry = self._rows.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._rows[user_id]
+                self.misses += 1
+                return None
+            self._rows.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[1])
+    
+    def peek(self, user_id: int) -> Optional[Dict]:
+        """قراءة صف مخزن دون التأثير على العدادات أو ترتيب LRU"""
+        with self._lock:
+            entry = self._rows.get(user_id)
+            return dict(entry[1]) if entry is not None else None
+    
+    def put(self, user_id: int, row: Dict):
+        """تخزين صف كامل"""
+        with self._lock:
+            self._rows[user_id] = (time.monotonic() + self.ttl, dict(row))
+            self._rows.move_to_end(user_id)
+            while len(self._rows) > self.max_size:
+                self._rows.popitem(last=False)
+    
+    def update(self, user_id: int, **fields):
+        """تحديث حقول صف مخزن في مكانه (إن وجد)"""
+        with self._lock:
+            entry = self._rows.get(user_id)
+            if entry is not None:
+                entry[1].update(fields)
+    
+    def invalidate(self, user_id: int):
+        """حذف صف من الذاكرة"""
+        with self._lock:
+            self._rows.pop(user_id, None)
+    
+    def clear(self):
+        """تفريغ الذاكرة بالكامل"""
+        with self._lock:
+            self._rows.clear()
+    
+    def stats(self) -> Dict:
+        """عدادات الإصابة والإخفاق"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._rows),
+            "hit_rate": round(self.hits / total * 100, 1) if total else 0.0
+        }
+
+class _SkipListTail:
+    """مفتاح نهاية القائمة: أكبر من أي مفتاح آخر"""
+    __slots__ = ()
+    
+    def __lt__(self, other):
+        return False
+    
+    def __le__(self, other):
+        return False
+
+class _SkipNode:
+    __slots__ = ("key", "next", "width")
+    
+    def __init__(self, key, next_nodes: List, widths: List[int]):
+        self.key = key
+        self.next = next_nodes
+        self.width = widths
+
+class IndexableSkipList:
+    """قائمة تخطي مرتبة قابلة للفهرسة: إدراج وحذف وترتيب وفهرسة بـ O(log n)
+    
+    كل مؤشر يحمل عرضه (عدد العناصر التي يقفز فوقها) فيُحسب موضع أي مفتاح
+    أثناء البحث نفسه.
+    """
+    
+    MAX_LEVELS = 24
+    
+    def __init__(self):
+        self.size = 0
+        self.tail = _SkipNode(_SkipListTail(), [], [])
+        self.head = _SkipNode(None, [self.tail] * self.MAX_LEVELS, [1] * self.MAX_LEVELS)
+    
+    def __len__(self):
+        return self.size
+    
+    def _random_level(self) -> int:
+        level = 1
+        while level < self.MAX_LEVELS and random.random() < 0.5:
+            level += 1
+        return level
+    
+    def insert(self, key):
+        """إدراج مفتاح"""
+        chain = [None] * self.MAX_LEVELS
+        steps_at_level = [0] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        
+        depth = self._random_level()
+        new_node = _SkipNode(key, [None] * depth, [0] * depth)
+        steps = 0
+        for level in range(depth):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(depth, self.MAX_LEVELS):
+            chain[level].width[level] += 1
+        self.size += 1
+    
+    def remove(self, key):
+        """حذف مفتاح (KeyError إذا لم يوجد)"""
+        chain = [None] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        
+        target = chain[0].next[0]
+        if target is self.tail or target.key != key:
+            raise KeyError(key)
+        
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self.size -= 1
+    
+    def count_less(self, key) -> int:
+        """عدد المفاتيح الأصغر تماماً من key"""
+        position = 0
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+    
+    def iter_from(self, index: int):
+        """المرور على المفاتيح بدءاً من الفهرس index (يبدأ من 0)"""
+        if index >= self.size:
+            return
+        remaining = index + 1
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        while node is not self.tail:
+            yield node.key
+            node = node.next[0]
+
+class Leaderboard:
+    """لوحة متصدرين في الذاكرة: الترتيب وأفضل N والجيران بـ O(log n)
+    
+    المفاتيح (-النقاط، user_id) مرتبة تصاعدياً، فأعلى رصيد أولاً. تُبنى من
+    SQLite عند التشغيل وتُحدَّث مع كل كتابة في دفتر النقاط.
+    """
+    
+    def __init__(self):
+        self._list = IndexableSkipList()
+        self._points: Dict[int, int] = {}
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._list)
+    
+    def load(self, rows, owned=None):
+        """إعادة البناء من أزواج (user_id, points)
+        
+        owned (اختياري) يحدد المستخدمين الذين تستبدلهم rows؛ الباقون يبقون
+        كما هم (لوحة مشتركة بين عدة أجزاء قاعدة بيانات).
+        """
+        with self._lock:
+            if owned is None:
+                self._list = IndexableSkipList()
+                self._points = {}
+            else:
+                for user_id in [uid for uid in self._points if owned(uid)]:
+                    self._list.remove((-self._points.pop(user_id), user_id))
+            for user_id, points in rows:
+                self._points[user_id] = points
+                self._list.insert((-points, user_id))
+    
+    def update(self, user_id: int, points: int):
+        """إضافة مستخدم أو تحديث رصيده"""
+        with self._lock:
+            old = self._points.get(user_id)
+            if old == points:
+                return
+            if old is not None:
+                self._list.remove((-old, user_id))
+            self._points[user_id] = points
+            self._list.insert((-points, user_id))
+    
+    def remove(self, user_id: int):
+        """إزالة مستخدم (مثلاً عند الحظر)"""
+        with self._lock:
+            old = self._points.pop(user_id, None)
+            if old is not None:
+                self._list.remove((-old, user_id))
+    
+    def rank_for_points(self, points: int) -> int:
+        """الترتيب = عدد الأرصدة الأعلى تماماً + 1"""
+        with self._lock:
+            return self._list.count_less((-points,)) + 1
+    
+    def rank(self, user_id: int) -> Optional[int]:
+        """ترتيب مستخدم في اللوحة"""
+        points = self._points.get(user_id)
+        return None if points is None else self.rank_for_points(points)
+    
+    def top(self, limit: int) -> List[Tuple[int, int]]:
+        """أفضل limit مستخدم: [(user_id, points)]"""
+        with self._lock:
+            result = []
+            for neg_points, user_id in self._list.iter_from(0):
+                if len(result) >= limit:
+                    break
+                result.append((user_id, -neg_points))
+            return result
+    
+    def around(self, user_id: int, radius: int = 2) -> List[Tuple[int, int, int]]:
+        """المستخدم وجيرانه: [(الموضع، user_id، points)]"""
+        with self._lock:
+            points = self._points.get(user_id)
+            if points is None:
+                return []
+            index = self._list.count_less((-points, user_id))
+            start = max(index - radius, 0)
+            result = []
+            for position, (neg_points, uid) in enumerate(self._list.iter_from(start), start=start + 1):
+                if position > index + radius + 1:
+                    break
+                result.append((position, uid, -neg_points))
+            return result
+
+class DailyStatsCounters:
+    """عدادات إحصائيات اليوم في الذاكرة
+    
+    تزداد مع كل حدث بدلاً من إعادة حساب سبعة استعلامات تجميعية، وتُحفظ في
+    جدول statistics دورياً. عند تغير اليوم تُحفظ لقطة اليوم المنتهي أولاً.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: List[Dict] = []
+        self.total_users = 0
+        self.total_points = 0
+        self._reset_day(self._today())
+    
+    @staticmethod
+    def _today() -> str:
+        return datetime.now().strftime('%Y-%m-%d')
+    
+    def _reset_day(self, day: str):
+        self.day = day
+        self.new_users = 0
+        self.active_users = set()
+        self.ads_viewed = 0
+        self.games_played = 0
+        self.files_converted = 0
+    
+    def _roll(self):
+        """بدء يوم جديد مع الاحتفاظ بلقطة اليوم السابق للحفظ"""
+        today = self._today()
+        if today != self.day:
+            self._pending.append(self._snapshot())
+            self._reset_day(today)
+    
+    def _snapshot(self) -> Dict:
+        return {
+            "date": self.day,
+            "total_users": self.total_users,
+            "new_users": self.new_users,
+            "active_users": len(self.active_users),
+            "total_points": self.total_points,
+            "ads_viewed": self.ads_viewed,
+            "games_played": self.games_played,
+            "files_converted": self.files_converted
+        }
+    
+    def record_new_user(self, points: int):
+        with self._lock:
+            self._roll()
+            self.new_users += 1
+            self.total_users += 1
+            self.total_points += points
+    
+    def record_activity(self, user_id: int, points_delta: int = 0):
+        with self._lock:
+            self._roll()
+            self.active_users.add(user_id)
+            self.total_points += points_delta
+    
+    def record_ad_view(self):
+        with self._lock:
+            self._roll()
+            self.ads_viewed += 1
+    
+    def record_game(self):
+        with self._lock:
+            self._roll()
+            self.games_played += 1
+    
+    def record_file(self):
+        with self._lock:
+            self._roll()
+            self.files_converted += 1
+    
+    def active_count(self) -> int:
+        with self._lock:
+            self._roll()
+            return len(self.active_users)
+    
+    def drain(self) -> List[Dict]:
+        """لقطات الأيام المنتهية + لقطة اليوم الحالي للحفظ"""
+        with self._lock:
+            self._roll()
+            snapshots = self._pending + [self._snapshot()]
+            self._pending = []
+            return snapshots
+    
+    def restore(self, snapshots: List[Dict]):
+        """إعادة لقطات الأيام المنتهية بعد فشل الحفظ"""
+        with self._lock:
+            self._pending = [snap for snap in snapshots if snap["date"] != self.day] + self._pending
+    
+    def reset(self, day: str, values: Dict, active_ids):
+        """ضبط العدادات على القيم الدقيقة (بعد المطابقة)"""
+        with self._lock:
+            self.total_users = values["total_users"]
+            self.total_points = values["total_points"]
+            if day == self.day:
+                self.new_users = values["new_users"]
+                self.active_users = set(active_ids)
+                self.ads_viewed = values["ads_viewed"]
+                self.games_played = values["games_played"]
+                self.files_converted = values["files_converted"]
+
+class AdInventory:
+    """مخزون الإعلانات النشطة في الذاكرة مع سحب عشوائي موزون
+    
+    الوزن مشتق من نقاط الإعلان وميزانيته، والسحب بجدول Alias (Vose) بزمن
+    O(1). لكل مستخدم سجل صغير بالإعلانات التي شاهدها خلال فترة الانتظار
+    فيُعاد السحب إن وقع عليها.
+    """
+    
+    def __init__(self, cooldown: int):
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._ads: List[Dict] = []
+        self._by_id: Dict[int, Dict] = {}
+        self._prob: List[float] = []
+        self._alias: List[int] = []
+        self._recent: OrderedDict = OrderedDict()
+    
+    def __len__(self):
+        return len(self._ads)
+    
+    @staticmethod
+    def weight(ad: Dict) -> float:
+        """وزن الإعلان: نقاطه مضروبة في معامل لوغاريتمي لميزانيته"""
+        return max(ad.get('points') or 1, 1) * (1 + math.log1p(max(ad.get('budget') or 0, 0)))
+    
+    def load(self, ads: List[Dict]):
+        """إعادة بناء المخزون وجدول Alias"""
+        weights = [self.weight(ad) for ad in ads]
+        count = len(ads)
+        prob = [0.0] * count
+        alias = [0] * count
+        
+        if count:
+            total = sum(weights)
+            scaled = [w * count / total for w in weights]
+            small = [i for i, p in enumerate(scaled) if p < 1]
+            large = [i for i, p in enumerate(scaled) if p >= 1]
+            while small and large:
+                low, high = small.pop(), large.pop()
+                prob[low] = scaled[low]
+                alias[low] = high
+                scaled[high] = scaled[high] + scaled[low] - 1
+                (small if scaled[high] < 1 else large).append(high)
+            for i in small + large:
+                prob[i] = 1.0
+        
+        with self._lock:
+            self._ads = [dict(ad) for ad in ads]
+            self._by_id = {ad['id']: ad for ad in self._ads}
+            self._prob = prob
+            self._alias = alias
+    
+    def get(self, ad_id: int) -> Optional[Dict]:
+        """إعلان نشط بالمعرف"""
+        ad = self._by_id.get(ad_id)
+        return dict(ad) if ad else None
+    
+    def _seen(self, user_id: int, now: float) -> Dict[int, float]:
+        """الإعلانات التي شاهدها المستخدم ولم تنته فترة انتظارها"""
+        seen = self._recent.get(user_id)
+        if seen is None:
+            return {}
+        expired = [ad_id for ad_id, until in seen.items() if until <= now]
+        for ad_id in expired:
+            del seen[ad_id]
+        if not seen:
+            del self._recent[user_id]
+        return seen
+    
+    def mark_seen(self, user_id: int, ad_id: int, seen_at: float = None):
+        """تسجيل مشاهدة مستخدم لإعلان"""
+        until = (seen_at if seen_at is not None else time.time()) + self.cooldown
+        with self._lock:
+            seen = self._recent.setdefault(user_id, {})
+            seen[ad_id] = max(seen.get(ad_id, 0), until)
+            self._recent.move_to_end(user_id)
+            while len(self._recent) > Config.AD_ENGINE["max_tracked_users"]:
+                self._recent.popitem(last=False)
+    
+    def pick(self, user_id: int) -> Optional[Dict]:
+        """اختيار إعلان موزون لم يشاهده المستخدم مؤخراً"""
+        with self._lock:
+            if not self._ads:
+                return None
+            seen = self._seen(user_id, time.time())
+            
+            for _ in range(Config.AD_ENGINE["sample_attempts"]):
+                i = random.randrange(len(self._ads))
+                if random.random() >= self._prob[i]:
+                    i = self._alias[i]
+                if self._ads[i]['id'] not in seen:
+                    return dict(self._ads[i])
+            
+            # معظم الإعلانات شوهدت: اختيار موزون من المتبقي فقط
+            eligible = [ad for ad in self._ads if ad['id'] not in seen]
+            if not eligible:
+                return None
+            ad = random.choices(eligible, weights=[self.weight(a) for a in eligible])[0]
+            return dict(ad)
+
+class AdViewBuffer:
+    """تجميع مشاهدات ونقرات الإعلانات في الذاكرة وحفظها دفعة واحدة
+    
+    كل مشاهدة تُضاف لعدادات الإعلان في الذاكرة ولصفوف ad_views المعلقة،
+    وتُكتب أولاً سطراً في ملف سجل (journal) بترقيم تسلسلي. الحفظ يكتب الصفوف
+    ويزيد عدادات ads ويسجل آخر رقم محفوظ في نفس المعاملة، فإعادة تشغيل
+    السجل بعد توقف مفاجئ لا تكرر ولا تفقد أي مشاهدة.
+    """
+    
+    def __init__(self, journal_path: str):
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+        self._rows: List[Tuple] = []
+        self._views: Dict[int, int] = {}
+        self._clicks: Dict[int, int] = {}
+        self._seq = 0
+        self._journal = None
+    
+    def __len__(self):
+        return len(self._rows)
+    
+    def open(self, flushed_seq: int) -> List[Tuple]:
+        """قراءة المشاهدات غير المحفوظة من السجل ثم فتحه للإضافة"""
+        recovered = []
+        self._seq = flushed_seq
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding='utf-8') as journal:
+                for line in journal:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) != 5:
+                        continue  # سطر ناقص من توقف أثناء الكتابة
+                    seq, user_id, ad_id, clicked, viewed_at = parts
+                    self._seq = max(self._seq, int(seq))
+                    if int(seq) > flushed_seq:
+                        recovered.append((int(seq), int(user_id), int(ad_id), int(clicked), viewed_at))
+        
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        with self._lock:
+            for row in recovered:
+                self._add(row)
+        return recovered
+    
+    def _add(self, row: Tuple):
+        _, _, ad_id, clicked, _ = row
+        self._rows.append(row)
+        self._views[ad_id] = self._views.get(ad_id, 0) + 1
+        if clicked:
+            self._clicks[ad_id] = self._clicks.get(ad_id, 0) + 1
+    
+    def record(self, user_id: int, ad_id: int, clicked: bool):
+        """تسجيل مشاهدة في السجل والذاكرة"""
+        viewed_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        with self._lock:
+            self._seq += 1
+            row = (self._seq, user_id, ad_id, int(clicked), viewed_at)
+            if self._journal:
+                self._journal.write('\t'.join(map(str, row)) + '\n')
+                self._journal.flush()
+            self._add(row)
+    
+    def drain(self) -> Tuple[List[Tuple], Dict[int, int], Dict[int, int]]:
+        """أخذ كل المعلق وتصفير الذاكرة"""
+        with self._lock:
+            drained = (self._rows, self._views, self._clicks)
+            self._rows, self._views, self._clicks = [], {}, {}
+            return drained
+    
+    def restore(self, rows: List[Tuple]):
+        """إعادة صفوف لم تُحفظ إلى مقدمة الطابور"""
+        with self._lock:
+            pending = self._rows
+            self._rows, self._views, self._clicks = [], {}, {}
+            for row in rows + pending:
+                self._add(row)
+    
+    def truncate_journal(self):
+        """تفريغ السجل بعد حفظ كل ما فيه"""
+        with self._lock:
+            if self._journal and not self._rows:
+                self._journal.truncate(0)
+    
+    def close(self):
+        with self._lock:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+
+class TransactionArchive:
+    """أرشيف المعاملات القديمة في ملفات شهرية مضغوطة
+    
+    كل ملف (transactions-YYYY-MM.seg) يكتب مرة واحدة ولا يعدل بعدها:
+    رأس ثابت، ثم كتلة zlib لكل مستخدم (معاملاته من الأحدث للأقدم)، ثم فهرس
+    مضغوط يربط user_id بـ (offset, length, count)، ثم تذييل بموقع الفهرس.
+    قراءة سجل مستخدم واحد تفك كتلته فقط دون باقي الملف.
+    """
+    
+    MAGIC = b"MLKSEG1\n"
+    FOOTER = struct.Struct(">QI")
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._indexes: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+    
+    def path_for(self, month: str) -> str:
+        return os.path.join(self.directory, f"transactions-{month}.seg")
+    
+    def write_segment(self, month: str, columns: List[str], rows: List[tuple]) -> Dict:
+        """كتابة ملف شهر كامل ذرياً (ملف مؤقت ثم إعادة تسمية)"""
+        os.makedirs(self.directory, exist_ok=True)
+        user_column = columns.index("user_id")
+        id_column = columns.index("id")
+        by_user: Dict[int, List[tuple]] = {}
+        for row in rows:
+            by_user.setdefault(row[user_column], []).append(row)
+        
+        path = self.path_for(month)
+        tmp_path = f"{path}.tmp"
+        users = {}
+        with open(tmp_path, "wb") as f:
+            f.write(self.MAGIC)
+            for user_id, user_rows in by_user.items():
+                user_rows.sort(key=lambda r: r[id_column], reverse=True)
+                block = zlib.compress(json.dumps(user_rows, ensure_ascii=False).encode("utf-8"), 9)
+                users[str(user_id)] = [f.tell(), len(block), len(user_rows)]
+                f.write(block)
+            index_offset = f.tell()
+            index = zlib.compress(json.dumps({
+                "month": month, "columns": columns, "rows": len(rows), "users": users
+            }).encode("utf-8"), 9)
+            f.write(index)
+            f.write(self.FOOTER.pack(index_offset, len(index)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, path)
+        
+        with self._lock:
+            self._indexes.pop(path, None)
+        return {"path": path, "rows": len(rows), "users": len(users), "sha256": self.checksum(path)}
+    
+    @staticmethod
+    def checksum(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def index(self, path: str) -> Dict:
+        """فهرس الملف (يحمّل مرة ويبقى في الذاكرة)"""
+        with self._lock:
+            cached = self._indexes.get(path)
+        if cached is not None:
+            return cached
+        with open(path, "rb") as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f"ملف أرشيف غير صالح: {path}")
+            f.seek(-self.FOOTER.size, os.SEEK_END)
+            index_offset, index_length = self.FOOTER.unpack(f.read(self.FOOTER.size))
+            f.seek(index_offset)
+            index = json.loads(zlib.decompress(f.read(index_length)))
+        with self._lock:
+            self._indexes[path] = index
+        return index
+    
+    def user_count(self, path: str, user_id: int) -> int:
+        entry = self.index(path)["users"].get(str(user_id))
+        return entry[2] if entry else 0
+    
+    def read_user(self, path: str, user_id: int) -> List[Dict]:
+        """معاملات مستخدم في ملف واحد، من الأحدث للأقدم"""
+        index = self.index(path)
+        entry = index["users"].get(str(user_id))
+        if not entry:
+            return []
+        offset, length, _ = entry
+        with open(path, "rb") as f:
+            f.seek(offset)
+            rows = json.loads(zlib.decompress(f.read(length)))
+        return [dict(zip(index["columns"], row), archived=True) for row in rows]
+
+class ReferralCodec:
+    """أكواد إحالة حتمية من user_id دون أي استعلام
+    
+    user_id (حتى 52 بت حسب Telegram) يمر بتبديل Feistel مفتاحه سري
+    (4 جولات على نصفين 26 بت) فلا يظهر المعرف في الكود، ثم يضاف
+    checksum مفتاحي 8 بت، ويكتب الناتج (60 بت) بـ 12 حرف Crockford base32.
+    التبديل عكسي: فك الكود يعطي user_id مباشرة ويرفض الأكواد المحرفة.
+    """
+    
+    ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+    ALIASES = str.maketrans({"O": "0", "I": "1", "L": "1", "-": None, " ": None})
+    HALF_BITS = 26
+    HALF_MASK = (1 << 26) - 1
+    ROUNDS = 4
+    LENGTH = 12
+    
+    def __init__(self, secret: str):
+        self._key = hashlib.sha256(secret.encode("utf-8")).digest()
+        self._digits = {char: value for value, char in enumerate(self.ALPHABET)}
+    
+    def _mix(self, value: int, tag: int, size: int) -> int:
+        digest = hashlib.blake2b(
+            value.to_bytes(7, "big") + bytes([tag]), key=self._key, digest_size=size
+        ).digest()
+        return int.from_bytes(digest, "big")
+    
+    def _permute(self, value: int) -> int:
+        left, right = value >> self.HALF_BITS, value & self.HALF_MASK
+        for round_no in range(self.ROUNDS):
+            left, right = right, left ^ (self._mix(right, round_no, 4) & self.HALF_MASK)
+        return (left << self.HALF_BITS) | right
+    
+    def _unpermute(self, value: int) -> int:
+        left, right = value >> self.HALF_BITS, value & self.HALF_MASK
+        for round_no in reversed(range(self.ROUNDS)):
+            left, right = right ^ (self._mix(left, round_no, 4) & self.HALF_MASK), left
+        return (left << self.HALF_BITS) | right
+    
+    def encode(self, user_id: int) -> str:
+        if not 0 < user_id < (1 << (2 * self.HALF_BITS)):
+            raise ValueError(f"معرف خارج النطاق: {user_id}")
+        permuted = self._permute(user_id)
+        value = (permuted << 8) | self._mix(permuted, 255, 1)
+        return "".join(
+            self.ALPHABET[(value >> shift) & 31]
+            for shift in range(5 * (self.LENGTH - 1), -1, -5)
+        )
+    
+    def decode(self, code: str) -> Optional[int]:
+        """user_id من الكود، أو None إن لم يكن كوداً صالحاً من هذا المولد"""
+        code = code.upper().translate(self.ALIASES)
+        if len(code) != self.LENGTH:
+            return None
+        value = 0
+        for char in code:
+            digit = self._digits.get(char)
+            if digit is None:
+                return None
+            value = (value << 5) | digit
+        permuted = value >> 8
+        if value & 0xFF != self._mix(permuted, 255, 1):
+            return None
+        return self._unpermute(permuted)
+
+class QueryProfiler:
+    """إحصائيات زمن كل استعلام مجمعة حسب نص SQL بعد توحيده
+    
+    لكل استعلام: عدد التنفيذات والزمن الكلي والأقصى والصفوف ومدرج زمني
+    (histogram) بحدود ثابتة بالملّي ثانية يقدر منه p50/p95/p99.
+    التحديث بلا قفل لأن كل الاستعلامات تنفذ متسلسلة تحت قفل Database.
+    """
+    
+    BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, float("inf"))
+    _literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+    _spaces = re.compile(r"\s+")
+    
+    def __init__(self, slow_query_ms: float):
+        self.slow_query_ms = slow_query_ms
+        self._stats: Dict[str, Dict] = {}
+        self._keys: Dict[str, str] = {}
+    
+    def entry(self, sql: str) -> Dict:
+        """سجل إحصائيات الاستعلام (يُنشأ عند أول تنفيذ)"""
+        key = self._keys.get(sql)
+        if key is None:
+            key = self._spaces.sub(" ", self._literals.sub("?", sql)).strip()
+            if len(self._keys) < 10000:
+                self._keys[sql] = key
+        entry = self._stats.get(key)
+        if entry is None:
+            entry = self._stats[key] = {
+                "sql": key, "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+                "histogram": [0] * len(self.BUCKETS_MS), "plan": None, "sample": None
+            }
+        return entry
+    
+    def entries(self) -> List[Dict]:
+        return list(self._stats.values())
+    
+    def finish(self, entry: Dict, elapsed_ms: float) -> bool:
+        """إغلاق تنفيذ واحد؛ يعيد True إن كان بطيئاً"""
+        entry["calls"] += 1
+        if elapsed_ms > entry["max_ms"]:
+            entry["max_ms"] = elapsed_ms
+        entry["histogram"][bisect.bisect_left(self.BUCKETS_MS, elapsed_ms)] += 1
+        return elapsed_ms >= self.slow_query_ms
+    
+    def _percentile(self, histogram: List[int], fraction: float) -> float:
+        target = fraction * sum(histogram)
+        seen = 0
+        for bound, count in zip(self.BUCKETS_MS, histogram):
+            seen += count
+            if seen >= target and count:
+                return bound
+        return 0.0
+    
+    def top(self, n: int = 10) -> List[Dict]:
+        """أعلى n استعلامات حسب الزمن الكلي"""
+        entries = sorted(list(self._stats.values()), key=lambda e: e["total_ms"], reverse=True)
+        result = []
+        for entry in entries[:n]:
+            calls = entry["calls"] or 1
+            histogram = list(entry["histogram"])
+            result.append({
+                "sql": entry["sql"],
+                "calls": entry["calls"],
+                "total_ms": round(entry["total_ms"], 2),
+                "avg_ms": round(entry["total_ms"] / calls, 3),
+                "max_ms": round(entry["max_ms"], 2),
+                "p50_ms": self._percentile(histogram, 0.50),
+                "p95_ms": self._percentile(histogram, 0.95),
+                "p99_ms": self._percentile(histogram, 0.99),
+                "rows": entry["rows"],
+                "plan": entry["plan"]
+            })
+        return result
+    
+    def reset(self):
+        self._stats.clear()
+
+class ProfiledCursor(sqlite3.Cursor):
+    """مؤشر يقيس زمن كل تنفيذ وما يتبعه من جلب للصفوف
+    
+    زمن SELECT يشمل الجلب: يبقى التنفيذ مفتوحاً حتى أول fetchone/fetchall
+    (أو حتى تُستنفد fetchmany) ثم يقارن الزمن الكلي بحد البطء.
+    """
+    
+    _profile_entry = None
+    _profile_elapsed = 0.0
+    _profile_args = None
+    
+    def execute(self, sql, parameters=()):
+        profiler = self.connection.profiler
+        if profiler is None:
+            return super().execute(sql, parameters)
+        if self._profile_entry is not None:
+            self._profile_done()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._profile_start(profiler, sql, parameters, time.perf_counter() - started)
+    
+    def executemany(self, sql, seq_of_parameters):
+        profiler = self.connection.profiler
+        if profiler is None:
+            return super().executemany(sql, seq_of_parameters)
+        if self._profile_entry is not None:
+            self._profile_done()
+        seq_of_parameters = list(seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            first = seq_of_parameters[0] if seq_of_parameters else ()
+            self._profile_start(profiler, sql, first, time.perf_counter() - started)
+    
+    def _profile_start(self, profiler: QueryProfiler, sql: str, parameters, elapsed: float):
+        entry = profiler.entry(sql)
+        entry["total_ms"] += elapsed * 1000
+        if self.rowcount > 0:
+            entry["rows"] += self.rowcount
+        if entry["sample"] is None:
+            entry["sample"] = (sql, parameters)
+        self._profile_entry = entry
+        self._profile_elapsed = elapsed * 1000
+        self._profile_args = (sql, parameters)
+        if self.description is None:
+            self._profile_done()
+    
+    def _profile_fetch(self, fetch, *args):
+        entry = self._profile_entry
+        if entry is None:
+            return fetch(*args)
+        started = time.perf_counter()
+        rows = fetch(*args)
+        elapsed = (time.perf_counter() - started) * 1000
+        entry["total_ms"] += elapsed
+        self._profile_elapsed += elapsed
+        if isinstance(rows, list):
+            entry["rows"] += len(rows)
+            if rows and fetch.__name__ == "fetchmany":
+                return rows
+        elif rows is not None:
+            entry["rows"] += 1
+        # fetchone يغلق القياس أيضاً: أغلب استخداماته لصف واحد ثم يُترك المؤشر
+        self._profile_done()
+        return rows
+    
+    def fetchone(self):
+        return self._profile_fetch(super().fetchone)
+    
+    def fetchmany(self, size=None):
+        return self._profile_fetch(super().fetchmany, size or self.arraysize)
+    
+    def fetchall(self):
+        return self._profile_fetch(super().fetchall)
+    
+    def _profile_done(self):
+        """إغلاق قياس التنفيذ الحالي وتسجيله في سجل البطء إن لزم"""
+        entry, self._profile_entry = self._profile_entry, None
+        if not self.connection.profiler.finish(entry, self._profile_elapsed):
+            return
+        sql, parameters = self._profile_args
+        if entry["plan"] is None:
+            entry["plan"] = self.connection.explain(sql, parameters)
+        logger.warning(
+            f"استعلام بطيء ({self._profile_elapsed:.1f}ms): {entry['sql']}"
+            + (f" | الخطة: {'; '.join(entry['plan'])}" if entry["plan"] else "")
+        )
+
+class ProfiledConnection(sqlite3.Connection):
+    """اتصال تمر كل استعلاماته عبر ProfiledCursor"""
+    
+    profiler: Optional[QueryProfiler] = None
+    
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def explain(self, sql: str, parameters=()) -> List[str]:
+        """EXPLAIN QUERY PLAN بمؤشر عادي (خارج القياس)"""
+        try:
+            cursor = super().cursor()
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+            return [row[-1] for row in cursor.fetchall()]
+        except sqlite3.Error:
+            return []
+
 class Database:
     """نظام قاعدة بيانات متقدم مع إدارة الاتصالات"""
     _instance = None
     
-    def __new__(cls):
+    def __new__(cls, path: str = None, home: "Database" = None, shard: Tuple[int, int] = None):
+        # مسار مخصص = نسخة مستقلة (للاختبارات وقياس الأداء، أو جزء من ShardedDatabase)
+        if path is not None:
+            instance = super().__new__(cls)
+            instance.initialize(path, home, shard)
+            return instance
+        
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             cls._instance.initialize()
         return cls._instance
     
-    def initialize(self):
-        """تهيئة قاعدة البيانات"""
+    def initialize(self, path: str = None, home: "Database" = None, shard: Tuple[int, int] = None):
+        """تهيئة قاعدة البيانات
+        
+        shard=(index, count) يجعل النسخة جزءاً من ShardedDatabase: أرشيفها
+        ونسخها الاحتياطية في مجلد خاص، ولوحة المتصدرين تستبدل مستخدميها فقط.
+        home هو الجزء 0 (جداول الإعلانات والإعدادات والإحصائيات العامة) وتشاركه
+        باقي الأجزاء هياكل الذاكرة.
+        """
+        self.path = path or Config.PATHS["database"]
         self.conn = sqlite3.connect(
-            Config.PATHS["database"],
+            self.path,
             check_same_thread=False,
-            timeout=30
+            timeout=Config.DATABASE["busy_timeout"],
+            factory=ProfiledConnection
         )
+        if Config.PROFILING["enabled"]:
+            self.conn.profiler = QueryProfiler(Config.PROFILING["slow_query_ms"])
         self.conn.row_factory = sqlite3.Row
         self.cursor = self.conn.cursor()
+        # قواعد البيانات الجديدة تعيد الصفحات المحررة للنظام تدريجياً
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.user_cache = UserCache(
+            Config.USER_CACHE["max_size"],
+            Config.USER_CACHE["ttl"]
+        )
+        if home is None:
+            self.leaderboard = Leaderboard()
+            self.daily_stats = DailyStatsCounters()
+            self.ad_inventory = AdInventory(Config.TIME_LIMITS["ad_cooldown"])
+        else:
+            self.leaderboard = home.leaderboard
+            self.daily_stats = home.daily_stats
+            self.ad_inventory = home.ad_inventory
+        self.ad_counters_db = home or self
+        self.archive_dir = Config.RETENTION["archive_dir"]
+        self.backup_dir = Config.PATHS["backups"]
+        self.shard_filter = None
+        if shard is not None:
+            index, count = shard
+            self.archive_dir = os.path.join(self.archive_dir, f"shard{index}")
+            self.backup_dir = os.path.join(self.backup_dir, f"shard{index}")
+            self.shard_filter = lambda user_id: shard_index(user_id, count) == index
+        self.archive = TransactionArchive(self.archive_dir)
+        self.referral_codec = ReferralCodec(Config.SECURITY["referral_secret"])
+        self.ad_view_buffer = AdViewBuffer(f"{self.path}.adviews.journal")
+        
+        # خيط مخصص لتنفيذ الاستعلامات بعيداً عن حلقة الأحداث
+        self.lock = threading.RLock()
+        self._backup_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=Config.DATABASE["executor_workers"],
+            thread_name_prefix="malik-db"
+        )
         self.create_tables()
         self.create_indexes()
         self.seed_data()
+        self.migrate()
+        self.rebuild_leaderboard()
+        self.recover_ad_views()
+        if home is None:
+            self.reconcile_daily_stats()
+            self.reload_ads()
+        else:
+            # الإعلانات والإحصائيات العامة يحملها الجزء 0 و ShardedDatabase
+            self.restore_ad_cooldowns()
     
     def create_tables(self):
         """إنشاء جميع الجداول"""
@@ -245,9 +1369,9 @@ class Database:
                 first_name TEXT NOT NULL,
                 last_name TEXT,
                 language_code TEXT DEFAULT 'ar',
-                points DECIMAL(10,2) DEFAULT 5.0,
-                total_earned DECIMAL(10,2) DEFAULT 0.0,
-                referral_code VARCHAR(10) UNIQUE,
+                points INTEGER DEFAULT 0,  -- ملّي-نقاط (1/1000 نقطة)
+                total_earned INTEGER DEFAULT 0,
+                referral_code VARCHAR(12) UNIQUE,
                 referred_by INTEGER,
                 referral_count INTEGER DEFAULT 0,
                 join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -257,6 +1381,9 @@ class Database:
                 is_premium BOOLEAN DEFAULT 0,
                 is_banned BOOLEAN DEFAULT 0,
                 ban_reason TEXT,
+                delivery_state TEXT DEFAULT 'ok',  -- ok / blocked / deactivated / not_found
+                delivery_error TEXT,
+                undeliverable_since TIMESTAMP,
                 settings TEXT DEFAULT '{}'
             )
             """,
@@ -266,7 +1393,7 @@ class Database:
             CREATE TABLE IF NOT EXISTS transactions (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
-                amount DECIMAL(10,2) NOT NULL,
+                amount INTEGER NOT NULL,
                 type VARCHAR(20) NOT NULL,
                 description TEXT,
                 reference_id TEXT,
@@ -320,7 +1447,7 @@ class Database:
                 file_size INTEGER,
                 file_hash VARCHAR(64),
                 operation_type VARCHAR(20),
-                points_cost DECIMAL(5,2),
+                points_cost INTEGER,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 status VARCHAR(20) DEFAULT 'active',
                 FOREIGN KEY (user_id) REFERENCES users(user_id)
@@ -334,13 +1461,95 @@ class Database:
                 user_id INTEGER NOT NULL,
                 game_type VARCHAR(20) NOT NULL,
                 score INTEGER,
-                points_earned DECIMAL(5,2),
+                points_earned INTEGER,
                 duration INTEGER,
+                game_data TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users(user_id)
             )
             """,
             
+            # مجاميع يومية لكل مستخدم (تُحدَّث مع كل كتابة)
+            """
+            CREATE TABLE IF NOT EXISTS user_daily_totals (
+                user_id INTEGER NOT NULL,
+                day DATE NOT NULL,
+                points INTEGER DEFAULT 0,
+                transactions INTEGER DEFAULT 0,
+                ads INTEGER DEFAULT 0,
+                games INTEGER DEFAULT 0,
+                PRIMARY KEY (user_id, day)
+            ) WITHOUT ROWID
+            """,
+            
+            # ملخص يومي للمعاملات المضغوطة (لكل مستخدم ونوع)
+            """
+            CREATE TABLE IF NOT EXISTS transactions_daily (
+                user_id INTEGER NOT NULL,
+                day DATE NOT NULL,
+                type VARCHAR(20) NOT NULL,
+                count INTEGER DEFAULT 0,
+                amount INTEGER DEFAULT 0,
+                PRIMARY KEY (user_id, day, type)
+            ) WITHOUT ROWID
+            """,
+            
+            # مهام الإعلان الجماعي (تستأنف بعد إعادة التشغيل من cursor_user_id)
+            """
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                parse_mode TEXT,
+                created_by INTEGER,
+                chat_id INTEGER,
+                message_id INTEGER,
+                status TEXT DEFAULT 'running',
+                cursor_user_id INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                unknown INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+            """,
+            
+            # نتيجة كل مستلم (queued = حُجز للإرسال ولم تُسجل نتيجته بعد)
+            """
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (job_id, user_id)
+            ) WITHOUT ROWID
+            """,
+            
+            # ملفات أرشيف المعاملات الشهرية
+            """
+            CREATE TABLE IF NOT EXISTS archive_segments (
+                month VARCHAR(7) PRIMARY KEY,
+                path TEXT NOT NULL,
+                rows INTEGER NOT NULL,
+                users INTEGER NOT NULL,
+                sha256 VARCHAR(64) NOT NULL,
+                amount_scale INTEGER NOT NULL DEFAULT 1,  -- مضاعف amount المخزن في الملف إلى ملّي-نقاط
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            
+            # ملخص يومي لمشاهدات الإعلانات المضغوطة (لكل إعلان)
+            """
+            CREATE TABLE IF NOT EXISTS ad_views_daily (
+                ad_id INTEGER NOT NULL,
+                day DATE NOT NULL,
+                views INTEGER DEFAULT 0,
+                clicks INTEGER DEFAULT 0,
+                PRIMARY KEY (ad_id, day)
+            ) WITHOUT ROWID
+            """,
+            
             # جدول الإحصائيات
             """
             CREATE TABLE IF NOT EXISTS statistics (
@@ -349,7 +1558,7 @@ class Database:
                 total_users INTEGER DEFAULT 0,
                 new_users INTEGER DEFAULT 0,
                 active_users INTEGER DEFAULT 0,
-                total_points DECIMAL(15,2) DEFAULT 0.0,
+                total_points INTEGER DEFAULT 0,
                 ads_viewed INTEGER DEFAULT 0,
                 games_played INTEGER DEFAULT 0,
                 files_converted INTEGER DEFAULT 0,
@@ -372,7 +1581,7 @@ class Database:
             CREATE TABLE IF NOT EXISTS withdrawals (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
-                amount DECIMAL(10,2) NOT NULL,
+                amount INTEGER NOT NULL,
                 method VARCHAR(20),
                 status VARCHAR(20) DEFAULT 'pending',
                 details TEXT,
@@ -407,13 +1616,14 @@ class Database:
     def create_indexes(self):
         """إنشاء فهارس لتحسين الأداء"""
         indexes = [
-            "CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id)",
-            "CREATE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code)",
-            "CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions(user_id)",
+            # user_id و referral_code لهما فهارس UNIQUE تلقائية
+            "CREATE INDEX IF NOT EXISTS idx_users_join_date ON users(join_date)",
+            "CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions(user_id, created_at)",
             "CREATE INDEX IF NOT EXISTS idx_transactions_created_at ON transactions(created_at)",
-            "CREATE INDEX IF NOT EXISTS idx_ad_views_user_ad ON ad_views(user_id, ad_id)",
-            "CREATE INDEX IF NOT EXISTS idx_games_user_id ON games(user_id)",
-            "CREATE INDEX IF NOT EXISTS idx_files_user_id ON files(user_id)"
+            "CREATE INDEX IF NOT EXISTS idx_ad_views_viewed_at ON ad_views(viewed_at)",
+            "CREATE INDEX IF NOT EXISTS idx_games_user_type ON games(user_id, game_type)",
+            "CREATE INDEX IF NOT EXISTS idx_games_created_at ON games(created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_files_created_at ON files(created_at)"
         ]
         
         for index_sql in indexes:
@@ -443,66 +1653,245 @@ class Database:
                 (key, value, description)
             )
         
-        # إضافة إعلانات افتراضية
+        # إضافة إعلانات افتراضية (مرة واحدة فقط - لا يوجد قيد UNIQUE على ads)
         for ad in Config.ADS:
             self.cursor.execute(
-                """INSERT OR IGNORE INTO ads 
+                """INSERT INTO ads 
                 (title, content, ad_type, image_url, link, points) 
-                VALUES (?, ?, ?, ?, ?, ?)""",
+                SELECT ?, ?, ?, ?, ?, ? 
+                WHERE NOT EXISTS (SELECT 1 FROM ads WHERE title = ?)""",
                 (ad["title"], ad["content"], ad["type"], 
-                 ad.get("image_url"), ad.get("link"), ad.get("points", 1))
+                 ad.get("image_url"), ad.get("link"), ad.get("points", 1), ad["title"])
             )
         
         self.conn.commit()
     
+    def migrate(self):
+        """تطبيق ترحيلات البيانات المعلقة حسب PRAGMA user_version"""
+        migrations = [
+            self.backfill_daily_totals,  # 1: ملء المجاميع اليومية من السجلات الحالية
+            self.upgrade_indexes,  # 2: حذف الفهارس المكررة وإضافة games.game_data
+            self.convert_to_milli_points,  # 3: الأرصدة والمبالغ أعداد صحيحة بالملّي-نقاط
+            self.add_delivery_state,  # 4: حالة الوصول للمستخدم (حظر البوت، حساب محذوف)
+        ]
+        
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(migrations[version:], start=version + 1):
+            logger.info(f"تطبيق ترحيل قاعدة البيانات رقم {number}: {migration.__name__}")
+            migration()
+            self.conn.execute(f"PRAGMA user_version = {number}")
+            self.conn.commit()
+    
+    def upgrade_indexes(self):
+        """حذف فهارس لا يستخدمها أي استعلام (كتابة إضافية فقط) وإكمال المخطط"""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(games)")]
+        if "game_data" not in columns:
+            self.conn.execute("ALTER TABLE games ADD COLUMN game_data TEXT")
+        for index in ("idx_users_user_id", "idx_users_referral_code", "idx_transactions_user_id",
+                      "idx_ad_views_user_ad", "idx_games_user_id", "idx_files_user_id"):
+            self.conn.execute(f"DROP INDEX IF EXISTS {index}")
+        self.conn.execute("ANALYZE")
+        self.conn.commit()
+    
+    # أعمدة النقاط المخزنة كملّي-نقاط صحيحة
+    MILLI_COLUMNS = {
+        "users": ("points", "total_earned"),
+        "transactions": ("amount",),
+        "games": ("points_earned",),
+        "files": ("points_cost",),
+        "withdrawals": ("amount",),
+        "user_daily_totals": ("points",),
+        "transactions_daily": ("amount",),
+        "statistics": ("total_points",)
+    }
+    
+    def convert_to_milli_points(self):
+        """تحويل الأرصدة والمبالغ العشرية (REAL) إلى أعداد صحيحة بالملّي-نقاط
+        
+        الأعمدة المعلنة DECIMAL لها ألفة NUMERIC فتخزن القيم الصحيحة كـ INTEGER
+        دون إعادة بناء الجداول. ملفات الأرشيف لا تعدل: amount_scale يحول قيمها عند القراءة.
+        """
+        for table, columns in self.MILLI_COLUMNS.items():
+            assignments = ", ".join(
+                f"{column} = CAST(ROUND({column} * {MILLI_POINTS}) AS INTEGER)" for column in columns
+            )
+            self.conn.execute(f"UPDATE {table} SET {assignments}")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(archive_segments)")]
+        if "amount_scale" not in columns:
+            self.conn.execute(
+                "ALTER TABLE archive_segments ADD COLUMN amount_scale INTEGER NOT NULL DEFAULT 1"
+            )
+            self.conn.execute(f"UPDATE archive_segments SET amount_scale = {MILLI_POINTS}")
+        self.conn.commit()
+    
+    def add_delivery_state(self):
+        """أعمدة حالة الوصول في users للقواعد الأقدم"""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(users)")]
+        for column, definition in (("delivery_state", "TEXT DEFAULT 'ok'"),
+                                   ("delivery_error", "TEXT"),
+                                   ("undeliverable_since", "TIMESTAMP")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
+        self.conn.commit()
+    
+    # ===== التنفيذ غير المتزامن =====
+    def _call_locked(self, func, *args, **kwargs):
+        """تنفيذ دالة مع قفل الاتصال المشترك"""
+        with self.lock:
+            return func(*args, **kwargs)
+    
+    async def run(self, func, *args, **kwargs):
+        """تنفيذ دالة متزامنة على خيط قاعدة البيانات وانتظار نتيجتها"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(self._call_locked, func, *args, **kwargs)
+        )
+    
+    def apply_batch(self, operations: List[Tuple]) -> List[Tuple[bool, Any]]:
+        """تنفيذ دفعة عمليات كتابة في معاملة واحدة بـ commit واحد
+        
+        كل عملية تنفذ داخل SAVEPOINT خاص بها حتى لا يلغي فشل عملية
+        واحدة باقي الدفعة. النتيجة قائمة (نجاح، قيمة أو خطأ) بنفس الترتيب.
+        """
+        results = []
+        try:
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+            
+            for func, args, kwargs in operations:
+                self.conn.execute("SAVEPOINT ledger_op")
+                try:
+                    value = func(*args, **kwargs)
+                    self.conn.execute("RELEASE ledger_op")
+                    results.append((True, value))
+                except Exception as e:
+                    # أي خطأ (وليس sqlite فقط) يلغي العملية وحدها ولا يترك المعاملة مفتوحة
+                    self.conn.execute("ROLLBACK TO ledger_op")
+                    self.conn.execute("RELEASE ledger_op")
+                    results.append((False, e))
+            
+            self.conn.commit()
+            return results
+        except Exception as e:
+            logger.error(f"خطأ في تنفيذ دفعة الكتابة: {e}")
+            try:
+                self.conn.rollback()
+            except sqlite3.Error:
+                pass
+            # قد تحتوي الذاكرة على أرصدة لم تُحفظ
+            self.user_cache.clear()
+            self.rebuild_leaderboard()
+            return [(False, e)] * len(operations)
+    
     # ===== عمليات المستخدمين =====
     def get_user(self, user_id: int) -> Optional[Dict]:
         """الحصول على بيانات مستخدم"""
+        cached = self.user_cache.get(user_id)
+        if cached is not None:
+            return cached
+        
         try:
             self.cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
             row = self.cursor.fetchone()
-            return dict(row) if row else None
+            if not row:
+                return None
+            user = dict(row)
+            # الرابط يحفظ مع الصف في الذاكرة (كود الإحالة لا يتغير بعد الإنشاء)
+            user["referral_link"] = bot_identity.referral_link(user["referral_code"])
+            self.user_cache.put(user_id, user)
+            return dict(user)
         except sqlite3.Error as e:
             logger.error(f"خطأ في جلب بيانات المستخدم {user_id}: {e}")
             return None
     
-    def create_user(self, user_id: int, username: str, first_name: str, 
-                   last_name: str = "", referred_by: int = None) -> Dict:
-        """إنشاء مستخدم جديد"""
+    def get_user_id_by_referral_code(self, referral_code: str) -> Optional[int]:
+        """الحصول على معرف المستخدم من كود الإحالة
+        
+        الأكواد الحالية تفك مباشرة إلى user_id (تحقق الوجود من الذاكرة أو
+        المفتاح الأساسي)؛ الأكواد العشوائية القديمة فقط تمر بفهرس referral_code.
+        """
+        user_id = self.referral_codec.decode(referral_code)
+        if user_id is not None and self.get_user(user_id):
+            return user_id
+        try:
+            self.cursor.execute(
+                "SELECT user_id FROM users WHERE referral_code = ?",
+                (referral_code,)
+            )
+            row = self.cursor.fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في البحث عن كود الإحالة {referral_code}: {e}")
+            return None
+    
+    def create_user(self, user_id: int, username: str, first_name: str, 
+                   last_name: str = "", referred_by: int = None,
+                   credit_referrer: bool = True) -> Dict:
+        """إنشاء مستخدم جديد
+        
+        credit_referrer=False يسجل المحيل دون مكافأته هنا (المحيل في جزء آخر).
+        """
+        welcome = to_milli(Config.POINTS["welcome"])
         try:
-            referral_code = self.generate_referral_code()
+            referral_code = self.generate_referral_code(user_id)
             
             self.cursor.execute(
                 """INSERT INTO users 
                 (user_id, username, first_name, last_name, referral_code, referred_by, points) 
                 VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                (user_id, username, first_name, last_name, referral_code, referred_by, 
-                 Config.POINTS["welcome"])
+                (user_id, username, first_name, last_name, referral_code, referred_by, welcome)
             )
             
             # تسجيل معاملة نقطة الترحيب
             self.add_transaction(
                 user_id, 
-                Config.POINTS["welcome"], 
+                welcome, 
                 "welcome", 
-                "نقاط ترحيبية"
+                "نقاط ترحيبية",
+                commit=False
             )
             
             # تحديث عداد الإحالات إذا كان هناك محيل
-            if referred_by:
-                self.cursor.execute(
-                    "UPDATE users SET referral_count = referral_count + 1 WHERE user_id = ?",
-                    (referred_by,)
-                )
-                # منح نقاط الإحالة للمحيل
-                self.add_points(referred_by, Config.POINTS["referral"], "referral")
+            if referred_by and credit_referrer:
+                self._credit_referral(referred_by)
             
+            # commit واحد لكامل عملية التسجيل
             self.conn.commit()
-            return self.get_user(user_id)
+            self.daily_stats.record_new_user(welcome)
+            self.user_cache.invalidate(user_id)
+            user = self.get_user(user_id)
+            if user:
+                self.leaderboard.update(user_id, user['points'])
+            return user
         except sqlite3.Error as e:
             logger.error(f"خطأ في إنشاء مستخدم {user_id}: {e}")
+            self.conn.rollback()
+            if referred_by and credit_referrer:
+                self._refresh_user(referred_by)
             return {}
     
+    def _credit_referral(self, referrer_id: int):
+        """زيادة عداد الإحالات ومنح نقاط الإحالة دون commit (يرفع sqlite3.Error)"""
+        self.cursor.execute(
+            "UPDATE users SET referral_count = referral_count + 1 WHERE user_id = ?",
+            (referrer_id,)
+        )
+        self.user_cache.invalidate(referrer_id)
+        self._apply_points(referrer_id, to_milli(Config.POINTS["referral"]), "referral")
+    
+    def credit_referral(self, referrer_id: int) -> bool:
+        """مكافأة محيل في معاملة مستقلة"""
+        try:
+            self._credit_referral(referrer_id)
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في مكافأة المحيل {referrer_id}: {e}")
+            self.conn.rollback()
+            self._refresh_user(referrer_id)
+            return False
+    
     def update_user(self, user_id: int, **kwargs) -> bool:
         """تحديث بيانات مستخدم"""
         try:
@@ -516,47 +1905,192 @@ class Database:
                 f"UPDATE users SET {set_clause} WHERE user_id = ?",
                 values
             )
+            updated = self.cursor.rowcount > 0
             self.conn.commit()
-            return self.cursor.rowcount > 0
+            if updated:
+                self.user_cache.update(user_id, **kwargs)
+                if 'is_banned' in kwargs or 'points' in kwargs:
+                    self._refresh_user(user_id)
+            return updated
         except sqlite3.Error as e:
             logger.error(f"خطأ في تحديث المستخدم {user_id}: {e}")
+            self._refresh_user(user_id)
             return False
     
-    def add_points(self, user_id: int, amount: float, 
+    def get_users_page(self, after_user_id: int = 0, limit: int = None,
+                       exclude_banned: bool = False, language: str = None,
+                       active_since: str = None, reachable: bool = False,
+                       columns: Tuple[str, ...] = None) -> List[Dict]:
+        """صفحة مستخدمين بعد after_user_id بترتيب user_id (يرفع sqlite3.Error)
+        
+        ترقيم بالمفتاح: كل صفحة بحث في فهرس user_id يبدأ من آخر مفتاح، فتكلفتها ثابتة مهما
+        بعدت الصفحة، بخلاف OFFSET الذي يمر على كل ما قبلها.
+        """
+        conditions = ["user_id > ?"]
+        params: List[Any] = [after_user_id]
+        if exclude_banned:
+            conditions.append("is_banned = 0")
+        if reachable:
+            conditions.append("delivery_state = 'ok'")
+        if language:
+            conditions.append("language_code = ?")
+            params.append(language)
+        if active_since:
+            conditions.append("last_active >= ?")
+            params.append(active_since)
+        params.append(limit or Config.DATABASE["page_size"])
+        
+        # خطأ في منتصف المرور يجب أن يظهر للمستدعي بدل قائمة ناقصة بصمت
+        self.cursor.execute(
+            f"""SELECT {", ".join(columns) if columns else "*"} FROM users 
+            WHERE {" AND ".join(conditions)} 
+            ORDER BY user_id LIMIT ?""",
+            params
+        )
+        return [dict(row) for row in self.cursor.fetchall()]
+    
+    def iter_users(self, page_size: int = None, after_user_id: int = 0, **filters):
+        """المرور على المستخدمين بعد after_user_id صفحة بعد صفحة بذاكرة ثابتة (مرشحات get_users_page)"""
+        after = after_user_id
+        while True:
+            page = self.get_users_page(after, page_size, **filters)
+            yield from page
+            if len(page) < (page_size or Config.DATABASE["page_size"]):
+                return
+            after = page[-1]["user_id"]
+    
+    def mark_undeliverable(self, entries: List[Tuple[int, str, str]]) -> int:
+        """تسجيل محادثات لا تصلها الرسائل: (user_id, state, error)"""
+        try:
+            self.cursor.executemany(
+                """UPDATE users SET delivery_state = ?, delivery_error = ?, 
+                undeliverable_since = COALESCE(undeliverable_since, CURRENT_TIMESTAMP) 
+                WHERE user_id = ?""",
+                [(state, error[:200], user_id) for user_id, state, error in entries]
+            )
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في تسجيل حالة الوصول: {e}")
+            self.conn.rollback()
+            return 0
+        for user_id, _, _ in entries:
+            self.user_cache.invalidate(user_id)
+        return len(entries)
+    
+    def mark_reachable(self, user_id: int) -> bool:
+        """المستخدم تفاعل مع البوت مجدداً (ألغى الحظر): يعود لجمهور الإعلانات"""
+        return self.update_user(user_id, delivery_state='ok', delivery_error=None, undeliverable_since=None)
+    
+    def count_audience(self) -> Dict:
+        """حجم الجمهور: كل المستخدمين، من تصلهم الرسائل، المحظورون، ومن لا تصلهم"""
+        self.cursor.execute(
+            """SELECT COUNT(*), 
+                COALESCE(SUM(is_banned = 0 AND delivery_state = 'ok'), 0), 
+                COALESCE(SUM(is_banned != 0), 0), 
+                COALESCE(SUM(delivery_state != 'ok'), 0) 
+            FROM users"""
+        )
+        total, reachable, banned, unreachable = self.cursor.fetchone()
+        return {"total": total, "reachable": reachable, "banned": banned, "unreachable": unreachable}
+    
+    def _refresh_user(self, user_id: int):
+        """إعادة قراءة المستخدم من القاعدة وتحديث الذاكرة ولوحة المتصدرين"""
+        self.user_cache.invalidate(user_id)
+        user = self.get_user(user_id)
+        if user and not user['is_banned']:
+            self.leaderboard.update(user_id, user['points'])
+        else:
+            self.leaderboard.remove(user_id)
+    
+    def _apply_points(self, user_id: int, amount: int, 
+                      trans_type: str, description: str = "", 
+                      reference_id: str = None) -> bool:
+        """تعديل الرصيد وتسجيل المعاملة دون commit (يرفع sqlite3.Error)"""
+        # تحديث نقاط المستخدم
+        self.cursor.execute(
+            """UPDATE users 
+            SET points = points + ?, total_earned = total_earned + ? 
+            WHERE user_id = ? 
+            RETURNING points, total_earned""",
+            (amount, max(amount, 0), user_id)
+        )
+        row = self.cursor.fetchone()
+        
+        # تسجيل المعاملة
+        self.cursor.execute(
+            """INSERT INTO transactions 
+            (user_id, amount, type, description, reference_id) 
+            VALUES (?, ?, ?, ?, ?)""",
+            (user_id, amount, trans_type, description, reference_id)
+        )
+        self._bump_daily_totals(user_id, points=amount, transactions=1)
+        self.daily_stats.record_activity(user_id, amount if row else 0)
+        
+        if row:
+            self.user_cache.update(user_id, points=row[0], total_earned=row[1])
+            self._update_leaderboard(user_id, row[0])
+        return True
+    
+    def add_points(self, user_id: int, amount: int, 
                    trans_type: str, description: str = "", 
                    reference_id: str = None) -> bool:
         """إضافة نقاط للمستخدم وتسجيل المعاملة"""
         try:
-            # تحديث نقاط المستخدم
-            self.cursor.execute(
-                """UPDATE users 
-                SET points = points + ?, total_earned = total_earned + ? 
-                WHERE user_id = ?""",
-                (amount, max(amount, 0), user_id)
-            )
-            
-            # تسجيل المعاملة
-            self.add_transaction(user_id, amount, trans_type, description, reference_id)
-            
+            self._apply_points(user_id, amount, trans_type, description, reference_id)
             self.conn.commit()
             return True
         except sqlite3.Error as e:
             logger.error(f"خطأ في إضافة نقاط للمستخدم {user_id}: {e}")
+            self.conn.rollback()
+            self._refresh_user(user_id)
             return False
     
-    def deduct_points(self, user_id: int, amount: float, 
-                     trans_type: str, description: str = "") -> bool:
-        """خصم نقاط من المستخدم"""
+    def _apply_debit(self, user_id: int, amount: int, 
+                     trans_type: str, description: str = "", 
+                     reference_id: str = None) -> Optional[int]:
+        """خصم مشروط دون commit: يرجع الرصيد الجديد أو None عند عدم كفاية الرصيد"""
+        # التحقق من الرصيد والخصم في جملة واحدة (لا سباق بين عمليتين متزامنتين)
+        self.cursor.execute(
+            """UPDATE users 
+            SET points = points - ? 
+            WHERE user_id = ? AND points >= ? 
+            RETURNING points""",
+            (amount, user_id, amount)
+        )
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        
+        self.cursor.execute(
+            """INSERT INTO transactions 
+            (user_id, amount, type, description, reference_id) 
+            VALUES (?, ?, ?, ?, ?)""",
+            (user_id, -amount, trans_type, description, reference_id)
+        )
+        self._bump_daily_totals(user_id, points=-amount, transactions=1)
+        self.daily_stats.record_activity(user_id, -amount)
+        self.user_cache.update(user_id, points=row[0])
+        self._update_leaderboard(user_id, row[0])
+        return row[0]
+    
+    def debit_points(self, user_id: int, amount: int, 
+                     trans_type: str, description: str = "", 
+                     reference_id: str = None) -> Optional[int]:
+        """خصم نقاط في معاملة واحدة وإرجاع الرصيد الجديد"""
         try:
-            # التحقق من رصيد المستخدم
-            user = self.get_user(user_id)
-            if not user or user['points'] < amount:
-                return False
-            
-            return self.add_points(user_id, -amount, trans_type, description)
+            balance = self._apply_debit(user_id, amount, trans_type, description, reference_id)
+            self.conn.commit()
+            return balance
         except sqlite3.Error as e:
             logger.error(f"خطأ في خصم نقاط من المستخدم {user_id}: {e}")
-            return False
+            self.conn.rollback()
+            self._refresh_user(user_id)
+            return None
+    
+    def deduct_points(self, user_id: int, amount: int, 
+                     trans_type: str, description: str = "") -> bool:
+        """خصم نقاط من المستخدم"""
+        return self.debit_points(user_id, amount, trans_type, description) is not None
     
     def get_user_stats(self, user_id: int) -> Dict:
         """الحصول على إحصائيات مستخدم"""
@@ -574,53 +2108,23 @@ class Database:
             return stats
         
         try:
-            # نقاط اليوم
-            self.cursor.execute(
-                """SELECT COALESCE(SUM(amount), 0) 
-                FROM transactions 
-                WHERE user_id = ? AND DATE(created_at) = DATE('now')""",
-                (user_id,)
-            )
-            stats["today_points"] = self.cursor.fetchone()[0]
-            
-            # نقاط الأسبوع
-            self.cursor.execute(
-                """SELECT COALESCE(SUM(amount), 0) 
-                FROM transactions 
-                WHERE user_id = ? AND created_at >= DATE('now', '-7 days')""",
-                (user_id,)
-            )
-            stats["week_points"] = self.cursor.fetchone()[0]
-            
-            # عدد المعاملات
-            self.cursor.execute(
-                "SELECT COUNT(*) FROM transactions WHERE user_id = ?",
-                (user_id,)
-            )
-            stats["total_transactions"] = self.cursor.fetchone()[0]
-            
-            # عدد الإعلانات
-            self.cursor.execute(
-                "SELECT COUNT(*) FROM ad_views WHERE user_id = ?",
-                (user_id,)
-            )
-            stats["total_ads"] = self.cursor.fetchone()[0]
-            
-            # عدد الألعاب
+            # نقاط اليوم والأسبوع والعدادات من المجاميع اليومية (بحث واحد بالفهرس)
             self.cursor.execute(
-                "SELECT COUNT(*) FROM games WHERE user_id = ?",
+                """SELECT 
+                    COALESCE(SUM(CASE WHEN day = DATE('now') THEN points END), 0), 
+                    COALESCE(SUM(CASE WHEN day >= DATE('now', '-7 days') THEN points END), 0), 
+                    COALESCE(SUM(transactions), 0), 
+                    COALESCE(SUM(ads), 0), 
+                    COALESCE(SUM(games), 0) 
+                FROM user_daily_totals 
+                WHERE user_id = ?""",
                 (user_id,)
             )
-            stats["total_games"] = self.cursor.fetchone()[0]
+            (stats["today_points"], stats["week_points"], stats["total_transactions"],
+             stats["total_ads"], stats["total_games"]) = self.cursor.fetchone()
             
-            # الترتيب
-            self.cursor.execute(
-                """SELECT COUNT(*) + 1 
-                FROM users 
-                WHERE points > (SELECT points FROM users WHERE user_id = ?)""",
-                (user_id,)
-            )
-            stats["rank"] = self.cursor.fetchone()[0]
+            # الترتيب من لوحة المتصدرين في الذاكرة
+            stats["rank"] = self.leaderboard.rank_for_points(stats["user"]["points"])
             
         except sqlite3.Error as e:
             logger.error(f"خطأ في جلب إحصائيات المستخدم {user_id}: {e}")
@@ -628,9 +2132,9 @@ class Database:
         return stats
     
     # ===== المعاملات =====
-    def add_transaction(self, user_id: int, amount: float, 
+    def add_transaction(self, user_id: int, amount: int, 
                        trans_type: str, description: str = "", 
-                       reference_id: str = None) -> bool:
+                       reference_id: str = None, commit: bool = True) -> bool:
         """تسجيل معاملة جديدة"""
         try:
             self.cursor.execute(
@@ -639,238 +2143,1498 @@ class Database:
                 VALUES (?, ?, ?, ?, ?)""",
                 (user_id, amount, trans_type, description, reference_id)
             )
-            self.conn.commit()
+            self._bump_daily_totals(user_id, points=amount, transactions=1)
+            self.daily_stats.record_activity(user_id)
+            if commit:
+                self.conn.commit()
             return True
         except sqlite3.Error as e:
             logger.error(f"خطأ في تسجيل معاملة للمستخدم {user_id}: {e}")
             return False
     
-    def get_transactions(self, user_id: int, limit: int = 10) -> List[Dict]:
-        """الحصول على معاملات المستخدم"""
+    # ===== المجاميع اليومية =====
+    DAILY_TOTALS_UPSERT = """INSERT INTO user_daily_totals 
+            (user_id, day, points, transactions, ads, games) 
+            VALUES (?, COALESCE(?, DATE('now')), ?, ?, ?, ?) 
+            ON CONFLICT(user_id, day) DO UPDATE SET 
+                points = points + excluded.points, 
+                transactions = transactions + excluded.transactions, 
+                ads = ads + excluded.ads, 
+                games = games + excluded.games"""
+    
+    def _bump_daily_totals(self, user_id: int, points: int = 0, 
+                           transactions: int = 0, ads: int = 0, games: int = 0,
+                           day: str = None):
+        """زيادة مجاميع اليوم للمستخدم دون commit (يرفع sqlite3.Error)"""
+        self.cursor.execute(
+            self.DAILY_TOTALS_UPSERT,
+            (user_id, day, points, transactions, ads, games)
+        )
+    
+    def backfill_daily_totals(self) -> int:
+        """إعادة بناء user_daily_totals من الجداول الخام
+        
+        الأيام التي ضُغطت سجلاتها الخام (قبل compacted_before) تبقى كما هي.
+        """
+        try:
+            since = self.get_setting("compacted_before", "0000-00-00")
+            self.cursor.execute("DELETE FROM user_daily_totals WHERE day >= ?", (since,))
+            self.cursor.execute(
+                """INSERT INTO user_daily_totals 
+                (user_id, day, points, transactions, ads, games) 
+                SELECT user_id, day, SUM(points), SUM(transactions), SUM(ads), SUM(games) 
+                FROM (
+                    SELECT user_id, DATE(created_at) AS day, SUM(amount) AS points, 
+                           COUNT(*) AS transactions, 0 AS ads, 0 AS games 
+                    FROM transactions GROUP BY user_id, DATE(created_at) 
+                    UNION ALL 
+                    SELECT user_id, DATE(viewed_at), 0, 0, COUNT(*), 0 
+                    FROM ad_views GROUP BY user_id, DATE(viewed_at) 
+                    UNION ALL 
+                    SELECT user_id, DATE(created_at), 0, 0, 0, COUNT(*) 
+                    FROM games GROUP BY user_id, DATE(created_at)
+                ) 
+                WHERE day >= ? 
+                GROUP BY user_id, day""",
+                (since,)
+            )
+            rows = self.cursor.rowcount
+            self.conn.commit()
+            logger.info(f"تم بناء المجاميع اليومية: {rows} صف")
+            return rows
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في بناء المجاميع اليومية: {e}")
+            self.conn.rollback()
+            return -1
+    
+    def get_transactions(self, user_id: int, limit: int = 10, offset: int = 0) -> List[Dict]:
+        """الحصول على معاملات المستخدم (من الأحدث)
+        
+        عند تجاوز المعاملات الحية تكمل القراءة من ملفات الأرشيف الشهرية.
+        """
         try:
             self.cursor.execute(
                 """SELECT * FROM transactions 
                 WHERE user_id = ? 
-                ORDER BY created_at DESC 
-                LIMIT ?""",
-                (user_id, limit)
+                ORDER BY created_at DESC, id DESC 
+                LIMIT ? OFFSET ?""",
+                (user_id, limit, offset)
             )
-            return [dict(row) for row in self.cursor.fetchall()]
-        except sqlite3.Error as e:
+            result = [dict(row) for row in self.cursor.fetchall()]
+            if len(result) == limit:
+                return result
+            
+            self.cursor.execute("SELECT COUNT(*) FROM transactions WHERE user_id = ?", (user_id,))
+            skip = max(0, offset - self.cursor.fetchone()[0])
+            for segment in self.get_archive_segments():
+                # عدد صفوف المستخدم من الفهرس يكفي لتخطي الملف دون فكه
+                count = self.archive.user_count(segment["path"], user_id)
+                if skip >= count:
+                    skip -= count
+                    continue
+                rows = self.archive.read_user(segment["path"], user_id)
+                if segment["amount_scale"] != 1:
+                    for row in rows:
+                        row["amount"] = int(round(row["amount"] * segment["amount_scale"]))
+                result.extend(rows[skip:skip + limit - len(result)])
+                skip = 0
+                if len(result) >= limit:
+                    break
+            return result
+        except (sqlite3.Error, OSError, ValueError) as e:
             logger.error(f"خطأ في جلب معاملات المستخدم {user_id}: {e}")
             return []
     
+    def count_transactions(self, user_id: int) -> int:
+        """عدد معاملات المستخدم الحية والمؤرشفة"""
+        self.cursor.execute("SELECT COUNT(*) FROM transactions WHERE user_id = ?", (user_id,))
+        total = self.cursor.fetchone()[0]
+        for segment in self.get_archive_segments():
+            total += self.archive.user_count(segment["path"], user_id)
+        return total
+    
+    # ===== أرشيف المعاملات =====
+    def get_archive_segments(self) -> List[Dict]:
+        """ملفات الأرشيف المسجلة من الأحدث للأقدم"""
+        self.cursor.execute("SELECT * FROM archive_segments ORDER BY month DESC")
+        return [dict(row) for row in self.cursor.fetchall()]
+    
+    def oldest_transaction_time(self) -> Optional[str]:
+        self.cursor.execute("SELECT MIN(created_at) FROM transactions")
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+    
+    def fetch_transactions_range(self, after: Tuple[str, int], end: str, limit: int) -> Tuple[List[str], List[tuple]]:
+        """دفعة من المعاملات بعد المفتاح (created_at, id) وقبل end، بترتيب الفهرس"""
+        self.cursor.execute(
+            """SELECT * FROM transactions 
+            WHERE (created_at, id) > (?, ?) AND created_at < ? 
+            ORDER BY created_at, id LIMIT ?""",
+            (*after, end, limit)
+        )
+        rows = self.cursor.fetchall()
+        columns = [col[0] for col in self.cursor.description]
+        return columns, [tuple(row) for row in rows]
+    
+    def register_archive_segment(self, month: str, segment: Dict):
+        self.cursor.execute(
+            """INSERT OR REPLACE INTO archive_segments (month, path, rows, users, sha256) 
+            VALUES (?, ?, ?, ?, ?)""",
+            (month, segment["path"], segment["rows"], segment["users"], segment["sha256"])
+        )
+        self.conn.commit()
+    
     # ===== الإعلانات =====
-    def get_available_ad(self, user_id: int) -> Optional[Dict]:
-        """الحصول على إعلان متاح للمستخدم"""
+    def reload_ads(self) -> bool:
+        """إعادة تحميل الإعلانات النشطة والمشاهدات الأخيرة إلى الذاكرة"""
         try:
-            # تجنب تكرار الإعلانات
             self.cursor.execute(
-                """SELECT a.* FROM ads a
-                LEFT JOIN ad_views av ON a.id = av.ad_id AND av.user_id = ?
-                WHERE a.is_active = 1 
-                AND (av.id IS NULL OR av.viewed_at < DATETIME('now', '-5 minutes'))
-                ORDER BY RANDOM()
-                LIMIT 1""",
-                (user_id,)
+                """SELECT * FROM ads 
+                WHERE is_active = 1 
+                AND (end_date IS NULL OR end_date > CURRENT_TIMESTAMP)"""
             )
+            self.ad_inventory.load([dict(row) for row in self.cursor.fetchall()])
+            self.restore_ad_cooldowns()
+            
+            logger.info(f"تم تحميل {len(self.ad_inventory)} إعلان نشط")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في تحميل الإعلانات: {e}")
+            return False
+    
+    def restore_ad_cooldowns(self):
+        """استعادة فترات الانتظار الجارية من ad_views بعد إعادة التشغيل"""
+        self.cursor.execute(
+            """SELECT user_id, ad_id, CAST(strftime('%s', MAX(viewed_at)) AS INTEGER) 
+            FROM ad_views 
+            WHERE viewed_at >= DATETIME('now', ?) 
+            GROUP BY user_id, ad_id""",
+            (f"-{self.ad_inventory.cooldown} seconds",)
+        )
+        for user_id, ad_id, seen_at in self.cursor.fetchall():
+            self.ad_inventory.mark_seen(user_id, ad_id, seen_at)
+    
+    def get_available_ad(self, user_id: int) -> Optional[Dict]:
+        """الحصول على إعلان متاح للمستخدم"""
+        return self.ad_inventory.pick(user_id)
+    
+    def get_ad(self, ad_id: int) -> Optional[Dict]:
+        """الحصول على إعلان بالمعرف"""
+        ad = self.ad_inventory.get(ad_id)
+        if ad:
+            return ad
+        
+        try:
+            self.cursor.execute("SELECT * FROM ads WHERE id = ?", (ad_id,))
             row = self.cursor.fetchone()
             return dict(row) if row else None
         except sqlite3.Error as e:
-            logger.error(f"خطأ في جلب إعلان للمستخدم {user_id}: {e}")
+            logger.error(f"خطأ في جلب الإعلان {ad_id}: {e}")
             return None
     
-    def record_ad_view(self, user_id: int, ad_id: int, clicked: bool = False) -> bool:
-        """تسجيل مشاهدة إعلان"""
+    def create_ad(self, title: str, content: str, ad_type: str = "text",
+                  created_by: int = None) -> Optional[int]:
+        """إضافة إعلان جديد"""
         try:
             self.cursor.execute(
-                """INSERT INTO ad_views (user_id, ad_id, clicked) 
-                VALUES (?, ?, ?)""",
-                (user_id, ad_id, clicked)
-            )
-            
-            # تحديث إحصائيات الإعلان
-            self.cursor.execute(
-                "UPDATE ads SET views = views + 1 WHERE id = ?",
-                (ad_id,)
+                """INSERT INTO ads 
+                (title, content, ad_type, created_by) 
+                VALUES (?, ?, ?, ?)""",
+                (title, content, ad_type, created_by)
             )
-            
-            if clicked:
-                self.cursor.execute(
-                    "UPDATE ads SET clicks = clicks + 1 WHERE id = ?",
-                    (ad_id,)
-                )
-            
+            ad_id = self.cursor.lastrowid
             self.conn.commit()
-            return True
+            self.reload_ads()
+            return ad_id
         except sqlite3.Error as e:
+            logger.error(f"خطأ في إضافة إعلان: {e}")
+            return None
+    
+    def record_ad_view(self, user_id: int, ad_id: int, clicked: bool = False) -> bool:
+        """تسجيل مشاهدة إعلان (تُحفظ مع الدفعة التالية)"""
+        try:
+            self.ad_view_buffer.record(user_id, ad_id, clicked)
+        except OSError as e:
             logger.error(f"خطأ في تسجيل مشاهدة إعلان: {e}")
             return False
+        
+        self.daily_stats.record_ad_view()
+        self.ad_inventory.mark_seen(user_id, ad_id)
+        return True
     
-    # ===== الإحصائيات =====
-    def update_daily_stats(self):
-        """تحديث الإحصائيات اليومية"""
+    def flush_ad_views(self) -> int:
+        """حفظ المشاهدات المجمعة وعدادات الإعلانات في معاملة واحدة"""
+        rows, views, clicks = self.ad_view_buffer.drain()
+        if not rows:
+            self.ad_view_buffer.truncate_journal()
+            return 0
+        
+        per_user_day: Dict[Tuple[int, str], int] = {}
+        for _, user_id, _, _, viewed_at in rows:
+            key = (user_id, viewed_at[:10])
+            per_user_day[key] = per_user_day.get(key, 0) + 1
+        
         try:
-            today = datetime.now().strftime('%Y-%m-%d')
-            
-            # عدد المستخدمين الجدد
-            self.cursor.execute(
-                """SELECT COUNT(*) FROM users 
-                WHERE DATE(join_date) = ?""",
-                (today,)
+            self.cursor.executemany(
+                """INSERT INTO ad_views (user_id, ad_id, clicked, viewed_at) 
+                VALUES (?, ?, ?, ?)""",
+                [(user_id, ad_id, clicked, viewed_at) for _, user_id, ad_id, clicked, viewed_at in rows]
             )
-            new_users = self.cursor.fetchone()[0]
-            
-            # المستخدمين النشطين اليوم
+            if self.ad_counters_db is self:
+                self.bump_ad_counters(views, clicks)
+            self.cursor.executemany(
+                self.DAILY_TOTALS_UPSERT,
+                [(user_id, day, 0, 0, count, 0) for (user_id, day), count in per_user_day.items()]
+            )
+            # آخر رقم تسلسلي محفوظ، في نفس المعاملة
             self.cursor.execute(
-                """SELECT COUNT(DISTINCT user_id) 
-                FROM transactions 
-                WHERE DATE(created_at) = ?""",
-                (today,)
+                "INSERT OR REPLACE INTO settings (key, value, description) VALUES (?, ?, ?)",
+                ("ad_views_flushed_seq", str(rows[-1][0]), "آخر مشاهدة إعلان محفوظة من السجل")
             )
-            active_users = self.cursor.fetchone()[0]
-            
-            # إجمالي المستخدمين
-            self.cursor.execute("SELECT COUNT(*) FROM users")
-            total_users = self.cursor.fetchone()[0]
-            
-            # إجمالي النقاط
-            self.cursor.execute("SELECT SUM(points) FROM users")
-            total_points = self.cursor.fetchone()[0] or 0
-            
-            # الإعلانات المشاهدة اليوم
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في حفظ مشاهدات الإعلانات: {e}")
+            self.conn.rollback()
+            self.ad_view_buffer.restore(rows)
+            return 0
+        
+        self.ad_view_buffer.truncate_journal()
+        if self.ad_counters_db is not self:
+            # جدول ads في الجزء 0: معاملة منفصلة (قد يفقد العداد دفعة عند توقف مفاجئ بينهما)
+            home = self.ad_counters_db
+            try:
+                home._call_locked(home.apply_ad_counters, views, clicks)
+            except sqlite3.Error as e:
+                logger.error(f"خطأ في تحديث عدادات الإعلانات: {e}")
+        return len(rows)
+    
+    def bump_ad_counters(self, views: Dict[int, int], clicks: Dict[int, int]):
+        """إضافة المشاهدات والنقرات لعدادات جدول ads (دون commit)"""
+        self.cursor.executemany(
+            "UPDATE ads SET views = views + ?, clicks = clicks + ? WHERE id = ?",
+            [(count, clicks.get(ad_id, 0), ad_id) for ad_id, count in views.items()]
+        )
+    
+    def apply_ad_counters(self, views: Dict[int, int], clicks: Dict[int, int]):
+        """تحديث عدادات الإعلانات في معاملة مستقلة (مشاهدات أجزاء أخرى)"""
+        try:
+            self.bump_ad_counters(views, clicks)
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+    
+    def recover_ad_views(self) -> int:
+        """استعادة المشاهدات غير المحفوظة من السجل بعد توقف مفاجئ"""
+        recovered = self.ad_view_buffer.open(int(self.get_setting("ad_views_flushed_seq", "0")))
+        if recovered:
+            logger.warning(f"استعادة {len(recovered)} مشاهدة إعلان من السجل")
+        return self.flush_ad_views()
+    
+    # ===== الإعلان الجماعي =====
+    def create_broadcast_job(self, text: str, parse_mode: str, created_by: int,
+                             chat_id: int, message_id: int) -> Optional[int]:
+        """إنشاء مهمة إعلان جماعي جديدة"""
+        try:
             self.cursor.execute(
-                """SELECT COUNT(*) FROM ad_views 
-                WHERE DATE(viewed_at) = ?""",
-                (today,)
+                """INSERT INTO broadcast_jobs (text, parse_mode, created_by, chat_id, message_id) 
+                VALUES (?, ?, ?, ?, ?)""",
+                (text, parse_mode, created_by, chat_id, message_id)
             )
-            ads_viewed = self.cursor.fetchone()[0]
-            
-            # الألعاب اليوم
+            job_id = self.cursor.lastrowid
+            self.conn.commit()
+            return job_id
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في إنشاء مهمة إعلان: {e}")
+            self.conn.rollback()
+            return None
+    
+    def get_broadcast_job(self, job_id: int) -> Optional[Dict]:
+        self.cursor.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,))
+        row = self.cursor.fetchone()
+        return dict(row) if row else None
+    
+    def get_unfinished_broadcasts(self) -> List[Dict]:
+        """المهام التي توقفت قبل اكتمالها (إعادة تشغيل أو توقف مفاجئ)"""
+        self.cursor.execute("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+        return [dict(row) for row in self.cursor.fetchall()]
+    
+    def recover_broadcast_job(self, job_id: int) -> List[int]:
+        """تجهيز مهمة للاستئناف: المستلمون بعد المؤشر الذين حسمت نتيجتهم
+        
+        المحجوزون بلا نتيجة ربما وصلتهم الرسالة قبل التوقف، فيسجلون unknown
+        ولا يعاد الإرسال لهم (لا تكرار).
+        """
+        try:
             self.cursor.execute(
-                """SELECT COUNT(*) FROM games 
-                WHERE DATE(created_at) = ?""",
-                (today,)
+                "UPDATE broadcast_deliveries SET status = 'unknown' WHERE job_id = ? AND status = 'queued'",
+                (job_id,)
             )
-            games_played = self.cursor.fetchone()[0]
-            
-            # الملفات المحولة اليوم
             self.cursor.execute(
-                """SELECT COUNT(*) FROM files 
-                WHERE DATE(created_at) = ?""",
-                (today,)
+                "UPDATE broadcast_jobs SET unknown = unknown + ? WHERE id = ?",
+                (self.cursor.rowcount, job_id)
             )
-            files_converted = self.cursor.fetchone()[0]
-            
-            # إدراج أو تحديث الإحصائيات
             self.cursor.execute(
-                """INSERT OR REPLACE INTO statistics 
-                (date, total_users, new_users, active_users, total_points, 
-                 ads_viewed, games_played, files_converted) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                (today, total_users, new_users, active_users, total_points,
-                 ads_viewed, games_played, files_converted)
+                """SELECT d.user_id FROM broadcast_deliveries d 
+                JOIN broadcast_jobs j ON j.id = d.job_id 
+                WHERE d.job_id = ? AND d.user_id > j.cursor_user_id""",
+                (job_id,)
+            )
+            done = [row[0] for row in self.cursor.fetchall()]
+            self.conn.commit()
+            return done
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في استئناف مهمة الإعلان {job_id}: {e}")
+            self.conn.rollback()
+            raise
+    
+    def claim_broadcast_recipients(self, job_id: int, user_ids: List[int]) -> bool:
+        """حجز دفعة مستلمين قبل إرسالها (queued)"""
+        try:
+            self.cursor.executemany(
+                "INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id, status) VALUES (?, ?, 'queued')",
+                [(job_id, user_id) for user_id in user_ids]
             )
-            
             self.conn.commit()
             return True
         except sqlite3.Error as e:
-            logger.error(f"خطأ في تحديث الإحصائيات: {e}")
+            logger.error(f"خطأ في حجز مستلمي الإعلان {job_id}: {e}")
+            self.conn.rollback()
             return False
     
-    # ===== أدوات مساعدة =====
-    def generate_referral_code(self) -> str:
-        """توليد كود إحالة فريد"""
-        while True:
-            code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    def save_broadcast_progress(self, job_id: int, results: List[Tuple[int, str]], cursor_user_id: int) -> bool:
+        """حفظ نتائج المستلمين والعدادات والمؤشر في معاملة واحدة
+        
+        unsent (أوقف قبل إرساله) يحذف حجزه ليرسل عند الاستئناف.
+        """
+        counts = {"sent": 0, "blocked": 0, "failed": 0}
+        for _, outcome in results:
+            if outcome in counts:
+                counts[outcome] += 1
+        try:
+            self.cursor.executemany(
+                """UPDATE broadcast_deliveries SET status = ?, updated_at = CURRENT_TIMESTAMP 
+                WHERE job_id = ? AND user_id = ?""",
+                [(outcome, job_id, user_id) for user_id, outcome in results if outcome != "unsent"]
+            )
+            self.cursor.executemany(
+                "DELETE FROM broadcast_deliveries WHERE job_id = ? AND user_id = ?",
+                [(job_id, user_id) for user_id, outcome in results if outcome == "unsent"]
+            )
             self.cursor.execute(
-                "SELECT COUNT(*) FROM users WHERE referral_code = ?",
-                (code,)
+                """UPDATE broadcast_jobs 
+                SET sent = sent + ?, blocked = blocked + ?, failed = failed + ?, 
+                    cursor_user_id = ?, updated_at = CURRENT_TIMESTAMP 
+                WHERE id = ?""",
+                (counts["sent"], counts["blocked"], counts["failed"], cursor_user_id, job_id)
             )
-            if self.cursor.fetchone()[0] == 0:
-                return code
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في حفظ تقدم الإعلان {job_id}: {e}")
+            self.conn.rollback()
+            return False
     
-    def get_top_users(self, limit: int = 10) -> List[Dict]:
-        """الحصول على أفضل المستخدمين"""
+    def finish_broadcast_job(self, job_id: int, status: str = "done") -> bool:
         try:
             self.cursor.execute(
-                """SELECT user_id, username, first_name, points, referral_count 
-                FROM users 
-                WHERE is_banned = 0 
-                ORDER BY points DESC 
-                LIMIT ?""",
-                (limit,)
-            )
-            return [dict(row) for row in self.cursor.fetchall()]
+                """UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP, 
+                updated_at = CURRENT_TIMESTAMP WHERE id = ?""",
+                (status, job_id)
+            )
+            self.conn.commit()
+            return True
         except sqlite3.Error as e:
-            logger.error(f"خطأ في جلب أفضل المستخدمين: {e}")
-            return []
+            logger.error(f"خطأ في إنهاء مهمة الإعلان {job_id}: {e}")
+            self.conn.rollback()
+            return False
     
-    def get_system_stats(self) -> Dict:
-        """إحصائيات النظام"""
-        stats = {}
+    # ===== الألعاب =====
+    def record_game(self, user_id: int, game_type: str, score: int,
+                    points_earned: int, duration: int = 0, game_data: str = None) -> bool:
+        """تسجيل جولة لعب"""
         try:
-            # إجمالي المستخدمين
-            self.cursor.execute("SELECT COUNT(*) FROM users")
-            stats["total_users"] = self.cursor.fetchone()[0]
-            
-            # المستخدمين النشطين اليوم
             self.cursor.execute(
-                """SELECT COUNT(DISTINCT user_id) FROM transactions 
-                WHERE DATE(created_at) = DATE('now')"""
+                """INSERT INTO games (user_id, game_type, score, points_earned, duration, game_data) 
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (user_id, game_type, score, points_earned, duration, game_data)
             )
-            stats["active_today"] = self.cursor.fetchone()[0]
-            
-            # إجمالي النقاط
-            self.cursor.execute("SELECT SUM(points) FROM users")
-            stats["total_points"] = self.cursor.fetchone()[0] or 0
-            
-            # إجمالي المعاملات
-            self.cursor.execute("SELECT COUNT(*) FROM transactions")
-            stats["total_transactions"] = self.cursor.fetchone()[0]
-            
-            # الإعلانات المشاهدة
-            self.cursor.execute("SELECT SUM(views) FROM ads")
-            stats["total_ad_views"] = self.cursor.fetchone()[0] or 0
-            
-            # الألعاب
-            self.cursor.execute("SELECT COUNT(*) FROM games")
-            stats["total_games"] = self.cursor.fetchone()[0]
-            
+            self._bump_daily_totals(user_id, games=1)
+            self.conn.commit()
+            self.daily_stats.record_game()
+            return True
         except sqlite3.Error as e:
-            logger.error(f"خطأ في جلب إحصائيات النظام: {e}")
-        
-        return stats
+            logger.error(f"خطأ في تسجيل لعبة للمستخدم {user_id}: {e}")
+            self.conn.rollback()
+            return False
     
-    def backup_database(self) -> bool:
-        """إنشاء نسخة احتياطية من قاعدة البيانات"""
+    def get_last_game(self, user_id: int, game_type: str) -> Optional[Dict]:
+        """آخر جولة للمستخدم في لعبة معينة"""
+        self.cursor.execute(
+            """SELECT * FROM games 
+            WHERE user_id = ? AND game_type = ? 
+            ORDER BY id DESC LIMIT 1""",
+            (user_id, game_type)
+        )
+        row = self.cursor.fetchone()
+        return dict(row) if row else None
+    
+    # ===== الملفات =====
+    def record_file(self, user_id: int, file_name: str, file_type: str,
+                    file_size: int, operation_type: str, points_cost: int) -> bool:
+        """تسجيل ملف معالج"""
         try:
-            backup_file = os.path.join(
-                Config.PATHS["backups"],
-                f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+            self.cursor.execute(
+                """INSERT INTO files 
+                (user_id, file_name, file_type, file_size, operation_type, points_cost) 
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (user_id, file_name, file_type, file_size, operation_type, points_cost)
             )
-            
-            # إنشاء نسخة من قاعدة البيانات
-            backup_conn = sqlite3.connect(backup_file)
-            with backup_conn:
-                self.conn.backup(backup_conn)
-            backup_conn.close()
-            
-            logger.info(f"تم إنشاء نسخة احتياطية: {backup_file}")
+            self.conn.commit()
+            self.daily_stats.record_file()
             return True
         except sqlite3.Error as e:
-            logger.error(f"خطأ في إنشاء نسخة احتياطية: {e}")
+            logger.error(f"خطأ في تسجيل ملف للمستخدم {user_id}: {e}")
             return False
     
-    def close(self):
-        """إغلاق الاتصال بقاعدة البيانات"""
+    # ===== ضغط السجلات القديمة =====
+    COMPACTION = {
+        "ad_views": (
+            "viewed_at",
+            """INSERT INTO ad_views_daily (ad_id, day, views, clicks) 
+            SELECT ad_id, DATE(viewed_at), COUNT(*), SUM(clicked) 
+            FROM ad_views WHERE id IN (SELECT id FROM temp.compact_ids) 
+            GROUP BY ad_id, DATE(viewed_at) 
+            ON CONFLICT(ad_id, day) DO UPDATE SET 
+                views = views + excluded.views, 
+                clicks = clicks + excluded.clicks"""
+        ),
+        "transactions": (
+            "created_at",
+            """INSERT INTO transactions_daily (user_id, day, type, count, amount) 
+            SELECT user_id, DATE(created_at), type, COUNT(*), SUM(amount) 
+            FROM transactions WHERE id IN (SELECT id FROM temp.compact_ids) 
+            GROUP BY user_id, DATE(created_at), type 
+            ON CONFLICT(user_id, day, type) DO UPDATE SET 
+                count = count + excluded.count, 
+                amount = amount + excluded.amount"""
+        )
+    }
+    
+    def compact_chunk(self, table: str, cutoff: str, chunk_size: int) -> int:
+        """تجميع وحذف دفعة من أقدم الصفوف قبل cutoff في معاملة قصيرة واحدة"""
+        time_column, rollup_sql = self.COMPACTION[table]
         try:
-            self.conn.close()
-        except sqlite3.Error as e:
-            logger.error(f"خطأ في إغلاق قاعدة البيانات: {e}")
-
-# إنشاء كائن قاعدة البيانات
-db = Database()
+            self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS compact_ids (id INTEGER PRIMARY KEY)")
+            self.cursor.execute("DELETE FROM temp.compact_ids")
+            self.cursor.execute(
+                f"""INSERT INTO temp.compact_ids 
+                SELECT id FROM {table} WHERE {time_column} < ? LIMIT ?""",
+                (cutoff, chunk_size)
+            )
+            moved = self.cursor.rowcount
+            if moved > 0:
+                self.cursor.execute(rollup_sql)
+                self.cursor.execute(
+                    f"DELETE FROM {table} WHERE id IN (SELECT id FROM temp.compact_ids)"
+                )
+            self.conn.commit()
+            return moved
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في ضغط {table}: {e}")
+            self.conn.rollback()
+            return -1
+    
+    def mark_compacted(self, cutoff: str):
+        """تسجيل حد الضغط (الأيام قبله لم تعد لها سجلات خام)"""
+        self.set_setting("compacted_before", cutoff, "السجلات الخام قبل هذا التاريخ مضغوطة")
+    
+    def page_stats(self) -> Dict:
+        """عدد صفحات الملف والصفحات الحرة"""
+        return {
+            "page_count": self.conn.execute("PRAGMA page_count").fetchone()[0],
+            "freelist_count": self.conn.execute("PRAGMA freelist_count").fetchone()[0],
+            "page_size": self.conn.execute("PRAGMA page_size").fetchone()[0],
+            "auto_vacuum": self.conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        }
+    
+    def incremental_vacuum(self, pages: int) -> int:
+        """إعادة حتى pages صفحة حرة للنظام (يتطلب auto_vacuum=INCREMENTAL)"""
+        before = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        self.conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        after = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return before - after
+    
+    def enable_incremental_vacuum(self) -> bool:
+        """تحويل قاعدة موجودة إلى auto_vacuum=INCREMENTAL (VACUUM كامل - دون اتصال)"""
+        try:
+            self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self.conn.execute("VACUUM")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في VACUUM: {e}")
+            return False
+    
+    # ===== الإعدادات =====
+    def get_setting(self, key: str, default: str = None) -> Optional[str]:
+        """قراءة قيمة من جدول الإعدادات"""
+        self.cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+        row = self.cursor.fetchone()
+        return row[0] if row else default
+    
+    def set_setting(self, key: str, value: str, description: str = None):
+        """كتابة قيمة في جدول الإعدادات"""
+        self.cursor.execute(
+            """INSERT INTO settings (key, value, description, updated_at) 
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP) 
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP""",
+            (key, value, description)
+        )
+        self.conn.commit()
+    
+    # ===== الإحصائيات =====
+    def compute_daily_stats(self, day: str) -> Dict:
+        """حساب إحصائيات يوم بدقة من الجداول الخام (يرفع sqlite3.Error)"""
+        values = {"date": day}
+        # مدى [day, day+1) بدل DATE(column) = day حتى تستخدم فهارس التاريخ
+        day_range = (day, (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+        
+        # عدد المستخدمين الجدد
+        self.cursor.execute(
+            """SELECT COUNT(*) FROM users 
+            WHERE join_date >= ? AND join_date < ?""",
+            day_range
+        )
+        values["new_users"] = self.cursor.fetchone()[0]
+        
+        # المستخدمين النشطين
+        self.cursor.execute(
+            """SELECT COUNT(DISTINCT user_id) 
+            FROM transactions 
+            WHERE created_at >= ? AND created_at < ?""",
+            day_range
+        )
+        values["active_users"] = self.cursor.fetchone()[0]
+        
+        # إجمالي المستخدمين
+        self.cursor.execute("SELECT COUNT(*) FROM users")
+        values["total_users"] = self.cursor.fetchone()[0]
+        
+        # إجمالي النقاط
+        self.cursor.execute("SELECT SUM(points) FROM users")
+        values["total_points"] = self.cursor.fetchone()[0] or 0
+        
+        # الإعلانات المشاهدة
+        self.cursor.execute(
+            """SELECT COUNT(*) FROM ad_views 
+            WHERE viewed_at >= ? AND viewed_at < ?""",
+            day_range
+        )
+        values["ads_viewed"] = self.cursor.fetchone()[0]
+        
+        # الألعاب
+        self.cursor.execute(
+            """SELECT COUNT(*) FROM games 
+            WHERE created_at >= ? AND created_at < ?""",
+            day_range
+        )
+        values["games_played"] = self.cursor.fetchone()[0]
+        
+        # الملفات المحولة
+        self.cursor.execute(
+            """SELECT COUNT(*) FROM files 
+            WHERE created_at >= ? AND created_at < ?""",
+            day_range
+        )
+        values["files_converted"] = self.cursor.fetchone()[0]
+        
+        return values
+    
+    def _save_daily_stats(self, snapshots: List[Dict]):
+        """إدراج أو تحديث صفوف الإحصائيات دون commit"""
+        self.cursor.executemany(
+            """INSERT INTO statistics 
+            (date, total_users, new_users, active_users, total_points, 
+             ads_viewed, games_played, files_converted) 
+            VALUES (:date, :total_users, :new_users, :active_users, :total_points, 
+                    :ads_viewed, :games_played, :files_converted) 
+            ON CONFLICT(date) DO UPDATE SET 
+                total_users = excluded.total_users, 
+                new_users = excluded.new_users, 
+                active_users = excluded.active_users, 
+                total_points = excluded.total_points, 
+                ads_viewed = excluded.ads_viewed, 
+                games_played = excluded.games_played, 
+                files_converted = excluded.files_converted""",
+            snapshots
+        )
+    
+    def update_daily_stats(self, day: str = None):
+        """إعادة حساب إحصائيات يوم بدقة وحفظها"""
+        try:
+            day = day or datetime.now().strftime('%Y-%m-%d')
+            self._save_daily_stats([self.compute_daily_stats(day)])
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في تحديث الإحصائيات: {e}")
+            self.conn.rollback()
+            return False
+    
+    def flush_daily_stats(self) -> bool:
+        """حفظ عدادات الذاكرة في جدول statistics"""
+        snapshots = self.daily_stats.drain()
+        try:
+            self._save_daily_stats(snapshots)
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في حفظ عدادات الإحصائيات: {e}")
+            self.conn.rollback()
+            self.daily_stats.restore(snapshots)
+            return False
+    
+    def reconcile_daily_stats(self) -> bool:
+        """مطابقة العدادات مع القيم الدقيقة (لأمس واليوم) - تُشغل خارج الذروة"""
+        try:
+            now = datetime.now()
+            yesterday = (now - timedelta(days=1)).strftime('%Y-%m-%d')
+            today = now.strftime('%Y-%m-%d')
+            
+            exact = self.compute_daily_stats(today)
+            active_ids = self.active_user_ids(today)
+            
+            self._save_daily_stats([self.compute_daily_stats(yesterday), exact])
+            self.conn.commit()
+            self.daily_stats.reset(today, exact, active_ids)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في مطابقة الإحصائيات: {e}")
+            self.conn.rollback()
+            return False
+    
+    def active_user_ids(self, day: str) -> List[int]:
+        """المستخدمون الذين لهم معاملة في يوم معين"""
+        next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        self.cursor.execute(
+            "SELECT DISTINCT user_id FROM transactions WHERE created_at >= ? AND created_at < ?",
+            (day, next_day)
+        )
+        return [row[0] for row in self.cursor.fetchall()]
+    
+    # ===== أدوات مساعدة =====
+    def generate_referral_code(self, user_id: int) -> str:
+        """كود إحالة فريد للمستخدم (مشتق من user_id، بلا استعلامات)"""
+        return self.referral_codec.encode(user_id)
+    
+    # ===== لوحة المتصدرين =====
+    def rebuild_leaderboard(self):
+        """إعادة بناء لوحة المتصدرين من جدول المستخدمين"""
+        try:
+            self.cursor.execute("SELECT user_id, points FROM users WHERE is_banned = 0")
+            self.leaderboard.load(((row[0], row[1]) for row in self.cursor.fetchall()), self.shard_filter)
+            logger.info(f"تم بناء لوحة المتصدرين: {len(self.leaderboard)} مستخدم")
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في بناء لوحة المتصدرين: {e}")
+    
+    def _update_leaderboard(self, user_id: int, points: int):
+        """تحديث رصيد مستخدم غير محظور في اللوحة"""
+        user = self.user_cache.peek(user_id)
+        if user is None or not user['is_banned']:
+            self.leaderboard.update(user_id, points)
+    
+    def _with_profiles(self, entries: List[Tuple], lookup=None) -> List[Dict]:
+        """إرفاق بيانات العرض لمستخدمي اللوحة"""
+        lookup = lookup or self.get_user
+        result = []
+        for position, user_id, points in entries:
+            user = lookup(user_id) or {}
+            result.append({
+                "position": position,
+                "user_id": user_id,
+                "username": user.get("username"),
+                "first_name": user.get("first_name", str(user_id)),
+                "points": points,
+                "referral_count": user.get("referral_count", 0)
+            })
+        return result
+    
+    def get_top_users(self, limit: int = 10) -> List[Dict]:
+        """الحصول على أفضل المستخدمين"""
+        top = self.leaderboard.top(limit)
+        return self._with_profiles(
+            [(position, user_id, points) for position, (user_id, points) in enumerate(top, start=1)]
+        )
+    
+    def get_leaderboard(self, user_id: int, limit: int = 10, radius: int = 2) -> Dict:
+        """أفضل المستخدمين وموقع المستخدم وجيرانه"""
+        return {
+            "top": self.get_top_users(limit),
+            "around": self._with_profiles(self.leaderboard.around(user_id, radius)),
+            "rank": self.leaderboard.rank(user_id),
+            "total": len(self.leaderboard)
+        }
+    
+    def get_system_stats(self) -> Dict:
+        """إحصائيات النظام"""
+        stats = {}
+        try:
+            # إجمالي المستخدمين ومن تصلهم الرسائل
+            audience = self.count_audience()
+            stats["total_users"] = audience["total"]
+            stats["reachable_users"] = audience["reachable"]
+            stats["unreachable_users"] = audience["unreachable"]
+            
+            # المستخدمين النشطين اليوم (من العدادات في الذاكرة)
+            stats["active_today"] = self.daily_stats.active_count()
+            
+            # إجمالي النقاط
+            self.cursor.execute("SELECT SUM(points) FROM users")
+            stats["total_points"] = self.cursor.fetchone()[0] or 0
+            
+            # إجمالي المعاملات
+            self.cursor.execute("SELECT COUNT(*) FROM transactions")
+            stats["total_transactions"] = self.cursor.fetchone()[0]
+            
+            # الإعلانات المشاهدة
+            self.cursor.execute("SELECT SUM(views) FROM ads")
+            stats["total_ad_views"] = self.cursor.fetchone()[0] or 0
+            
+            # الألعاب
+            self.cursor.execute("SELECT COUNT(*) FROM games")
+            stats["total_games"] = self.cursor.fetchone()[0]
+            
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في جلب إحصائيات النظام: {e}")
+        
+        return stats
+    
+    # ===== النسخ الاحتياطي =====
+    BACKUP_PATTERN = re.compile(r"^backup-(\d{8}-\d{6})\.db\.gz$")
+    
+    def backup_database(self) -> Dict:
+        """نسخة احتياطية مضغوطة ومتحقق منها، ثم تدوير النسخ القديمة
+        
+        تُستدعى من خيط عامل (لا من خيط قاعدة البيانات): النسخ يتم على
+        الاتصال المشترك نفسه بخطوات من pages_per_step صفحة، فتتخلل استعلامات
+        البوت الخطوات، وأي كتابة من الاتصال نفسه تنعكس على النسخة دون إعادة.
+        """
+        if not self._backup_lock.acquire(blocking=False):
+            return {"ok": False, "error": "نسخة احتياطية أخرى قيد التنفيذ"}
+        
+        started = time.perf_counter()
+        directory = self.backup_dir
+        os.makedirs(directory, exist_ok=True)
+        name = f"backup-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db.gz"
+        backup_file = os.path.join(directory, name)
+        tmp_file = os.path.join(directory, f".{name}.tmp")
+        try:
+            backup_conn = sqlite3.connect(tmp_file)
+            try:
+                self.conn.backup(
+                    backup_conn,
+                    pages=Config.BACKUP["pages_per_step"],
+                    sleep=Config.BACKUP["step_pause"]
+                )
+                check = backup_conn.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                backup_conn.close()
+            if check != "ok":
+                raise sqlite3.DatabaseError(f"فشل فحص السلامة: {check}")
+            
+            digest = hashlib.sha256()
+            with open(tmp_file, "rb") as src, gzip.open(f"{backup_file}.part", "wb", compresslevel=6) as dst:
+                for chunk in iter(lambda: src.read(1 << 20), b""):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            
+            # التحقق من الملف المضغوط بمطابقة بصمة محتواه بعد فك الضغط
+            verify = hashlib.sha256()
+            with gzip.open(f"{backup_file}.part", "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    verify.update(chunk)
+            if verify.digest() != digest.digest():
+                raise OSError("النسخة المضغوطة لا تطابق الأصل")
+            os.replace(f"{backup_file}.part", backup_file)
+            
+            result = {
+                "ok": True,
+                "file": backup_file,
+                "size_kb": round(os.path.getsize(backup_file) / 1024, 1),
+                "raw_kb": round(os.path.getsize(tmp_file) / 1024, 1),
+                "sha256": digest.hexdigest(),
+                "removed": self.rotate_backups(directory),
+                "seconds": round(time.perf_counter() - started, 2)
+            }
+            logger.info(f"تم إنشاء نسخة احتياطية: {result}")
+            return result
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"خطأ في إنشاء نسخة احتياطية: {e}")
+            return {"ok": False, "error": str(e)}
+        finally:
+            for leftover in (tmp_file, f"{backup_file}.part"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            self._backup_lock.release()
+    
+    def rotate_backups(self, directory: str) -> List[str]:
+        """حذف النسخ غير المشمولة بأي مستوى من مستويات الاحتفاظ"""
+        backups = []
+        for name in os.listdir(directory):
+            match = self.BACKUP_PATTERN.match(name)
+            if match:
+                backups.append((datetime.strptime(match.group(1), '%Y%m%d-%H%M%S'), name))
+        backups.sort(reverse=True)
+        
+        buckets = {
+            "hourly": lambda stamp: stamp.strftime('%Y%m%d%H'),
+            "daily": lambda stamp: stamp.strftime('%Y%m%d'),
+            "weekly": lambda stamp: stamp.strftime('%G%V')
+        }
+        keep = set()
+        for tier, bucket in buckets.items():
+            seen = set()
+            for stamp, name in backups:
+                if len(seen) >= Config.BACKUP["keep"][tier]:
+                    break
+                key = bucket(stamp)
+                if key not in seen:
+                    seen.add(key)
+                    keep.add(name)
+        
+        removed = [name for _, name in backups if name not in keep]
+        for name in removed:
+            os.remove(os.path.join(directory, name))
+        return removed
+    
+    def query_stats(self, limit: int = None) -> List[Dict]:
+        """أعلى الاستعلامات حسب الزمن الكلي"""
+        if self.conn.profiler is None:
+            return []
+        return self.conn.profiler.top(limit or Config.PROFILING["top_n"])
+    
+    def reset_query_stats(self):
+        """تصفير إحصائيات الاستعلامات"""
+        if self.conn.profiler is not None:
+            self.conn.profiler.reset()
+    
+    def cache_stats(self) -> Dict:
+        """إحصائيات ذاكرة المستخدمين المؤقتة"""
+        return self.user_cache.stats()
+    
+    @property
+    def shards(self) -> List["Database"]:
+        """ملفات قاعدة البيانات (ملف واحد بدون تقسيم)"""
+        return [self]
+    
+    def close(self):
+        """إغلاق الاتصال بقاعدة البيانات"""
+        try:
+            self.executor.shutdown(wait=True)
+            self.flush_ad_views()
+            self.ad_view_buffer.close()
+            self.conn.close()
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في إغلاق قاعدة البيانات: {e}")
+
+class AsyncDatabase:
+    """واجهة غير متزامنة لقاعدة البيانات
+    
+    كل استدعاء ينفذ الدالة المتزامنة المقابلة في Database على خيط
+    قاعدة البيانات المخصص، فلا يحجب استعلام بطيء أو قفل باقي المحادثات.
+    """
+    
+    def __init__(self, database: Database):
+        self._db = database
+    
+    async def run(self, func, *args, **kwargs):
+        """تنفيذ دالة عشوائية على خيط قاعدة البيانات"""
+        return await self._db.run(func, *args, **kwargs)
+    
+    async def iter_users(self, page_size: int = None, after_user_id: int = 0, **filters):
+        """نسخة غير متزامنة من Database.iter_users: صفحة واحدة في الذاكرة في كل لحظة"""
+        page_size = page_size or Config.DATABASE["page_size"]
+        after = after_user_id
+        while True:
+            page = await self.get_users_page(after, page_size, **filters)
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                return
+            after = page[-1]["user_id"]
+    
+    def __getattr__(self, name: str):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        
+        async def wrapper(*args, **kwargs):
+            return await self._db.run(attr, *args, **kwargs)
+        
+        wrapper.__name__ = name
+        wrapper.__doc__ = attr.__doc__
+        setattr(self, name, wrapper)
+        return wrapper
+
+def shard_index(user_id: int, shards: int) -> int:
+    """رقم الجزء المالك للمستخدم (تجزئة ثابتة لا تتأثر بـ PYTHONHASHSEED)"""
+    if shards <= 1:
+        return 0
+    digest = hashlib.blake2b(struct.pack(">q", user_id), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+def shard_path(index: int) -> str:
+    """مسار ملف الجزء"""
+    return Config.SHARDING["path"].format(index=index)
+
+class ShardedDatabase:
+    """توزيع المستخدمين وسجلاتهم على عدة ملفات SQLite
+    
+    كل جزء Database مستقل باتصاله وخيطه وقفله، فتتوازى كتابات المستخدمين
+    في أجزاء مختلفة بدل التسلسل خلف كاتب SQLite واحد. المستخدم وكل سجلاته
+    (المعاملات، الألعاب، الملفات، المشاهدات، المجاميع اليومية) في جزء واحد
+    يحدده shard_index، فتبقى عمليات النقاط معاملة محلية واحدة.
+    
+    الجزء 0 يحمل أيضاً الجداول العامة (الإعلانات، الإعدادات، الإحصائيات)،
+    ولوحة المتصدرين وعدادات اليوم ومخزون الإعلانات في الذاكرة مشتركة بين الأجزاء.
+    ما يعبر الأجزاء (مكافأة محيل في جزء آخر، عدادات ads) يتم بمعاملة ثانية
+    مستقلة وليس ذرياً مع العملية الأصلية.
+    """
+    
+    # دوال معاملها الأول user_id: تنفذ في جزء المستخدم
+    USER_METHODS = frozenset({
+        "get_user", "update_user", "add_points", "debit_points", "deduct_points",
+        "get_user_stats", "add_transaction", "get_transactions", "count_transactions",
+        "get_available_ad", "record_ad_view", "record_game", "get_last_game",
+        "record_file", "generate_referral_code", "mark_reachable"
+    })
+    # الجداول العامة في الجزء 0
+    HOME_METHODS = frozenset({
+        "get_ad", "create_ad", "reload_ads", "get_setting", "set_setting", "flush_daily_stats",
+        "create_broadcast_job", "get_broadcast_job", "get_unfinished_broadcasts",
+        "recover_broadcast_job", "claim_broadcast_recipients", "save_broadcast_progress",
+        "finish_broadcast_job"
+    })
+    # تنفذ في كل الأجزاء ويجمع عدد الصفوف
+    SUM_METHODS = frozenset({"backfill_daily_totals", "flush_ad_views"})
+    
+    def __init__(self, count: int):
+        self.count = count
+        self.home = Database(shard_path(0), shard=(0, count))
+        self.shards = [self.home] + [
+            Database(shard_path(index), home=self.home, shard=(index, count))
+            for index in range(1, count)
+        ]
+        # خيوط الموجه: كل استدعاء يأخذ قفل جزئه فقط، فتتوازى الأجزاء
+        self.executor = ThreadPoolExecutor(
+            max_workers=count * Config.DATABASE["executor_workers"],
+            thread_name_prefix="malik-shard"
+        )
+        self.reconcile_daily_stats()
+        logger.info(f"قاعدة بيانات مقسمة على {count} ملفات")
+    
+    def shard_for(self, user_id: int) -> Database:
+        """الجزء المالك للمستخدم"""
+        return self.shards[shard_index(user_id, self.count)]
+    
+    def __getattr__(self, name: str):
+        if name in self.USER_METHODS:
+            def routed(user_id, *args, **kwargs):
+                shard = self.shard_for(user_id)
+                return shard._call_locked(getattr(shard, name), user_id, *args, **kwargs)
+        elif name in self.HOME_METHODS:
+            def routed(*args, **kwargs):
+                return self.home._call_locked(getattr(self.home, name), *args, **kwargs)
+        elif name in self.SUM_METHODS:
+            def routed(*args, **kwargs):
+                results = self._scatter(name, *args, **kwargs)
+                return -1 if any(result < 0 for result in results) else sum(results)
+        else:
+            raise AttributeError(f"{type(self).__name__} has no attribute {name!r}")
+        
+        routed.__name__ = name
+        routed.__doc__ = getattr(Database, name).__doc__
+        setattr(self, name, routed)
+        return routed
+    
+    def _scatter(self, name: str, *args, **kwargs) -> List:
+        """تنفيذ دالة في كل الأجزاء بالتوازي (كل جزء على خيطه) وجمع النتائج بالترتيب"""
+        futures = [
+            shard.executor.submit(shard._call_locked, getattr(shard, name), *args, **kwargs)
+            for shard in self.shards
+        ]
+        return [future.result() for future in futures]
+    
+    async def run(self, func, *args, **kwargs):
+        """تنفيذ دالة متزامنة على خيوط الموجه وانتظار نتيجتها"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(func, *args, **kwargs)
+        )
+    
+    # ===== المستخدمون =====
+    def create_user(self, user_id: int, username: str, first_name: str,
+                    last_name: str = "", referred_by: int = None) -> Dict:
+        """إنشاء مستخدم في جزئه، ومكافأة المحيل في جزء المحيل"""
+        shard = self.shard_for(user_id)
+        referrer_shard = self.shard_for(referred_by) if referred_by else shard
+        user = shard._call_locked(
+            shard.create_user, user_id, username, first_name, last_name, referred_by,
+            credit_referrer=referrer_shard is shard
+        )
+        if user and referrer_shard is not shard:
+            referrer_shard._call_locked(referrer_shard.credit_referral, referred_by)
+        return user
+    
+    def get_user_id_by_referral_code(self, referral_code: str) -> Optional[int]:
+        """فك الكود مباشرة، والأكواد العشوائية القديمة تبحث في فهرس كل جزء"""
+        user_id = self.home.referral_codec.decode(referral_code)
+        if user_id is not None and self.get_user(user_id):
+            return user_id
+        return next(
+            (found for found in self._scatter("get_user_id_by_referral_code", referral_code) if found),
+            None
+        )
+    
+    def get_users_page(self, after_user_id: int = 0, limit: int = None, **filters) -> List[Dict]:
+        """صفحة مستخدمين مرتبة من كل الأجزاء: أول limit بعد الدمج"""
+        limit = limit or Config.DATABASE["page_size"]
+        rows = [row for page in self._scatter("get_users_page", after_user_id, limit, **filters)
+                for row in page]
+        return heapq.nsmallest(limit, rows, key=lambda row: row["user_id"])
+    
+    iter_users = Database.iter_users
+    
+    def mark_undeliverable(self, entries: List[Tuple[int, str, str]]) -> int:
+        """تسجيل حالة الوصول في جزء كل مستخدم"""
+        by_shard: Dict[int, List[Tuple[int, str, str]]] = {}
+        for entry in entries:
+            by_shard.setdefault(shard_index(entry[0], self.count), []).append(entry)
+        return sum(
+            self.shards[index]._call_locked(self.shards[index].mark_undeliverable, group)
+            for index, group in by_shard.items()
+        )
+    
+    def count_audience(self) -> Dict:
+        """حجم الجمهور مجموعاً من كل الأجزاء"""
+        return self._sum_stats(self._scatter("count_audience"))
+    
+    # ===== الإحصائيات =====
+    @staticmethod
+    def _sum_stats(parts: List[Dict]) -> Dict:
+        """جمع القيم العددية لإحصائيات الأجزاء"""
+        total = dict(parts[0])
+        for part in parts[1:]:
+            for key, value in part.items():
+                if isinstance(value, (int, float)) and key in total:
+                    total[key] += value
+        return total
+    
+    def reconcile_daily_stats(self) -> bool:
+        """مطابقة العدادات المشتركة مع مجموع القيم الدقيقة لكل الأجزاء"""
+        now = datetime.now()
+        yesterday = (now - timedelta(days=1)).strftime('%Y-%m-%d')
+        today = now.strftime('%Y-%m-%d')
+        home = self.home
+        
+        def save(snapshots):
+            try:
+                home._save_daily_stats(snapshots)
+                home.conn.commit()
+            except sqlite3.Error:
+                home.conn.rollback()
+                raise
+        
+        try:
+            exact = self._sum_stats(self._scatter("compute_daily_stats", today))
+            previous = self._sum_stats(self._scatter("compute_daily_stats", yesterday))
+            active_ids = [uid for ids in self._scatter("active_user_ids", today) for uid in ids]
+            home._call_locked(save, [previous, exact])
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في مطابقة الإحصائيات: {e}")
+            return False
+        
+        home.daily_stats.reset(today, exact, active_ids)
+        return True
+    
+    def get_system_stats(self) -> Dict:
+        """إحصائيات النظام (مجموع الأجزاء)"""
+        stats = self._sum_stats(self._scatter("get_system_stats"))
+        stats["active_today"] = self.home.daily_stats.active_count()
+        return stats
+    
+    # ===== لوحة المتصدرين (مشتركة) =====
+    def rebuild_leaderboard(self):
+        """إعادة بناء اللوحة المشتركة من كل الأجزاء"""
+        self._scatter("rebuild_leaderboard")
+    
+    def get_top_users(self, limit: int = 10) -> List[Dict]:
+        """أفضل المستخدمين في كل الأجزاء"""
+        top = self.home.leaderboard.top(limit)
+        # بيانات العرض تجلب من جزء كل مستخدم دون حجز قفل الجزء 0
+        return self.home._with_profiles(
+            [(position, user_id, points) for position, (user_id, points) in enumerate(top, start=1)],
+            lookup=self.get_user
+        )
+    
+    def get_leaderboard(self, user_id: int, limit: int = 10, radius: int = 2) -> Dict:
+        """أفضل المستخدمين وموقع المستخدم وجيرانه"""
+        board = self.home.leaderboard
+        return {
+            "top": self.get_top_users(limit),
+            "around": self.home._with_profiles(board.around(user_id, radius), lookup=self.get_user),
+            "rank": board.rank(user_id),
+            "total": len(board)
+        }
+    
+    # ===== الصيانة =====
+    def backup_database(self) -> Dict:
+        """نسخة احتياطية لكل جزء بالتتابع (كل جزء في مجلده)"""
+        results = [shard.backup_database() for shard in self.shards]
+        failed = [result["error"] for result in results if not result["ok"]]
+        if failed:
+            return {"ok": False, "error": "; ".join(failed)}
+        return {
+            "ok": True,
+            "file": results[0]["file"],
+            "files": [result["file"] for result in results],
+            "size_kb": round(sum(result["size_kb"] for result in results), 1),
+            "raw_kb": round(sum(result["raw_kb"] for result in results), 1),
+            "sha256": [result["sha256"] for result in results],
+            "removed": [name for result in results for name in result["removed"]],
+            "seconds": round(sum(result["seconds"] for result in results), 2)
+        }
+    
+    def enable_incremental_vacuum(self) -> bool:
+        """تحويل كل الأجزاء إلى auto_vacuum=INCREMENTAL"""
+        return all(self._scatter("enable_incremental_vacuum"))
+    
+    def cache_stats(self) -> Dict:
+        """إحصائيات الذاكرة المؤقتة لكل الأجزاء"""
+        stats = self._sum_stats([shard.cache_stats() for shard in self.shards])
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / total * 100, 1) if total else 0.0
+        return stats
+    
+    def query_stats(self, limit: int = None) -> List[Dict]:
+        """أعلى الاستعلامات في كل الأجزاء (المئينات: أعلى قيمة بين الأجزاء)"""
+        merged: Dict[str, Dict] = {}
+        for shard in self.shards:
+            for entry in shard._call_locked(shard.query_stats, 10 ** 6):
+                current = merged.get(entry["sql"])
+                if current is None:
+                    merged[entry["sql"]] = dict(entry)
+                    continue
+                current["calls"] += entry["calls"]
+                current["total_ms"] = round(current["total_ms"] + entry["total_ms"], 2)
+                current["rows"] += entry["rows"]
+                for key in ("max_ms", "p50_ms", "p95_ms", "p99_ms"):
+                    current[key] = max(current[key], entry[key])
+        for entry in merged.values():
+            entry["avg_ms"] = round(entry["total_ms"] / (entry["calls"] or 1), 3)
+        return sorted(merged.values(), key=lambda e: e["total_ms"], reverse=True)[
+            :limit or Config.PROFILING["top_n"]
+        ]
+    
+    def reset_query_stats(self):
+        """تصفير إحصائيات الاستعلامات في كل الأجزاء"""
+        for shard in self.shards:
+            shard._call_locked(shard.reset_query_stats)
+    
+    def close(self):
+        """إغلاق كل الأجزاء"""
+        self.executor.shutdown(wait=True)
+        for shard in self.shards:
+            shard.close()
+
+class LedgerWriter:
+    """مرحلة تجميع كتابات دفتر النقاط (group commit)
+    
+    تجمع عمليات النقاط القادمة من محادثات متزامنة كثيرة وتنفذها في معاملة
+    واحدة كل بضعة أجزاء من الثانية أو كل max_batch عملية. كل مستدعٍ ينتظر
+    Future لا يكتمل إلا بعد نجاح الـ commit (تأكيد دائم).
+    """
+    
+    def __init__(self, database: Database, max_batch: int = None,
+                 max_delay: float = None):
+        self.db = database
+        self.max_batch = max_batch or Config.LEDGER["max_batch"]
+        self.max_delay = Config.LEDGER["max_delay"] if max_delay is None else max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"batches": 0, "operations": 0, "failed": 0}
+    
+    def _ensure_started(self):
+        """تشغيل مهمة التجميع عند أول استخدام داخل حلقة الأحداث"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def submit(self, func, *args, **kwargs) -> Any:
+        """إضافة عملية للدفعة التالية وانتظار تأكيد حفظها"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((func, args, kwargs, future))
+        return await future
+    
+    async def add_points(self, user_id: int, amount: int,
+                         trans_type: str, description: str = "",
+                         reference_id: str = None) -> bool:
+        """إضافة نقاط عبر الدفعة المجمعة"""
+        try:
+            return await self.submit(
+                self.db._apply_points, user_id, amount,
+                trans_type, description, reference_id
+            )
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في إضافة نقاط للمستخدم {user_id}: {e}")
+            return False
+    
+    async def debit_points(self, user_id: int, amount: int,
+                           trans_type: str, description: str = "",
+                           reference_id: str = None) -> Optional[int]:
+        """خصم مشروط عبر الدفعة المجمعة: الرصيد الجديد أو None"""
+        try:
+            return await self.submit(
+                self.db._apply_debit, user_id, amount,
+                trans_type, description, reference_id
+            )
+        except sqlite3.Error as e:
+            logger.error(f"خطأ في خصم نقاط من المستخدم {user_id}: {e}")
+            return None
+    
+    async def _collect(self) -> List[Tuple]:
+        """انتظار أول عملية ثم جمع ما يصل حتى انتهاء المهلة أو امتلاء الدفعة"""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_delay
+        
+        while len(batch) < self.max_batch:
+            while not self._queue.empty() and len(batch) < self.max_batch:
+                batch.append(self._queue.get_nowait())
+            
+            timeout = deadline - loop.time()
+            if len(batch) >= self.max_batch or timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        return batch
+    
+    async def _run(self):
+        """حلقة التجميع والكتابة"""
+        while True:
+            batch = await self._collect()
+            operations = [(func, args, kwargs) for func, args, kwargs, _ in batch]
+            
+            try:
+                results = await self.db.run(self.db.apply_batch, operations)
+            except Exception as e:
+                results = [(False, e)] * len(batch)
+            
+            self.stats["batches"] += 1
+            self.stats["operations"] += len(batch)
+            
+            for (_, _, _, future), (ok, value) in zip(batch, results):
+                if not ok:
+                    self.stats["failed"] += 1
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            
+            for _ in batch:
+                self._queue.task_done()
+    
+    async def stop(self):
+        """انتظار تفريغ الطابور ثم إيقاف مهمة التجميع"""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+class ShardedLedgerWriter:
+    """مرحلة تجميع مستقلة لكل جزء: دفعات الأجزاء تُحفظ بالتوازي"""
+    
+    def __init__(self, database: ShardedDatabase):
+        self.db = database
+        self.writers = [LedgerWriter(shard) for shard in database.shards]
+    
+    def _writer(self, user_id: int) -> LedgerWriter:
+        return self.writers[shard_index(user_id, self.db.count)]
+    
+    @property
+    def stats(self) -> Dict:
+        """مجموع عدادات الأجزاء"""
+        return {
+            key: sum(writer.stats[key] for writer in self.writers)
+            for key in ("batches", "operations", "failed")
+        }
+    
+    async def add_points(self, user_id: int, amount: int,
+                         trans_type: str, description: str = "",
+                         reference_id: str = None) -> bool:
+        """إضافة نقاط عبر دفعة جزء المستخدم"""
+        return await self._writer(user_id).add_points(
+            user_id, amount, trans_type, description, reference_id
+        )
+    
+    async def debit_points(self, user_id: int, amount: int,
+                           trans_type: str, description: str = "",
+                           reference_id: str = None) -> Optional[int]:
+        """خصم مشروط عبر دفعة جزء المستخدم"""
+        return await self._writer(user_id).debit_points(
+            user_id, amount, trans_type, description, reference_id
+        )
+    
+    async def stop(self):
+        """إيقاف مراحل كل الأجزاء"""
+        await asyncio.gather(*(writer.stop() for writer in self.writers))
+
+class HistoryCompactor:
+    """ضغط السجلات الخام الأقدم من الأفق المحدد
+    
+    كل دفعة (chunk_size صف) تُجمع في الجداول اليومية وتُحذف في معاملة قصيرة
+    مستقلة على خيط قاعدة البيانات، مع استراحة بين الدفعات، فلا تُقفل القاعدة
+    طويلاً ويبقى البوت يستجيب أثناء الضغط.
+    """
+    
+    def __init__(self, database: Database, horizon_days: int = None):
+        self.db = database
+        self.horizon_days = horizon_days or Config.RETENTION["horizon_days"]
+    
+    async def run(self) -> Dict:
+        """تشغيل الضغط الكامل وإرجاع تقرير"""
+        started = time.perf_counter()
+        cutoff = (datetime.utcnow() - timedelta(days=self.horizon_days)).strftime('%Y-%m-%d')
+        before = await self.db.run(self.db.page_stats)
+        report = {"cutoff": cutoff, "rows": {}, "chunks": 0}
+        
+        # المعاملات لا تحذف إلا بعد أرشفة شهرها كاملاً
+        archived_before, report["archived"] = await self.archive_closed_months(cutoff)
+        cutoffs = {"ad_views": cutoff, "transactions": min(cutoff, archived_before)}
+        
+        report["failed"] = []
+        for table in Database.COMPACTION:
+            total = 0
+            while True:
+                moved = await self.db.run(
+                    self.db.compact_chunk, table, cutoffs[table], Config.RETENTION["chunk_size"]
+                )
+                if moved < 0:
+                    report["failed"].append(table)
+                if moved <= 0:
+                    break
+                total += moved
+                report["chunks"] += 1
+                await asyncio.sleep(Config.RETENTION["chunk_pause"])
+            report["rows"][table] = total
+        
+        # بقيت صفوف قبل cutoff لم تنقل: لا نعلن الضغط حتى تكتمل في تشغيل لاحق
+        if report["failed"]:
+            logger.warning(f"ضغط ناقص في {report['failed']}، لن يسجل حد الضغط {cutoff}")
+        else:
+            await self.db.run(self.db.mark_compacted, cutoff)
+        
+        # إعادة الصفحات المحررة للنظام على دفعات أيضاً
+        freed = await self.db.run(self.db.page_stats)
+        vacuumed = 0
+        if freed["auto_vacuum"] == 2 and not report["failed"]:
+            while True:
+                step = await self.db.run(self.db.incremental_vacuum, Config.RETENTION["vacuum_pages"])
+                if step <= 0:
+                    break
+                vacuumed += step
+                await asyncio.sleep(Config.RETENTION["chunk_pause"])
+        after = await self.db.run(self.db.page_stats)
+        
+        report.update({
+            "pages_freed": freed["freelist_count"] - before["freelist_count"],
+            "pages_returned": vacuumed,
+            "page_count_before": before["page_count"],
+            "page_count_after": after["page_count"],
+            "reclaimed_kb": round(vacuumed * after["page_size"] / 1024, 1),
+            "seconds": round(time.perf_counter() - started, 2)
+        })
+        logger.info(f"ضغط السجلات: {report}")
+        return report
+    
+    @staticmethod
+    def _next_month(month_start: datetime) -> datetime:
+        return (month_start + timedelta(days=32)).replace(day=1)
+    
+    async def archive_closed_months(self, cutoff: str) -> Tuple[str, List[str]]:
+        """أرشفة كل شهر مغلق قبل cutoff لم يؤرشف بعد
+        
+        يعيد أول تاريخ لم تكتمل أرشفة ما قبله، وقائمة الأشهر المؤرشفة الآن.
+        """
+        limit_month = datetime.strptime(cutoff, '%Y-%m-%d').replace(day=1)
+        oldest = await self.db.run(self.db.oldest_transaction_time)
+        if not oldest:
+            return limit_month.strftime('%Y-%m-%d'), []
+        
+        done = {s["month"] for s in await self.db.run(self.db.get_archive_segments)}
+        month = datetime.strptime(oldest[:7], '%Y-%m')
+        archived = []
+        while month < limit_month:
+            key = month.strftime('%Y-%m')
+            next_month = self._next_month(month)
+            if key not in done:
+                try:
+                    if await self.archive_month(key, month, next_month):
+                        archived.append(key)
+                except (OSError, sqlite3.Error) as e:
+                    logger.error(f"خطأ في أرشفة شهر {key}: {e}")
+                    return month.strftime('%Y-%m-%d'), archived
+            month = next_month
+        return limit_month.strftime('%Y-%m-%d'), archived
+    
+    async def archive_month(self, key: str, start: datetime, end: datetime) -> bool:
+        """قراءة الشهر على دفعات من القاعدة ثم ضغطه وكتابته خارج خيطها"""
+        columns, rows = None, []
+        after, end_key = (start.strftime('%Y-%m-%d'), 0), end.strftime('%Y-%m-%d')
+        while True:
+            columns, batch = await self.db.run(
+                self.db.fetch_transactions_range, after, end_key, Config.RETENTION["archive_fetch"]
+            )
+            if not batch:
+                break
+            rows.extend(batch)
+            after = (batch[-1][columns.index("created_at")], batch[-1][0])
+        if not rows:
+            return False
+        
+        segment = await asyncio.to_thread(self.db.archive.write_segment, key, columns, rows)
+        # التحقق من الملف قبل اعتماده (وقبل أن يسمح بحذف صفوفه)
+        index = await asyncio.to_thread(self.db.archive.index, segment["path"])
+        if index["rows"] != len(rows):
+            raise OSError(f"عدد صفوف الأرشيف غير مطابق: {segment['path']}")
+        await self.db.run(self.db.register_archive_segment, key, segment)
+        logger.info(f"تمت أرشفة معاملات {key}: {segment['rows']} صف")
+        return True
+
+# إنشاء كائن قاعدة البيانات
+if Config.SHARDING["shards"] > 1:
+    # قاعدة قائمة غير مقسمة: لا نبدأ بأجزاء فارغة بجانبها
+    if os.path.exists(Config.PATHS["database"]) and not os.path.exists(shard_path(0)):
+        sys.exit(f"❌ {Config.PATHS['database']} غير مقسمة: شغّل "
+                 f"'DB_SHARDS=1 python bot.py reshard {Config.SHARDING['shards']}' أولاً")
+    db = ShardedDatabase(Config.SHARDING["shards"])
+    ledger = ShardedLedgerWriter(db)
+else:
+    db = Database()
+    ledger = LedgerWriter(db)
+adb = AsyncDatabase(db)
 
 # ==================== أدوات PDF المتقدمة ====================
 class PDFManager:
@@ -936,7 +3700,7 @@ class PDFManager:
             return output
         except Exception as e:
             logger.error(f"خطأ في دمج ملفات PDF: {e}")
-            return BytesIO(b"خطأ في دمج الملفات")
+            return BytesIO("خطأ في دمج الملفات".encode("utf-8"))
     
     @staticmethod
     def compress_pdf(input_pdf: BytesIO, quality: int = 50) -> BytesIO:
@@ -1292,14 +4056,10 @@ class GameManager:
     def number_guessing_game(user_id: int, guess: int) -> Dict:
         """لعبة تخمين الأرقام"""
         # الحصول على الرقم السري من قاعدة البيانات أو إنشائه
-        db.cursor.execute(
-            "SELECT game_data FROM games WHERE user_id = ? AND game_type = 'number_guess' ORDER BY id DESC LIMIT 1",
-            (user_id,)
-        )
-        row = db.cursor.fetchone()
+        last_game = db.get_last_game(user_id, "number_guess")
         
-        if row:
-            game_data = json.loads(row[0])
+        if last_game and last_game.get("game_data"):
+            game_data = json.loads(last_game["game_data"])
             secret_number = game_data.get("secret_number")
         else:
             secret_number = random.randint(1, 100)
@@ -1326,12 +4086,6 @@ class GameManager:
         game_data["last_guess"] = guess
         game_data["last_result"] = status
         
-        db.cursor.execute(
-            """INSERT INTO games (user_id, game_type, score, points_earned, duration) 
-            VALUES (?, ?, ?, ?, ?)""",
-            (user_id, "number_guess", attempts, points, 0)
-        )
-        
         # إذا فاز، إنشاء رقم جديد
         if status == "win":
             secret_number = random.randint(1, 100)
@@ -1339,6 +4093,7 @@ class GameManager:
         
         # حفظ في قاعدة البيانات (كبيانات إضافية)
         game_data_json = json.dumps(game_data)
+        db.record_game(user_id, "number_guess", attempts, to_milli(points), 0, game_data_json)
         
         return {
             "status": status,
@@ -1368,47 +4123,418 @@ class GameManager:
                 return user_answer.strip().lower() == q["answer"].lower()
         return False
 
-# ==================== معالجات البوت ====================
-class BotHandlers:
-    """جميع معالجات البوت"""
+# ==================== الإعلان الجماعي ====================
+class TokenBucket:
+    """دلو رموز غير متزامن: rate رسالة في الثانية بسعة burst
     
-    # حالات المحادثة
-    (WAITING_FOR_PDF_TEXT, WAITING_FOR_TOOL_INPUT, WAITING_FOR_GAME_INPUT,
-     WAITING_FOR_ADMIN_BROADCAST, WAITING_FOR_ADMIN_ADD_POINTS) = range(5)
+    المنتظرون يخدمون بالترتيب (قفل واحد)، و pause توقف الدلو كله عند
+    RetryAfter لأن حد تيليجرام على البوت كله لا على المحادثة.
+    """
     
-    @staticmethod
-    async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """معالجة أمر /start"""
-        user = update.effective_user
-        logger.info(f"مستخدم جديد: {user.id} - {user.username}")
-        
-        # التحقق من وجود محيل
-        referred_by = None
-        if context.args:
-            referral_code = context.args[0]
-            db.cursor.execute(
-                "SELECT user_id FROM users WHERE referral_code = ?",
-                (referral_code,)
-            )
-            row = db.cursor.fetchone()
-            if row:
-                referred_by = row[0]
-        
-        # التحقق من وجود المستخدم
-        user_data = db.get_user(user.id)
-        
-        if not user_data:
-            # إنشاء مستخدم جديد
-            user_data = db.create_user(
-                user.id, 
-                user.username or "", 
-                user.first_name, 
-                user.last_name or "",
-                referred_by
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated: Optional[float] = None
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """انتظار رمز واحد"""
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self._updated is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+    
+    def pause(self, seconds: float):
+        """إيقاف الإرسال لمدة seconds وتفريغ الرصيد (flood wait)"""
+        now = asyncio.get_running_loop().time()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+        self._updated = self._paused_until
+
+class DeliveryTracker:
+    """تصنيف أخطاء الإرسال الصادر وتسجيل المحادثات الميتة في القاعدة
+    
+    المحادثة الميتة (حظر البوت، حساب محذوف، محادثة غير موجودة) لا تعاد ولا
+    تدخل الإعلانات التالية حتى يعود المستخدم بـ /start. التسجيل يتجمع في
+    الذاكرة ويكتب دفعة واحدة عند flush.
+    """
+    
+    DEAD_STATES = ("blocked", "deactivated", "not_found")
+    # نص الخطأ من Bot API (بأحرف صغيرة) -> الحالة
+    PATTERNS = (
+        ("blocked by the user", "blocked"),
+        ("bot was kicked", "blocked"),
+        ("can't initiate conversation", "blocked"),
+        ("user is deactivated", "deactivated"),
+        ("chat not found", "not_found"),
+        ("user not found", "not_found"),
+        ("peer_id_invalid", "not_found"),
+    )
+    
+    def __init__(self):
+        self._dead: Dict[int, Tuple[str, str]] = {}
+        self.stats = {state: 0 for state in self.DEAD_STATES}
+    
+    @classmethod
+    def classify(cls, error: Exception) -> str:
+        """flood أو transient (تعاد) أو حالة ميتة أو failed (فشل لا يخص المستلم)"""
+        # BadRequest فرع من NetworkError في المكتبة: يفحص قبله
+        if isinstance(error, RetryAfter):
+            return "flood"
+        if isinstance(error, (Forbidden, BadRequest)):
+            message = str(error).lower()
+            for pattern, state in cls.PATTERNS:
+                if pattern in message:
+                    return state
+            # Forbidden غير معروف النص يعني منع الوصول للمحادثة نفسها
+            return "blocked" if isinstance(error, Forbidden) else "failed"
+        if isinstance(error, (TimedOut, NetworkError)):
+            return "transient"
+        return "failed"
+    
+    def mark_dead(self, chat_id: int, state: str, error: Exception):
+        self._dead[chat_id] = (state, str(error))
+        self.stats[state] += 1
+    
+    async def flush(self) -> int:
+        """كتابة المحادثات الميتة المتراكمة"""
+        if not self._dead:
+            return 0
+        dead, self._dead = self._dead, {}
+        entries = [(chat_id, state, error) for chat_id, (state, error) in dead.items()]
+        written = await adb.mark_undeliverable(entries)
+        if not written:
+            # فشل الكتابة: تبقى للمحاولة التالية
+            self._dead = {**dead, **self._dead}
+        return written
+
+class BroadcastEngine:
+    """إرسال رسالة لعدد كبير من المستخدمين بمعدل ثابت وتوازٍ محدود
+    
+    المعدل الكلي يحدده TokenBucket، وعدد الطلبات الجارية concurrency (يغطي
+    زمن الشبكة: المعدل × زمن الطلب). RetryAfter يوقف الدلو للجميع ثم يعيد
+    نفس المستلم؛ أخطاء الشبكة تعاد بتأخير أسي؛ الحظر أو المحادثة غير
+    الموجودة فشل نهائي بلا إعادة ويسجل في tracker إن وجد.
+    """
+    
+    def __init__(self, send, rate: float = None, concurrency: int = None,
+                 max_retries: int = None, on_progress=None, on_result=None,
+                 tracker: DeliveryTracker = None):
+        self.send = send
+        self.tracker = tracker
+        self.bucket = TokenBucket(
+            rate or Config.BROADCAST["rate"],
+            Config.BROADCAST["burst"]
+        )
+        self.concurrency = concurrency or Config.BROADCAST["concurrency"]
+        self.max_retries = Config.BROADCAST["max_retries"] if max_retries is None else max_retries
+        self.on_progress = on_progress
+        # on_result(chat_id, outcome) لكل مستلم؛ unsent = لم يُرسل بسبب stop
+        self.on_result = on_result
+        self.stats = {"sent": 0, "blocked": 0, "failed": 0, "retries": 0, "flood_waits": 0}
+        self._stopped = False
+    
+    def stop(self):
+        """إيقاف مرتب: لا إرسال جديد، والطلبات الجارية تكتمل"""
+        self._stopped = True
+    
+    async def _deliver(self, chat_id: int) -> str:
+        """إرسال لمستلم واحد مع الإعادة: sent أو blocked أو failed"""
+        attempt = 0
+        while True:
+            if self._stopped:
+                return "unsent"
+            await self.bucket.acquire()
+            try:
+                await self.send(chat_id)
+                return "sent"
+            except Exception as e:
+                kind = DeliveryTracker.classify(e)
+                if kind == "flood":
+                    self.stats["flood_waits"] += 1
+                    self.bucket.pause(float(e.retry_after))
+                elif kind in DeliveryTracker.DEAD_STATES:
+                    if self.tracker:
+                        self.tracker.mark_dead(chat_id, kind, e)
+                    return "blocked"
+                elif kind == "transient":
+                    if attempt >= self.max_retries:
+                        logger.warning(f"فشل الإرسال إلى {chat_id} بعد {attempt} إعادة: {e}")
+                        return "failed"
+                    await asyncio.sleep(Config.BROADCAST["retry_base"] * 2 ** attempt)
+                    attempt += 1
+                else:
+                    logger.error(f"فشل الإرسال إلى {chat_id}: {e}")
+                    return "failed"
+            self.stats["retries"] += 1
+    
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            chat_id = await queue.get()
+            try:
+                if chat_id is None:
+                    return
+                outcome = await self._deliver(chat_id)
+                if outcome in self.stats:
+                    self.stats[outcome] += 1
+                if self.on_result:
+                    self.on_result(chat_id, outcome)
+            finally:
+                queue.task_done()
+    
+    async def _report(self, started: float):
+        """استدعاء on_progress دورياً حتى الإلغاء"""
+        while True:
+            await asyncio.sleep(Config.BROADCAST["progress_interval"])
+            await self.on_progress(self.progress(started))
+    
+    def progress(self, started: float) -> Dict:
+        """العدادات الحالية مع المدة والمعدل الفعلي"""
+        elapsed = time.perf_counter() - started
+        done = self.stats["sent"] + self.stats["blocked"] + self.stats["failed"]
+        return {
+            **self.stats,
+            "total": done,
+            "seconds": round(elapsed, 2),
+            "per_second": round(self.stats["sent"] / elapsed, 1) if elapsed else 0.0
+        }
+    
+    async def run(self, recipients) -> Dict:
+        """الإرسال لكل user_id من recipients (مكرر غير متزامن) وإرجاع الإحصائيات"""
+        started = time.perf_counter()
+        # طابور محدود: القراءة من القاعدة لا تسبق الإرسال بأكثر من صفحة تقريباً
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report(started)) if self.on_progress else None
+        try:
+            async for chat_id in recipients:
+                if self._stopped:
+                    if self.on_result:
+                        self.on_result(chat_id, "unsent")
+                    break
+                await queue.put(chat_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers + ([reporter] if reporter else []):
+                task.cancel()
+        
+        result = self.progress(started)
+        logger.info(f"انتهى الإعلان الجماعي: {result}")
+        return result
+
+class BroadcastJobRunner:
+    """تشغيل مهمة من broadcast_jobs بمحرك الإرسال مع حفظ التقدم دورياً
+    
+    المستلمون يحجزون (queued) على دفعات قبل إرسالهم، والنتائج تحفظ كل
+    checkpoint_interval مع المؤشر: أصغر مستلم محجوز لم تحسم نتيجته ناقص واحد.
+    بعد التوقف يستأنف من المؤشر متخطياً من حسمت نتيجتهم بعده.
+    """
+    
+    def __init__(self, bot, job: Dict):
+        self.bot = bot
+        self.job = job
+        self.engine = BroadcastEngine(self._send, on_progress=self._report, on_result=self._record,
+                                      tracker=deliveries)
+        self._pending: set = set()
+        self._undispatched: List[int] = []
+        self._results: List[Tuple[int, str]] = []
+        self._claimed_until = job["cursor_user_id"]
+        self._started = time.perf_counter()
+    
+    async def _send(self, chat_id: int):
+        await self.bot.send_message(chat_id=chat_id, text=self.job["text"], parse_mode=self.job["parse_mode"])
+    
+    def _record(self, chat_id: int, outcome: str):
+        self._results.append((chat_id, outcome))
+    
+    async def _recipients(self):
+        """المستلمون بعد المؤشر، محجوزين على دفعات"""
+        done = set(await adb.recover_broadcast_job(self.job["id"]))
+        chunk: List[int] = []
+        users = adb.iter_users(after_user_id=self.job["cursor_user_id"], exclude_banned=True,
+                               reachable=True, columns=("user_id",))
+        async for row in users:
+            if row["user_id"] not in done:
+                chunk.append(row["user_id"])
+            if len(chunk) >= Config.BROADCAST["claim_chunk"]:
+                await self._claim(chunk)
+                while self._undispatched:
+                    yield self._undispatched.pop()
+                chunk = []
+        await self._claim(chunk)
+        while self._undispatched:
+            yield self._undispatched.pop()
+    
+    async def _claim(self, chunk: List[int]):
+        if chunk:
+            if not await adb.claim_broadcast_recipients(self.job["id"], chunk):
+                raise sqlite3.OperationalError("تعذر حجز المستلمين")
+            self._pending.update(chunk)
+            self._claimed_until = chunk[-1]
+            self._undispatched = chunk[::-1]
+    
+    async def checkpoint(self):
+        """حفظ النتائج المتراكمة والمؤشر"""
+        results, self._results = self._results, []
+        for chat_id, outcome in results:
+            if outcome != "unsent":
+                self._pending.discard(chat_id)
+        cursor = min(self._pending) - 1 if self._pending else self._claimed_until
+        if not await adb.save_broadcast_progress(self.job["id"], results, cursor):
+            self._results = results + self._results
+        await deliveries.flush()
+    
+    async def _checkpoints(self):
+        while True:
+            await asyncio.sleep(Config.BROADCAST["checkpoint_interval"])
+            await self.checkpoint()
+    
+    def totals(self) -> Dict:
+        """عدادات المهمة كلها (التشغيلات السابقة + الحالي)"""
+        progress = self.engine.progress(self._started)
+        for key in ("sent", "blocked", "failed"):
+            progress[key] += self.job[key]
+        progress["total"] = progress["sent"] + progress["blocked"] + progress["failed"]
+        return progress
+    
+    async def _edit(self, text: str):
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.job["chat_id"], message_id=self.job["message_id"], parse_mode='Markdown'
             )
-            
-            welcome_message = f"""
-            🎉 **أهلاً وسهلاً بك {user.first_name}!**
+        except TelegramError as e:
+            logger.warning(f"تعذر تحديث رسالة تقدم الإعلان {self.job['id']}: {e}")
+    
+    async def _report(self, progress: Dict):
+        totals = self.totals()
+        await self._edit(
+            f"⏳ **جاري الإرسال...**\n\n"
+            f"✅ الناجح: {totals['sent']:,}\n"
+            f"🚫 محظور/غير موجود: {totals['blocked']:,}\n"
+            f"❌ الفاشل: {totals['failed']:,}\n"
+            f"⚡ المعدل: {progress['per_second']} رسالة/ثانية"
+        )
+    
+    async def run(self) -> Dict:
+        """الإرسال حتى النهاية أو حتى stop (تبقى المهمة running للاستئناف)"""
+        self._started = time.perf_counter()
+        saver = asyncio.create_task(self._checkpoints())
+        try:
+            await self.engine.run(self._recipients())
+        finally:
+            saver.cancel()
+            # محجوزون لم يصلوا للمحرك قبل stop: يحرر حجزهم ليرسلوا عند الاستئناف
+            for user_id in self._undispatched:
+                self._record(user_id, "unsent")
+            self._undispatched = []
+            await self.checkpoint()
+        
+        totals = self.totals()
+        if self.engine._stopped:
+            logger.info(f"أوقف الإعلان {self.job['id']} عند المستخدم {self._claimed_until}")
+            return totals
+        
+        await adb.finish_broadcast_job(self.job["id"])
+        await self._edit(
+            f"✅ **تم إرسال الإعلان بنجاح!**\n\n"
+            f"📊 **النتائج:**\n"
+            f"✅ الناجح: {totals['sent']:,}\n"
+            f"🚫 محظور/غير موجود: {totals['blocked']:,}\n"
+            f"❌ الفاشل: {totals['failed']:,}\n"
+            f"📈 الإجمالي: {totals['total']:,}\n"
+            f"⏱️ المدة: {totals['seconds']} ثانية ({totals['per_second']} رسالة/ثانية)\n\n"
+            f"💡 **محتوى الإعلان:**\n"
+            f"{self.job['text'][:100]}..."
+        )
+        # تسجيل الإعلان في قاعدة البيانات
+        await adb.create_ad("إعلان جماعي من المشرف", self.job["text"], "text", self.job["created_by"])
+        return totals
+
+class BroadcastManager:
+    """مهام الإعلان الجارية في الخلفية (خارج محادثات المعالجات)"""
+    
+    def __init__(self):
+        self.running: Dict[int, Tuple[BroadcastJobRunner, asyncio.Task]] = {}
+    
+    def start(self, bot, job: Dict) -> asyncio.Task:
+        """تشغيل مهمة في الخلفية"""
+        runner = BroadcastJobRunner(bot, job)
+        task = asyncio.get_running_loop().create_task(runner.run())
+        self.running[job["id"]] = (runner, task)
+        task.add_done_callback(lambda _: self.running.pop(job["id"], None))
+        return task
+    
+    async def create(self, bot, text: str, created_by: int, chat_id: int, message_id: int) -> Optional[int]:
+        """حفظ مهمة جديدة وتشغيلها"""
+        job_id = await adb.create_broadcast_job(text, 'Markdown', created_by, chat_id, message_id)
+        if job_id:
+            self.start(bot, await adb.get_broadcast_job(job_id))
+        return job_id
+    
+    async def resume_all(self, bot) -> int:
+        """استئناف المهام غير المكتملة بعد إعادة التشغيل"""
+        jobs = [job for job in await adb.get_unfinished_broadcasts() if job["id"] not in self.running]
+        for job in jobs:
+            logger.info(f"استئناف الإعلان {job['id']} من المستخدم {job['cursor_user_id']}")
+            self.start(bot, job)
+        return len(jobs)
+    
+    async def stop_all(self, timeout: float = None):
+        """إيقاف مرتب: الطلبات الجارية تكتمل ويحفظ التقدم، ثم إلغاء ما تجاوز المهلة"""
+        if not self.running:
+            return
+        for runner, _ in self.running.values():
+            runner.engine.stop()
+        tasks = [task for _, task in self.running.values()]
+        _, late = await asyncio.wait(tasks, timeout=timeout or Config.BROADCAST["stop_timeout"])
+        for task in late:
+            task.cancel()
+        await asyncio.gather(*late, return_exceptions=True)
+
+broadcasts = BroadcastManager()
+deliveries = DeliveryTracker()
+
+# ==================== قوالب القوائم ====================
+class ScreenTemplate:
+    """نص شاشة مترجم مرة واحدة: أجزاء ثابتة وفتحات {name} تملأ عند العرض"""
+    
+    SLOT = re.compile(r"\{(\w+)\}")
+    
+    def __init__(self, text: str):
+        # الفهارس الزوجية نص ثابت والفردية أسماء الفتحات
+        self.parts = self.SLOT.split(text)
+    
+    def render(self, **values) -> str:
+        if len(self.parts) == 1:
+            return self.parts[0]
+        parts = list(self.parts)
+        for index in range(1, len(parts), 2):
+            parts[index] = str(values[parts[index]])
+        return "".join(parts)
+
+class Menus:
+    """الشاشات الثابتة تبنى مرة واحدة عند التحميل، وما يتغير (الاسم والرصيد) فتحات
+    
+    قيم Config تدخل في النص عند الترجمة. لوحات الأزرار غير قابلة للتعديل في
+    المكتبة فتبنى مرة لكل نسخة (مشرف أو مستخدم) ويعاد استخدامها.
+    """
+    
+    WELCOME = ScreenTemplate(f"""
+            🎉 **أهلاً وسهلاً بك {{first_name}}!**
             
             🤖 **بوت خدمات رقمية متكامل**
             📊 **بنظام النقاط المميز**
@@ -1428,17 +4554,189 @@ class BotHandlers:
             • 💰 نظام نقاط متكامل
             
             استخدم الأزرار أدناه للتنقل 👇
-            """
-        else:
-            welcome_message = f"""
-            👋 **مرحباً بعودتك {user.first_name}!**
+            """)
+    
+    WELCOME_BACK = ScreenTemplate("""
+            👋 **مرحباً بعودتك {first_name}!**
             
-            💰 **رصيدك الحالي:** {user_data['points']} نقطة
+            💰 **رصيدك الحالي:** {points} نقطة
             
             استخدم الأزرار أدناه للوصول للخدمات 👇
-            """
+            """)
+    
+    TOOLS = ScreenTemplate("""
+        🛠️ **الأدوات اليومية المجانية**
+        
+        **اختر الأداة التي تحتاجها:**
+        
+        🧾 **حاسبة الأقساط**
+        • احسب أقساط القروض
+        • مع الفوائد والمدة
+        
+        💰 **حاسبة الأرباح**
+        • احسب أرباح الاستثمارات
+        • فائدة بسيطة ومركبة
+        
+        💱 **تحويل العملات**
+        • بين جميع العملات العالمية
+        • أسعار محدثة
+        
+        📏 **تحويل الوحدات**
+        • بيانات: KB, MB, GB, TB
+        • أطوال: سم, متر, كيلومتر
+        • أوزان: جرام, كيلو, طن
+        • حرارة: مئوية, فهرنهايت
+        
+        ⏰ **حساب العمر**
+        • احسب عمرك بالتفصيل
+        • تاريخ الميلاد القادم
+        • البرج الفلكي
+        
+        📅 **حساب التاريخ**
+        • أضف أو اطرح أيام
+        • احسب الفرق بين تاريخين
+        
+        🎲 **أدوات عشوائية**
+        • توليد أرقام عشوائية
+        • اختيار عشوائي من قائمة
+        • عملة عشوائية
+        
+        **جميع الأدوات مجانية!** 🎉
+        """)
+    
+    HELP = ScreenTemplate("""
+        ❓ **مساعدة - Malik Services Bot**
+        
+        **🤖 عن البوت:**
+        بوت خدمات رقمية متكامل يقدم خدمات متنوعة مع نظام نقاط مميز.
+        
+        **💎 نظام النقاط:**
+        • الترحيب: +5 نقاط
+        • الإعلانات: +3 نقاط كل 5 دقائق
+        • الإحالة: +10 نقاط لكل صديق
+        • الألعاب: 2-15 نقطة حسب اللعبة
+        • اليومية: 5-20 نقطة كل 24 ساعة
+        
+        **📄 خدمات PDF:**
+        • تحويل نص إلى PDF: 0.5 نقطة
+        • دمج ملفات PDF: 1.0 نقطة لكل ملف
+        • ضغط PDF: 0.3 نقطة
+        • معلومات PDF: مجاناً
+        
+        **🛠️ الأدوات اليومية:**
+        • جميع الأدوات مجانية
+        • حاسبات متنوعة
+        • تحويل وحدات وعملات
+        • أدوات تاريخ ووقت
+        
+        **🎮 الألعاب:**
+        • تخمين الأرقام
+        • لعبة XO
+        • أسئلة عامة
+        • رياضيات سريعة
+        
+        **📢 الإعلانات:**
+        • مشاهدة إعلانات لكسب النقاط
+        • إعلانات متنوعة
+        • روابط مفيدة
+        
+        **👑 المشرفين:**
+        • إدارة كاملة للنظام
+        • إحصائيات مفصلة
+        • إرسال إعلانات
+        
+        **📞 الدعم:**
+        للاستفسارات أو المشاكل:
+        • راسل المطور: @S_1S2
+        • تقارير الأخطاء: /report
+        
+        **🔄 الأوامر الرئيسية:**
+        /start - بدء البوت
+        /help - هذه الرسالة
+        /points - رصيد النقاط
+        /pdf - خدمات PDF
+        /tools - أدوات يومية
+        /games - الألعاب
+        /ads - الإعلانات
+        
+        **💡 نصائح:**
+        • اكسب نقاط يومياً
+        • شارك البوت مع أصدقائك
+        • استخدم جميع الخدمات
+        • تابع الإعلانات الجديدة
+        
+        **🔒 الخصوصية:**
+        • نحن نحترم خصوصيتك
+        • لا نشارك بياناتك
+        • جميع المعاملات آمنة
+        
+        شكراً لاستخدامك Malik Services Bot! 🚀
+        """)
+    
+    GAMES = ScreenTemplate(f"""
+        🎮 **قاعة الألعاب**
+        
+        💰 **رصيدك الحالي:** {{points}} نقطة
+        
+        **الألعاب المتاحة:**
         
-        # لوحة المفاتيح الرئيسية
+        🎲 **تخمين الأرقام**
+        • خمن الرقم بين 1 و 100
+        • مكافأة: 5-20 نقطة
+        
+        ❌⭕ **لعبة XO**
+        • ضد الذكاء الاصطناعي
+        • مكافأة الفوز: 10 نقطة
+        
+        ❓ **لعبة الأسئلة**
+        • أسئلة عامة
+        • مكافأة الإجابة الصحيحة: 5 نقطة
+        
+        🎯 **لعبة الرياضيات**
+        • مسائل حسابية سريعة
+        • مكافأة: 2-10 نقاط
+        
+        🃏 **لعبة الورق**
+        • ضد الذكاء الاصطناعي
+        • مكافأة الفوز: 15 نقطة
+        
+        🎁 **المكافأة اليومية**
+        • احصل على نقاط مجانية
+        • مرة كل 24 ساعة
+        
+        **المكافآت:** {Config.POINTS['game_min']}-{Config.POINTS['game_max']} نقطة لكل لعبة
+        """)
+    
+    PDF = ScreenTemplate(f"""
+        📄 **خدمات تحويل ومعالجة PDF**
+        
+        💰 **رصيدك الحالي:** {{points}} نقطة
+        
+        **الخدمات المتاحة:**
+        
+        📝 **تحويل نص إلى PDF**
+        • تكلفة: {Config.POINTS['pdf_conversion']} نقطة
+        • الحد الأقصى: {Config.PDF_SETTINGS['max_text_length']} حرف
+        
+        🔗 **دمج ملفات PDF**
+        • تكلفة: {Config.POINTS['pdf_merge']} نقطة لكل ملف
+        • الحد الأقصى: 5 ملفات
+        
+        📉 **ضغط ملف PDF**
+        • تكلفة: {Config.POINTS['pdf_compress']} نقطة
+        • تقليل الحجم حتى 70%
+        
+        🔢 **معرفة معلومات PDF**
+        • مجاناً
+        • عدد الصفحات، الحجم، وغيرها
+        
+        **للتحويل:** اختر الخدمة ثم أرسل النص أو الملف
+        """)
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def main_keyboard(admin: bool = False) -> InlineKeyboardMarkup:
+        """القائمة الرئيسية (admin تضيف زر لوحة المشرف)"""
         keyboard = [
             [InlineKeyboardButton("💰 نقاطي والإحالة", callback_data="points_menu")],
             [
@@ -1451,13 +4749,143 @@ class BotHandlers:
             ]
         ]
         
-        # إضافة زر المشرف إذا كان مستخدمًا
-        if user.id in Config.ADMIN_IDS:
+        # زر المشرف في نسخة المشرفين فقط
+        if admin:
             keyboard.append([InlineKeyboardButton("👑 لوحة المشرف", callback_data="admin_menu")])
         
         keyboard.append([InlineKeyboardButton("❓ المساعدة", callback_data="help_menu")])
+        return InlineKeyboardMarkup(keyboard)
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def tools_keyboard() -> InlineKeyboardMarkup:
+        """قائمة الأدوات"""
+        keyboard = [
+            [
+                InlineKeyboardButton("🧾 حاسبة الأقساط", callback_data="tool_installment"),
+                InlineKeyboardButton("💰 حاسبة الأرباح", callback_data="tool_profit")
+            ],
+            [
+                InlineKeyboardButton("💱 تحويل عملات", callback_data="tool_currency"),
+                InlineKeyboardButton("📏 تحويل وحدات", callback_data="tool_units")
+            ],
+            [
+                InlineKeyboardButton("⏰ حساب العمر", callback_data="tool_age"),
+                InlineKeyboardButton("📅 حساب التاريخ", callback_data="tool_date")
+            ],
+            [
+                InlineKeyboardButton("🎲 أدوات عشوائية", callback_data="tool_random"),
+                InlineKeyboardButton("🔢 آلة حاسبة", callback_data="tool_calculator")
+            ],
+            [InlineKeyboardButton("🔙 الرئيسية", callback_data="main_menu")]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def help_keyboard() -> InlineKeyboardMarkup:
+        """قائمة المساعدة"""
+        keyboard = [
+            [
+                InlineKeyboardButton("📚 الدليل الكامل", url="https://example.com/guide"),
+                InlineKeyboardButton("📞 تواصل مع الدعم", url="https://t.me/S_1S2")
+            ],
+            [
+                InlineKeyboardButton("🐛 تقرير خطأ", callback_data="report_bug"),
+                InlineKeyboardButton("💡 اقتراح", callback_data="suggest_feature")
+            ],
+            [InlineKeyboardButton("🔙 الرئيسية", callback_data="main_menu")]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def games_keyboard() -> InlineKeyboardMarkup:
+        """قائمة الألعاب"""
+        keyboard = [
+            [
+                InlineKeyboardButton("🎲 تخمين الأرقام", callback_data="game_numbers"),
+                InlineKeyboardButton("❌⭕ لعبة XO", callback_data="game_xo")
+            ],
+            [
+                InlineKeyboardButton("❓ لعبة الأسئلة", callback_data="game_quiz"),
+                InlineKeyboardButton("🎯 لعبة الرياضيات", callback_data="game_math")
+            ],
+            [
+                InlineKeyboardButton("🎁 المكافأة اليومية", callback_data="daily_reward"),
+                InlineKeyboardButton("🏆 إحصائيات الألعاب", callback_data="game_stats")
+            ],
+            [InlineKeyboardButton("🔙 الرئيسية", callback_data="main_menu")]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def pdf_keyboard() -> InlineKeyboardMarkup:
+        """قائمة PDF"""
+        keyboard = [
+            [
+                InlineKeyboardButton("📝 نص إلى PDF", callback_data="pdf_text"),
+                InlineKeyboardButton("🔗 دمج PDF", callback_data="pdf_merge")
+            ],
+            [
+                InlineKeyboardButton("📉 ضغط PDF", callback_data="pdf_compress"),
+                InlineKeyboardButton("🔢 معلومات PDF", callback_data="pdf_info")
+            ],
+            [
+                InlineKeyboardButton("📋 سجل الملفات", callback_data="pdf_history"),
+                InlineKeyboardButton("⚙️ إعدادات", callback_data="pdf_settings")
+            ],
+            [InlineKeyboardButton("🔙 الرئيسية", callback_data="main_menu")]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+
+# ==================== معالجات البوت ====================
+class BotHandlers:
+    """جميع معالجات البوت"""
+    
+    # حالات المحادثة
+    (WAITING_FOR_PDF_TEXT, WAITING_FOR_TOOL_INPUT, WAITING_FOR_GAME_INPUT,
+     WAITING_FOR_ADMIN_BROADCAST, WAITING_FOR_ADMIN_ADD_POINTS) = range(5)
+    
+    @staticmethod
+    async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """معالجة أمر /start"""
+        user = update.effective_user
+        logger.info(f"مستخدم جديد: {user.id} - {user.username}")
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # التحقق من وجود محيل
+        referred_by = None
+        if context.args:
+            referral_code = context.args[0]
+            referred_by = await adb.get_user_id_by_referral_code(referral_code)
+            if referred_by == user.id:
+                referred_by = None
+        
+        # التحقق من وجود المستخدم
+        user_data = await adb.get_user(user.id)
+        
+        if not user_data:
+            # إنشاء مستخدم جديد
+            user_data = await adb.create_user(
+                user.id, 
+                user.username or "", 
+                user.first_name, 
+                user.last_name or "",
+                referred_by
+            )
+            
+            welcome_message = Menus.WELCOME.render(first_name=user.first_name)
+        else:
+            if user_data.get('delivery_state', 'ok') != 'ok':
+                # ألغى حظر البوت: يعود لجمهور الإعلانات
+                await adb.mark_reachable(user.id)
+            welcome_message = Menus.WELCOME_BACK.render(
+                first_name=user.first_name, points=format_points(user_data['points'])
+            )
+        
+        # لوحة المفاتيح الرئيسية (نسخة المشرفين فيها زر اللوحة)
+        reply_markup = Menus.main_keyboard(user.id in Config.ADMIN_IDS)
         
         # إرسال الصورة الترحيبية (اختياري)
         try:
@@ -1474,9 +4902,6 @@ class BotHandlers:
                 parse_mode='Markdown'
             )
         
-        # تحديث الإحصائيات
-        db.update_daily_stats()
-        
         return ConversationHandler.END
     
     @staticmethod
@@ -1486,13 +4911,13 @@ class BotHandlers:
         await query.answer()
         
         user = update.effective_user
-        user_data = db.get_user(user.id)
+        user_data = await adb.get_user(user.id)
         
         if not user_data:
             await query.edit_message_text("❌ لم يتم العثور على حسابك. استخدم /start أولاً")
             return
         
-        stats = db.get_user_stats(user.id)
+        stats = await adb.get_user_stats(user.id)
         
         message = f"""
         💰 **رصيد النقاط والإحالة**
@@ -1500,9 +4925,9 @@ class BotHandlers:
         👤 **المستخدم:** {user_data['first_name']}
         🆔 **ID:** `{user_data['user_id']}`
         
-        ⭐ **النقاط الحالية:** `{user_data['points']}`
-        📊 **نقاط اليوم:** `{stats['today_points']}`
-        📈 **نقاط الأسبوع:** `{stats['week_points']}`
+        ⭐ **النقاط الحالية:** `{format_points(user_data['points'])}`
+        📊 **نقاط اليوم:** `{format_points(stats['today_points'])}`
+        📈 **نقاط الأسبوع:** `{format_points(stats['week_points'])}`
         
         👥 **الإحالات:** `{stats.get('referrals_count', 0)}`
         🏆 **الترتيب:** `#{stats.get('rank', 0)}`
@@ -1514,7 +4939,7 @@ class BotHandlers:
         • 🎁 المكافأة اليومية (+{Config.POINTS['daily_min']}-{Config.POINTS['daily_max']} نقطة)
         
         📥 **كود الإحالة:** `{user_data['referral_code']}`
-        🔗 **رابط الإحالة:** `https://t.me/{(await context.bot.get_me()).username}?start={user_data['referral_code']}`
+        🔗 **رابط الإحالة:** `{user_data.get('referral_link') or bot_identity.referral_link(user_data['referral_code'])}`
         """
         
         keyboard = [
@@ -1541,6 +4966,43 @@ class BotHandlers:
             parse_mode='Markdown'
         )
     
+    @staticmethod
+    async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """لوحة المتصدرين"""
+        query = update.callback_query
+        await query.answer()
+        
+        user = update.effective_user
+        board = await adb.get_leaderboard(user.id)
+        medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+        
+        message = "🏆 **لوحة المتصدرين**\n\n"
+        for entry in board["top"]:
+            marker = medals.get(entry["position"], f"{entry['position']}.")
+            name = escape_markdown(entry['first_name'] or "", version=1)
+            message += f"{marker} {name} - `{format_points(entry['points'])}` نقطة\n"
+        
+        if board["rank"] and board["rank"] > len(board["top"]):
+            message += "\n📍 **موقعك:**\n"
+            for entry in board["around"]:
+                pointer = "👉 " if entry["user_id"] == user.id else ""
+                name = escape_markdown(entry['first_name'] or "", version=1)
+                message += f"{pointer}{entry['position']}. {name} - `{format_points(entry['points'])}` نقطة\n"
+        
+        if board["rank"]:
+            message += f"\n🏅 **ترتيبك:** #{board['rank']} من {board['total']}"
+        
+        keyboard = [
+            [InlineKeyboardButton("🔄 تحديث", callback_data="leaderboard")],
+            [InlineKeyboardButton("🔙 رجوع", callback_data="points_menu")]
+        ]
+        
+        await query.edit_message_text(
+            message,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode='Markdown'
+        )
+    
     @staticmethod
     async def daily_reward(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """المكافأة اليومية"""
@@ -1548,7 +5010,7 @@ class BotHandlers:
         await query.answer()
         
         user = update.effective_user
-        user_data = db.get_user(user.id)
+        user_data = await adb.get_user(user.id)
         
         if not user_data:
             await query.edit_message_text("❌ لم يتم العثور على حسابك")
@@ -1566,7 +5028,7 @@ class BotHandlers:
                 f"⏳ **المكافأة اليومية**\n\n"
                 f"لقد حصلت على المكافأة اليومية بالفعل!\n"
                 f"⏰ عد بعد: {hours:02d}:{minutes:02d}:{seconds:02d}\n\n"
-                f"💰 رصيدك الحالي: {user_data['points']} نقطة",
+                f"💰 رصيدك الحالي: {format_points(user_data['points'])} نقطة",
                 parse_mode='Markdown'
             )
             return
@@ -1577,18 +5039,18 @@ class BotHandlers:
             Config.POINTS["daily_max"]
         )
         
-        db.add_points(
+        await ledger.add_points(
             user.id,
-            reward,
+            to_milli(reward),
             "daily",
             "المكافأة اليومية"
         )
         
         # تحديث وقت المكافأة
-        db.update_user(user.id, last_daily=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        await adb.update_user(user.id, last_daily=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
         
         # الحصول على الرصيد الجديد
-        user_data = db.get_user(user.id)
+        user_data = await adb.get_user(user.id)
         
         message = f"""
         🎁 **المكافأة اليومية**
@@ -1596,7 +5058,7 @@ class BotHandlers:
         🎉 مبروك! لقد حصلت على مكافأتك اليومية!
         
         💰 **المكافأة:** +{reward} نقطة
-        📊 **رصيدك الجديد:** {user_data['points']} نقطة
+        📊 **رصيدك الجديد:** {format_points(user_data['points'])} نقطة
         
         ⏳ عد بعد 24 ساعة لمكافأة جديدة!
         
@@ -1629,7 +5091,7 @@ class BotHandlers:
         await query.answer()
         
         user = update.effective_user
-        user_data = db.get_user(user.id)
+        user_data = await adb.get_user(user.id)
         
         if not user_data:
             await query.edit_message_text("❌ لم يتم العثور على حسابك")
@@ -1646,13 +5108,13 @@ class BotHandlers:
                 f"⏳ **مشاهدة الإعلانات**\n\n"
                 f"يمكنك مشاهدة إعلان آخر بعد:\n"
                 f"⏰ {minutes:02d}:{seconds:02d}\n\n"
-                f"💰 رصيدك الحالي: {user_data['points']} نقطة",
+                f"💰 رصيدك الحالي: {format_points(user_data['points'])} نقطة",
                 parse_mode='Markdown'
             )
             return
         
         # الحصول على إعلان
-        ad = db.get_available_ad(user.id)
+        ad = await adb.get_available_ad(user.id)
         
         if not ad:
             await query.edit_message_text(
@@ -1734,33 +5196,29 @@ class BotHandlers:
         ad_id = int(query.data.split('_')[-1])
         
         # تسجيل مشاهدة الإعلان
-        ad = db.cursor.execute(
-            "SELECT * FROM ads WHERE id = ?",
-            (ad_id,)
-        ).fetchone()
+        ad = await adb.get_ad(ad_id)
         
         if ad:
-            ad = dict(ad)
             points = ad.get('points', Config.POINTS['ad_view'])
             
             # منح النقاط
-            db.add_points(user.id, points, "ad_view", f"مشاهدة إعلان: {ad['title']}")
+            await ledger.add_points(user.id, to_milli(points), "ad_view", f"مشاهدة إعلان: {ad['title']}")
             
             # تسجيل المشاهدة
-            db.record_ad_view(user.id, ad_id, clicked=False)
+            await adb.record_ad_view(user.id, ad_id, clicked=False)
             
             # تحديث وقت آخر إعلان
-            db.update_user(user.id, last_ad=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            await adb.update_user(user.id, last_ad=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
             
             # الحصول على الرصيد الجديد
-            user_data = db.get_user(user.id)
+            user_data = await adb.get_user(user.id)
             
             message = f"""
             ✅ **شكراً لمشاهدة الإعلان**
             
             🎁 **تمت إضافة {points} نقطة إلى رصيدك!**
             
-            💰 **رصيدك الجديد:** {user_data['points']} نقطة
+            💰 **رصيدك الجديد:** {format_points(user_data['points'])} نقطة
             
             📢 **عنوان الإعلان:** {ad['title']}
             
@@ -1789,55 +5247,14 @@ class BotHandlers:
         await query.answer()
         
         user = update.effective_user
-        user_data = db.get_user(user.id)
+        user_data = await adb.get_user(user.id)
         
         if not user_data:
             await query.edit_message_text("❌ لم يتم العثور على حسابك")
-            return
-        
-        message = f"""
-        📄 **خدمات تحويل ومعالجة PDF**
-        
-        💰 **رصيدك الحالي:** {user_data['points']} نقطة
-        
-        **الخدمات المتاحة:**
-        
-        📝 **تحويل نص إلى PDF**
-        • تكلفة: {Config.POINTS['pdf_conversion']} نقطة
-        • الحد الأقصى: {Config.PDF_SETTINGS['max_text_length']} حرف
-        
-        🔗 **دمج ملفات PDF**
-        • تكلفة: {Config.POINTS['pdf_merge']} نقطة لكل ملف
-        • الحد الأقصى: 5 ملفات
-        
-        📉 **ضغط ملف PDF**
-        • تكلفة: {Config.POINTS['pdf_compress']} نقطة
-        • تقليل الحجم حتى 70%
-        
-        🔢 **معرفة معلومات PDF**
-        • مجاناً
-        • عدد الصفحات، الحجم، وغيرها
-        
-        **للتحويل:** اختر الخدمة ثم أرسل النص أو الملف
-        """
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("📝 نص إلى PDF", callback_data="pdf_text"),
-                InlineKeyboardButton("🔗 دمج PDF", callback_data="pdf_merge")
-            ],
-            [
-                InlineKeyboardButton("📉 ضغط PDF", callback_data="pdf_compress"),
-                InlineKeyboardButton("🔢 معلومات PDF", callback_data="pdf_info")
-            ],
-            [
-                InlineKeyboardButton("📋 سجل الملفات", callback_data="pdf_history"),
-                InlineKeyboardButton("⚙️ إعدادات", callback_data="pdf_settings")
-            ],
-            [InlineKeyboardButton("🔙 الرئيسية", callback_data="main_menu")]
-        ]
+            return
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        message = Menus.PDF.render(points=format_points(user_data['points']))
+        reply_markup = Menus.pdf_keyboard()
         
         await query.edit_message_text(
             message,
@@ -1852,18 +5269,18 @@ class BotHandlers:
         await query.answer()
         
         user = update.effective_user
-        user_data = db.get_user(user.id)
+        user_data = await adb.get_user(user.id)
         
         if not user_data:
             await query.edit_message_text("❌ لم يتم العثور على حسابك")
             return
         
         # التحقق من الرصيد
-        if user_data['points'] < Config.POINTS['pdf_conversion']:
+        if user_data['points'] < to_milli(Config.POINTS['pdf_conversion']):
             await query.edit_message_text(
                 f"❌ **نقاطك غير كافية**\n\n"
                 f"تحتاج {Config.POINTS['pdf_conversion']} نقطة\n"
-                f"رصيدك الحالي: {user_data['points']} نقطة\n\n"
+                f"رصيدك الحالي: {format_points(user_data['points'])} نقطة\n\n"
                 f"💡 اكسب نقاط عن طريق:\n"
                 f"• مشاهدة الإعلانات\n"
                 f"• إحالة الأصدقاء\n"
@@ -1901,15 +5318,14 @@ class BotHandlers:
             )
             return BotHandlers.WAITING_FOR_PDF_TEXT
         
-        user_data = db.get_user(user.id)
-        
-        # خصم النقاط
-        if not db.deduct_points(
+        # خصم النقاط (تحقق وخصم ذري يعيد الرصيد الجديد)
+        new_balance = await ledger.debit_points(
             user.id,
-            Config.POINTS['pdf_conversion'],
+            to_milli(Config.POINTS['pdf_conversion']),
             "pdf_conversion",
             "تحويل نص إلى PDF"
-        ):
+        )
+        if new_balance is None:
             await update.message.reply_text("❌ خطأ في خصم النقاط!")
             return ConversationHandler.END
         
@@ -1930,14 +5346,10 @@ class BotHandlers:
             )
             
             # تسجيل الملف في قاعدة البيانات
-            db.cursor.execute(
-                """INSERT INTO files 
-                (user_id, file_name, file_type, file_size, operation_type, points_cost) 
-                VALUES (?, ?, ?, ?, ?, ?)""",
-                (user.id, f"document_{user.id}.pdf", "pdf", 
-                 len(pdf_file.getvalue()), "text_to_pdf", Config.POINTS['pdf_conversion'])
+            await adb.record_file(
+                user.id, f"document_{user.id}.pdf", "pdf",
+                len(pdf_file.getvalue()), "text_to_pdf", to_milli(Config.POINTS['pdf_conversion'])
             )
-            db.conn.commit()
             
             # حذف رسالة المعالجة
             await processing_msg.delete()
@@ -1949,7 +5361,7 @@ class BotHandlers:
                        f"📄 **اسم الملف:** مستند_{user.first_name}.pdf\n"
                        f"📏 **حجم الملف:** {len(pdf_file.getvalue()) / 1024:.1f} كيلوبايت\n"
                        f"💰 **التكلفة:** {Config.POINTS['pdf_conversion']} نقطة\n"
-                       f"💎 **رصيدك الجديد:** {user_data['points'] - Config.POINTS['pdf_conversion']} نقطة\n\n"
+                       f"💎 **رصيدك الجديد:** {format_points(new_balance)} نقطة\n\n"
                        f"شكراً لاستخدامك خدماتنا!",
                 parse_mode='Markdown'
             )
@@ -1964,7 +5376,7 @@ class BotHandlers:
             )
             
             # إرجاع النقاط
-            db.add_points(user.id, Config.POINTS['pdf_conversion'], "refund", "استرجاع نقاط تحويل PDF فاشل")
+            await ledger.add_points(user.id, to_milli(Config.POINTS['pdf_conversion']), "refund", "استرجاع نقاط تحويل PDF فاشل")
         
         return ConversationHandler.END
     
@@ -1974,67 +5386,8 @@ class BotHandlers:
         query = update.callback_query
         await query.answer()
         
-        message = """
-        🛠️ **الأدوات اليومية المجانية**
-        
-        **اختر الأداة التي تحتاجها:**
-        
-        🧾 **حاسبة الأقساط**
-        • احسب أقساط القروض
-        • مع الفوائد والمدة
-        
-        💰 **حاسبة الأرباح**
-        • احسب أرباح الاستثمارات
-        • فائدة بسيطة ومركبة
-        
-        💱 **تحويل العملات**
-        • بين جميع العملات العالمية
-        • أسعار محدثة
-        
-        📏 **تحويل الوحدات**
-        • بيانات: KB, MB, GB, TB
-        • أطوال: سم, متر, كيلومتر
-        • أوزان: جرام, كيلو, طن
-        • حرارة: مئوية, فهرنهايت
-        
-        ⏰ **حساب العمر**
-        • احسب عمرك بالتفصيل
-        • تاريخ الميلاد القادم
-        • البرج الفلكي
-        
-        📅 **حساب التاريخ**
-        • أضف أو اطرح أيام
-        • احسب الفرق بين تاريخين
-        
-        🎲 **أدوات عشوائية**
-        • توليد أرقام عشوائية
-        • اختيار عشوائي من قائمة
-        • عملة عشوائية
-        
-        **جميع الأدوات مجانية!** 🎉
-        """
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("🧾 حاسبة الأقساط", callback_data="tool_installment"),
-                InlineKeyboardButton("💰 حاسبة الأرباح", callback_data="tool_profit")
-            ],
-            [
-                InlineKeyboardButton("💱 تحويل عملات", callback_data="tool_currency"),
-                InlineKeyboardButton("📏 تحويل وحدات", callback_data="tool_units")
-            ],
-            [
-                InlineKeyboardButton("⏰ حساب العمر", callback_data="tool_age"),
-                InlineKeyboardButton("📅 حساب التاريخ", callback_data="tool_date")
-            ],
-            [
-                InlineKeyboardButton("🎲 أدوات عشوائية", callback_data="tool_random"),
-                InlineKeyboardButton("🔢 آلة حاسبة", callback_data="tool_calculator")
-            ],
-            [InlineKeyboardButton("🔙 الرئيسية", callback_data="main_menu")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        message = Menus.TOOLS.render()
+        reply_markup = Menus.tools_keyboard()
         
         await query.edit_message_text(
             message,
@@ -2202,63 +5555,14 @@ class BotHandlers:
         await query.answer()
         
         user = update.effective_user
-        user_data = db.get_user(user.id)
+        user_data = await adb.get_user(user.id)
         
         if not user_data:
             await query.edit_message_text("❌ لم يتم العثور على حسابك")
             return
         
-        message = f"""
-        🎮 **قاعة الألعاب**
-        
-        💰 **رصيدك الحالي:** {user_data['points']} نقطة
-        
-        **الألعاب المتاحة:**
-        
-        🎲 **تخمين الأرقام**
-        • خمن الرقم بين 1 و 100
-        • مكافأة: 5-20 نقطة
-        
-        ❌⭕ **لعبة XO**
-        • ضد الذكاء الاصطناعي
-        • مكافأة الفوز: 10 نقطة
-        
-        ❓ **لعبة الأسئلة**
-        • أسئلة عامة
-        • مكافأة الإجابة الصحيحة: 5 نقطة
-        
-        🎯 **لعبة الرياضيات**
-        • مسائل حسابية سريعة
-        • مكافأة: 2-10 نقاط
-        
-        🃏 **لعبة الورق**
-        • ضد الذكاء الاصطناعي
-        • مكافأة الفوز: 15 نقطة
-        
-        🎁 **المكافأة اليومية**
-        • احصل على نقاط مجانية
-        • مرة كل 24 ساعة
-        
-        **المكافآت:** {Config.POINTS['game_min']}-{Config.POINTS['game_max']} نقطة لكل لعبة
-        """
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("🎲 تخمين الأرقام", callback_data="game_numbers"),
-                InlineKeyboardButton("❌⭕ لعبة XO", callback_data="game_xo")
-            ],
-            [
-                InlineKeyboardButton("❓ لعبة الأسئلة", callback_data="game_quiz"),
-                InlineKeyboardButton("🎯 لعبة الرياضيات", callback_data="game_math")
-            ],
-            [
-                InlineKeyboardButton("🎁 المكافأة اليومية", callback_data="daily_reward"),
-                InlineKeyboardButton("🏆 إحصائيات الألعاب", callback_data="game_stats")
-            ],
-            [InlineKeyboardButton("🔙 الرئيسية", callback_data="main_menu")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        message = Menus.GAMES.render(points=format_points(user_data['points']))
+        reply_markup = Menus.games_keyboard()
         
         await query.edit_message_text(
             message,
@@ -2307,13 +5611,13 @@ class BotHandlers:
                     return BotHandlers.WAITING_FOR_GAME_INPUT
                 
                 # تشغيل اللعبة
-                result = GameManager.number_guessing_game(user.id, guess)
+                result = await adb.run(GameManager.number_guessing_game, user.id, guess)
                 
                 if result['status'] == 'win':
                     # منح النقاط
-                    db.add_points(
+                    await ledger.add_points(
                         user.id,
-                        result['points'],
+                        to_milli(result['points']),
                         "game",
                         f"فوز بلعبة تخمين الأرقام ({result['attempts']} محاولات)"
                     )
@@ -2380,7 +5684,8 @@ class BotHandlers:
             return
         
         # إحصائيات النظام
-        stats = db.get_system_stats()
+        stats = await adb.get_system_stats()
+        cache_stats = db.cache_stats()
         
         message = f"""
         👑 **لوحة مشرف - Malik Services Bot**
@@ -2389,11 +5694,14 @@ class BotHandlers:
         
         👥 **المستخدمين:** {stats.get('total_users', 0)}
         📈 **نشط اليوم:** {stats.get('active_today', 0)}
-        💰 **إجمالي النقاط:** {stats.get('total_points', 0):,.2f}
+        📬 **تصلهم الرسائل:** {stats.get('reachable_users', 0)} (🚫 {stats.get('unreachable_users', 0)} حظروا البوت أو حُذفت حساباتهم)
+        💰 **إجمالي النقاط:** {format_points(stats.get('total_points', 0))}
         🔄 **المعاملات:** {stats.get('total_transactions', 0):,}
         📢 **مشاهدات الإعلانات:** {stats.get('total_ad_views', 0):,}
         🎮 **الألعاب:** {stats.get('total_games', 0):,}
         
+        🗃️ **ذاكرة المستخدمين:** {cache_stats['size']:,} صف - إصابة {cache_stats['hit_rate']}%
+        
         ⚙️ **حالة البوت:** 🟢 نشط
         🕐 **الوقت:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
         
@@ -2436,182 +5744,180 @@ class BotHandlers:
             )
     
     @staticmethod
-    async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """إرسال إعلان جماعي"""
-        query = update.callback_query
-        await query.answer()
-        
+    async def admin_queries(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """أبطأ الاستعلامات حسب الزمن الكلي: /queries [n|reset]"""
         user = update.effective_user
         
         if user.id not in Config.ADMIN_IDS:
-            await query.edit_message_text("❌ هذا الأمر للمشرفين فقط!")
             return
         
-        await query.edit_message_text(
-            "📣 **إرسال إعلان جماعي**\n\n"
-            "أرسل نص الإعلان الآن...\n\n"
-            "💡 **تنسيق الإعلان:**\n"
-            "يمكنك استخدام:\n"
-            "• نص عادي\n"
-            "• Markdown\n"
-            "• مع الصور (أرسلها كملف)\n\n"
-            "⏰ **معلومة:**\n"
-            "سيتم إرسال الإعلان لجميع المستخدمين.\n"
-            "العملية قد تستغرق عدة دقائق.\n\n"
-            "اضغط /cancel للإلغاء"
-        )
+        if context.args and context.args[0] == "reset":
+            await adb.reset_query_stats()
+            await update.message.reply_text("✅ تم تصفير إحصائيات الاستعلامات")
+            return
         
-        return BotHandlers.WAITING_FOR_ADMIN_BROADCAST
+        limit = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+        stats = await adb.query_stats(limit)
+        if not stats:
+            await update.message.reply_text("لا توجد إحصائيات استعلامات بعد.")
+            return
+        
+        lines = ["📈 أعلى الاستعلامات حسب الزمن الكلي\n"]
+        for i, entry in enumerate(stats, 1):
+            lines.append(
+                f"{i}. {entry['total_ms']:,.1f}ms | {entry['calls']:,} مرة | "
+                f"متوسط {entry['avg_ms']}ms | p95 ≤{entry['p95_ms']}ms | أقصى {entry['max_ms']}ms | "
+                f"{entry['rows']:,} صف\n{entry['sql'][:300]}"
+            )
+            if entry["plan"]:
+                lines.append("   ↳ " + "; ".join(entry["plan"]))
+        
+        # نص عادي (بدون Markdown) لأن نص SQL يحوي * و _
+        text = "\n".join(lines)
+        for start in range(0, len(text), 4000):
+            await update.message.reply_text(text[start:start + 4000])
     
     @staticmethod
-    async def handle_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """معالجة الإعلان الجماعي"""
+    async def admin_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """إنشاء نسخة احتياطية فورية"""
+        query = update.callback_query
         user = update.effective_user
         
         if user.id not in Config.ADMIN_IDS:
-            return ConversationHandler.END
+            await query.edit_message_text("❌ هذا الأمر للمشرفين فقط!")
+            return
         
-        broadcast_text = update.message.text
+        await query.edit_message_text("⏳ جاري إنشاء نسخة احتياطية...")
+        result = await asyncio.to_thread(db.backup_database)
+        
+        if result["ok"]:
+            message = (
+                f"✅ **تم إنشاء النسخة الاحتياطية**\n\n"
+                f"📁 `{os.path.basename(result['file'])}`\n"
+                f"📦 الحجم: {result['size_kb']:,} KB (الأصل {result['raw_kb']:,} KB)\n"
+                f"🔒 فحص السلامة: ✅\n"
+                f"🗑️ نسخ قديمة محذوفة: {len(result['removed'])}\n"
+                f"⏱️ المدة: {result['seconds']} ثانية"
+            )
+        else:
+            message = f"❌ **فشل النسخ الاحتياطي**\n\n{result['error']}"
         
-        # إظهار رسالة المعالجة
-        processing_msg = await update.message.reply_text(
-            "⏳ جاري إرسال الإعلان لجميع المستخدمين...\n"
-            "قد تستغرق العملية عدة دقائق"
+        keyboard = [[InlineKeyboardButton("🔙 لوحة المشرف", callback_data="admin_menu")]]
+        await query.edit_message_text(
+            message,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode='Markdown'
         )
+    
+    HISTORY_PAGE_SIZE = 10
+    
+    @staticmethod
+    async def admin_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """سجل معاملات مستخدم للمشرف: /history <user_id> [page]"""
+        query = update.callback_query
+        if query:
+            await query.answer()
+        user = update.effective_user
         
-        # الحصول على جميع المستخدمين
-        users = db.get_all_users()
-        
-        success_count = 0
-        failed_count = 0
-        
-        for user_data in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_data['user_id'],
-                    text=broadcast_text,
-                    parse_mode='Markdown'
-                )
-                success_count += 1
-                
-                # تأخير صغير لمنع rate limiting
-                if success_count % 10 == 0:
-                    await asyncio.sleep(0.1)
-                    
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"فشل إرسال إعلان لـ {user_data['user_id']}: {e}")
+        if user.id not in Config.ADMIN_IDS:
+            return
         
-        # تحديث رسالة المعالجة
-        await processing_msg.edit_text(
-            f"✅ **تم إرسال الإعلان بنجاح!**\n\n"
-            f"📊 **النتائج:**\n"
-            f"✅ الناجح: {success_count}\n"
-            f"❌ الفاشل: {failed_count}\n"
-            f"📈 الإجمالي: {len(users)}\n\n"
-            f"💡 **محتوى الإعلان:**\n"
-            f"{broadcast_text[:100]}..."
-        )
+        try:
+            if query:
+                _, target_id, page = query.data.split("_")
+            else:
+                target_id, page = (context.args + ["1"])[:2]
+            target_id, page = int(target_id), max(1, int(page))
+        except ValueError:
+            await update.effective_message.reply_text("❌ الاستخدام: /history <user_id> [page]")
+            return
         
-        # تسجيل الإعلان في قاعدة البيانات
-        db.cursor.execute(
-            """INSERT INTO ads 
-            (title, content, ad_type, created_by) 
-            VALUES (?, ?, ?, ?)""",
-            ("إعلان جماعي من المشرف", broadcast_text, "text", user.id)
-        )
-        db.conn.commit()
+        page_size = BotHandlers.HISTORY_PAGE_SIZE
+        rows = await adb.get_transactions(target_id, page_size, (page - 1) * page_size)
+        total = await adb.count_transactions(target_id)
+        pages = max(1, math.ceil(total / page_size))
+        
+        message = f"📜 **سجل المعاملات - {target_id}**\n"
+        message += f"📄 الصفحة {page} من {pages} ({total:,} معاملة)\n\n"
+        for row in rows:
+            marker = "🗄️" if row.get("archived") else "•"
+            message += f"{marker} `{str(row['created_at'])[:16]}` {escape_markdown(row['type'], version=1)}: {format_points(row['amount'])}\n"
+        if not rows:
+            message += "لا توجد معاملات في هذه الصفحة."
+        
+        navigation = []
+        if page > 1:
+            navigation.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"history_{target_id}_{page - 1}"))
+        if page < pages:
+            navigation.append(InlineKeyboardButton("التالي ➡️", callback_data=f"history_{target_id}_{page + 1}"))
+        reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
         
-        return ConversationHandler.END
+        if query:
+            await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+        else:
+            await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
     
     @staticmethod
-    async def help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """قائمة المساعدة"""
+    async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """إرسال إعلان جماعي"""
         query = update.callback_query
         await query.answer()
         
-        message = """
-        ❓ **مساعدة - Malik Services Bot**
-        
-        **🤖 عن البوت:**
-        بوت خدمات رقمية متكامل يقدم خدمات متنوعة مع نظام نقاط مميز.
-        
-        **💎 نظام النقاط:**
-        • الترحيب: +5 نقاط
-        • الإعلانات: +3 نقاط كل 5 دقائق
-        • الإحالة: +10 نقاط لكل صديق
-        • الألعاب: 2-15 نقطة حسب اللعبة
-        • اليومية: 5-20 نقطة كل 24 ساعة
-        
-        **📄 خدمات PDF:**
-        • تحويل نص إلى PDF: 0.5 نقطة
-        • دمج ملفات PDF: 1.0 نقطة لكل ملف
-        • ضغط PDF: 0.3 نقطة
-        • معلومات PDF: مجاناً
-        
-        **🛠️ الأدوات اليومية:**
-        • جميع الأدوات مجانية
-        • حاسبات متنوعة
-        • تحويل وحدات وعملات
-        • أدوات تاريخ ووقت
-        
-        **🎮 الألعاب:**
-        • تخمين الأرقام
-        • لعبة XO
-        • أسئلة عامة
-        • رياضيات سريعة
-        
-        **📢 الإعلانات:**
-        • مشاهدة إعلانات لكسب النقاط
-        • إعلانات متنوعة
-        • روابط مفيدة
-        
-        **👑 المشرفين:**
-        • إدارة كاملة للنظام
-        • إحصائيات مفصلة
-        • إرسال إعلانات
+        user = update.effective_user
         
-        **📞 الدعم:**
-        للاستفسارات أو المشاكل:
-        • راسل المطور: @S_1S2
-        • تقارير الأخطاء: /report
+        if user.id not in Config.ADMIN_IDS:
+            await query.edit_message_text("❌ هذا الأمر للمشرفين فقط!")
+            return
         
-        **🔄 الأوامر الرئيسية:**
-        /start - بدء البوت
-        /help - هذه الرسالة
-        /points - رصيد النقاط
-        /pdf - خدمات PDF
-        /tools - أدوات يومية
-        /games - الألعاب
-        /ads - الإعلانات
+        await query.edit_message_text(
+            "📣 **إرسال إعلان جماعي**\n\n"
+            "أرسل نص الإعلان الآن...\n\n"
+            "💡 **تنسيق الإعلان:**\n"
+            "يمكنك استخدام:\n"
+            "• نص عادي\n"
+            "• Markdown\n"
+            "• مع الصور (أرسلها كملف)\n\n"
+            "⏰ **معلومة:**\n"
+            "سيتم إرسال الإعلان لجميع المستخدمين.\n"
+            "العملية قد تستغرق عدة دقائق.\n\n"
+            "اضغط /cancel للإلغاء"
+        )
         
-        **💡 نصائح:**
-        • اكسب نقاط يومياً
-        • شارك البوت مع أصدقائك
-        • استخدم جميع الخدمات
-        • تابع الإعلانات الجديدة
+        return BotHandlers.WAITING_FOR_ADMIN_BROADCAST
+    
+    @staticmethod
+    async def handle_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """معالجة الإعلان الجماعي"""
+        user = update.effective_user
         
-        **🔒 الخصوصية:**
-        • نحن نحترم خصوصيتك
-        • لا نشارك بياناتك
-        • جميع المعاملات آمنة
+        if user.id not in Config.ADMIN_IDS:
+            return ConversationHandler.END
         
-        شكراً لاستخدامك Malik Services Bot! 🚀
-        """
+        broadcast_text = update.message.text
+        audience = await adb.count_audience()
         
-        keyboard = [
-            [
-                InlineKeyboardButton("📚 الدليل الكامل", url="https://example.com/guide"),
-                InlineKeyboardButton("📞 تواصل مع الدعم", url="https://t.me/S_1S2")
-            ],
-            [
-                InlineKeyboardButton("🐛 تقرير خطأ", callback_data="report_bug"),
-                InlineKeyboardButton("💡 اقتراح", callback_data="suggest_feature")
-            ],
-            [InlineKeyboardButton("🔙 الرئيسية", callback_data="main_menu")]
-        ]
+        processing_msg = await update.message.reply_text(
+            f"⏳ جاري إرسال الإعلان لـ {audience['reachable']:,} مستخدم تصلهم الرسائل...\n"
+            f"(يُتخطى {audience['unreachable']:,} حظروا البوت أو حُذفت حساباتهم)\n"
+            "يمكنك متابعة استخدام البوت أثناء الإرسال"
+        )
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # مهمة محفوظة تعمل في الخلفية وتستأنف بعد إعادة التشغيل
+        job_id = await broadcasts.create(
+            context.bot, broadcast_text, user.id, processing_msg.chat_id, processing_msg.message_id
+        )
+        if not job_id:
+            await processing_msg.edit_text("❌ تعذر إنشاء مهمة الإعلان!")
+        return ConversationHandler.END
+    
+    @staticmethod
+    async def help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """قائمة المساعدة"""
+        query = update.callback_query
+        await query.answer()
+        
+        message = Menus.HELP.render()
+        reply_markup = Menus.help_keyboard()
         
         await query.edit_message_text(
             message,
@@ -2641,6 +5947,7 @@ class BotHandlers:
         handlers = {
             "main_menu": BotHandlers.start,
             "points_menu": BotHandlers.points_menu,
+            "leaderboard": BotHandlers.leaderboard,
             "daily_reward": BotHandlers.daily_reward,
             "view_ad": BotHandlers.view_advertisement,
             "ads_menu": BotHandlers.view_advertisement,
@@ -2653,6 +5960,7 @@ class BotHandlers:
             "game_numbers": BotHandlers.number_guessing_game,
             "admin_menu": BotHandlers.admin_menu,
             "admin_broadcast": BotHandlers.admin_broadcast,
+            "admin_backup": BotHandlers.admin_backup,
             "help_menu": BotHandlers.help_menu,
         }
         
@@ -2661,9 +5969,13 @@ class BotHandlers:
             await BotHandlers.ad_watched(update, context)
             return
         
-        # استدعاء المعالج المناسب
+        if data.startswith("history_"):
+            await BotHandlers.admin_history(update, context)
+            return
+        
+        # استدعاء المعالج المناسب (مع حالة المحادثة التي يعيدها، مثل انتظار نص PDF)
         if data in handlers:
-            await handlers[data](update, context)
+            return await handlers[data](update, context)
         else:
             await query.edit_message_text(
                 "❌ **زر غير معروف**\n\n"
@@ -2705,6 +6017,1214 @@ class BotHandlers:
             remaining = Config.TIME_LIMITS['ad_cooldown'] - elapsed
             return False, int(remaining)
 
+# ==================== المهام المجدولة ====================
+class ScheduledJobs:
+    """مهام الخلفية المسجلة في JobQueue"""
+    
+    @staticmethod
+    async def flush_daily_stats(context: ContextTypes.DEFAULT_TYPE):
+        """حفظ عدادات الإحصائيات اليومية"""
+        await adb.flush_daily_stats()
+    
+    @staticmethod
+    async def flush_ad_views(context: ContextTypes.DEFAULT_TYPE):
+        """حفظ مشاهدات ونقرات الإعلانات المجمعة"""
+        await adb.flush_ad_views()
+    
+    @staticmethod
+    async def compact_history(context: ContextTypes.DEFAULT_TYPE):
+        """ضغط السجلات القديمة خارج الذروة"""
+        for shard in db.shards:
+            await HistoryCompactor(shard).run()
+    
+    @staticmethod
+    async def resume_broadcasts(context: ContextTypes.DEFAULT_TYPE):
+        """استئناف الإعلانات التي قطعها إيقاف أو توقف مفاجئ"""
+        resumed = await broadcasts.resume_all(context.bot)
+        if resumed:
+            logger.info(f"تم استئناف {resumed} إعلان جماعي")
+    
+    @staticmethod
+    async def backup_database(context: ContextTypes.DEFAULT_TYPE):
+        """نسخة احتياطية دورية على خيط عامل (خارج خيط قاعدة البيانات)"""
+        await asyncio.to_thread(db.backup_database)
+    
+    @staticmethod
+    async def reconcile_daily_stats(context: ContextTypes.DEFAULT_TYPE):
+        """إعادة الحساب الدقيق للإحصائيات خارج الذروة"""
+        if await adb.reconcile_daily_stats():
+            logger.info("تمت مطابقة الإحصائيات اليومية")
+    
+    @staticmethod
+    def register(application: Application):
+        """تسجيل جميع المهام الدورية"""
+        job_queue = application.job_queue
+        job_queue.run_repeating(
+            ScheduledJobs.flush_daily_stats,
+            interval=Config.STATS["flush_interval"],
+            first=Config.STATS["flush_interval"]
+        )
+        job_queue.run_repeating(
+            ScheduledJobs.flush_ad_views,
+            interval=Config.AD_ENGINE["flush_interval"],
+            first=Config.AD_ENGINE["flush_interval"]
+        )
+        job_queue.run_daily(
+            ScheduledJobs.reconcile_daily_stats,
+            time=Config.STATS["reconcile_time"]
+        )
+        job_queue.run_daily(
+            ScheduledJobs.compact_history,
+            time=Config.RETENTION["run_time"]
+        )
+        job_queue.run_once(ScheduledJobs.resume_broadcasts, when=1)
+        job_queue.run_repeating(
+            ScheduledJobs.backup_database,
+            interval=Config.BACKUP["interval"],
+            first=Config.BACKUP["interval"]
+        )
+
+# ==================== دورة حياة التطبيق ====================
+async def post_init(application: Application):
+    """حفظ هوية البوت (initialize جلبها بالفعل عبر getMe)"""
+    bot_identity.load(application.bot.bot)
+    logger.info(f"هوية البوت: @{bot_identity.username} ({bot_identity.id})")
+
+async def post_stop(application: Application):
+    """إيقاف الإعلانات الجارية وحفظ تقدمها (البوت ما زال متصلاً)"""
+    await broadcasts.stop_all()
+
+async def post_shutdown(application: Application):
+    """تفريغ الكتابات المعلقة قبل الإغلاق"""
+    await ledger.stop()
+    await deliveries.flush()
+    await adb.flush_ad_views()
+    await adb.flush_daily_stats()
+
+# ==================== وضع webhook ====================
+if WEBHOOK_AVAILABLE:
+    class HealthHandler(tornado.web.RequestHandler):
+        """GET /health: 200 أثناء الخدمة و503 أثناء البدء أو التصريف"""
+        
+        SUPPORTED_METHODS = ("GET",)
+        
+        def initialize(self, service: "WebhookService"):
+            self.service = service
+        
+        def get(self):
+            self.set_status(200 if self.service.status == "serving" else 503)
+            self.write(self.service.health())
+
+class WebhookService:
+    """تشغيل التطبيق على خادم webhook الخاص بالمكتبة مع /health وتصريف مرتب
+    
+    خادم المكتبة (tornado) يتحقق من secret_token ويضع التحديثات في طابور
+    التطبيق، ونضيف إليه مسار الصحة على المنفذ نفسه. عند الإيقاف: /health
+    يرد 503، يتوقف الاستقبال (تيليجرام يعيد ما لم يستلم للنسخة التالية)،
+    ثم يعالج ما في الطابور وتكتمل المهام قبل خطافات الإغلاق.
+    """
+    
+    def __init__(self, application: Application, settings: Dict = None):
+        if not WEBHOOK_AVAILABLE:
+            raise RuntimeError("وضع webhook يتطلب: pip install python-telegram-bot[webhooks]")
+        self.application = application
+        self.settings = {**Config.WEBHOOK, **(settings or {})}
+        self.status = "starting"
+        self.started_at = time.time()
+        self.app = WebhookAppClass(
+            f"/{self.settings['path']}", application.bot, application.update_queue,
+            self.settings["secret_token"]
+        )
+        self.app.add_handlers(r".*", [(self.settings["health_path"], HealthHandler, {"service": self})])
+        self.server = WebhookServer(self.settings["listen"], self.settings["port"], self.app, None)
+    
+    @property
+    def webhook_url(self) -> str:
+        return f"{self.settings['url']}/{self.settings['path']}"
+    
+    def health(self) -> Dict:
+        return {
+            "status": self.status,
+            "mode": "webhook",
+            "uptime": round(time.time() - self.started_at),
+            "pending_updates": self.application.update_queue.qsize(),
+            "broadcasts": len(broadcasts.running)
+        }
+    
+    async def start(self):
+        """تهيئة التطبيق، فتح المنفذ، تسجيل العنوان لدى تيليجرام، ثم بدء المعالجة"""
+        application = self.application
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        ready = asyncio.Event()
+        await self.server.serve_forever(ready)
+        await ready.wait()
+        await application.bot.set_webhook(
+            url=self.webhook_url,
+            allowed_updates=Config.ALLOWED_UPDATES,
+            drop_pending_updates=self.settings["drop_pending_updates"],
+            max_connections=self.settings["max_connections"],
+            secret_token=self.settings["secret_token"]
+        )
+        await application.start()
+        self.status = "serving"
+        logger.info(f"webhook على {self.settings['listen']}:{self.settings['port']} -> {self.webhook_url}")
+    
+    async def stop(self):
+        """تصريف مرتب ثم خطافات الإيقاف والإغلاق (بترتيب run_webhook في المكتبة)"""
+        application = self.application
+        self.status = "draining"
+        await self.server.shutdown()
+        logger.info(f"توقف الاستقبال، تصريف {application.update_queue.qsize()} تحديث معلق")
+        if application.running:
+            # ينتظر الطابور والمهام الجارية والمهام الدورية
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        self.status = "stopped"
+    
+    async def serve(self):
+        """الخدمة حتى SIGINT أو SIGTERM"""
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopping.set)
+        try:
+            await self.start()
+            await stopping.wait()
+        finally:
+            await self.stop()
+
+# ==================== قياس الأداء ====================
+async def benchmark_ledger(operations: int = 2000, users: int = 50) -> Dict:
+    """قياس إنتاجية كتابة النقاط: commit لكل عملية مقابل التجميع"""
+    results = {}
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in ("per_call_commit", "group_commit"):
+            bench_db = Database(os.path.join(tmp_dir, f"{mode}.db"))
+            for uid in range(1, users + 1):
+                bench_db.create_user(uid, "", f"user{uid}")
+            
+            bench_adb = AsyncDatabase(bench_db)
+            writer = LedgerWriter(bench_db)
+            
+            started = time.perf_counter()
+            if mode == "per_call_commit":
+                await asyncio.gather(*(
+                    bench_adb.add_points(i % users + 1, 1, "bench")
+                    for i in range(operations)
+                ))
+            else:
+                await asyncio.gather(*(
+                    writer.add_points(i % users + 1, 1, "bench")
+                    for i in range(operations)
+                ))
+                await writer.stop()
+            elapsed = time.perf_counter() - started
+            
+            results[mode] = {
+                "operations": operations,
+                "seconds": round(elapsed, 3),
+                "ops_per_sec": round(operations / elapsed, 1),
+                "batches": writer.stats["batches"] if mode == "group_commit" else operations
+            }
+            bench_db.close()
+    
+    results["speedup"] = round(
+        results["group_commit"]["ops_per_sec"] / results["per_call_commit"]["ops_per_sec"], 2
+    )
+    return results
+
+async def benchmark_broadcast(recipients: int = 600, latency_ms: float = 80,
+                              server_limit: int = 30, blocked_ratio: float = 0.02) -> Dict:
+    """قياس الإعلان الجماعي على مرسل وهمي يحاكي زمن الشبكة وحد تيليجرام
+    
+    المرسل يرد RetryAfter إذا تجاوزت الطلبات server_limit في أي ثانية، و
+    Forbidden لنسبة blocked_ratio من المستخدمين. الحلقة القديمة تقاس على
+    عينة لأنها أبطأ بكثير.
+    """
+    rng = random.Random(7)
+    blocked = {uid for uid in range(1, recipients + 1) if rng.random() < blocked_ratio}
+    
+    def fake_sender(log: List[float]):
+        async def send(chat_id: int):
+            now = time.perf_counter()
+            while log and log[0] <= now - 1:
+                log.pop(0)
+            if len(log) >= server_limit:
+                raise RetryAfter(1)
+            log.append(now)
+            await asyncio.sleep(latency_ms / 1000 * rng.uniform(0.5, 1.5))
+            if chat_id in blocked:
+                raise Forbidden("bot was blocked by the user")
+        return send
+    
+    async def users(count: int):
+        for uid in range(1, count + 1):
+            yield uid
+    
+    results = {}
+    # الحلقة القديمة: رسالة واحدة في كل مرة واستراحة 0.1 ثانية كل 10 رسائل
+    sample = min(recipients, 100)
+    send = fake_sender([])
+    started = time.perf_counter()
+    sent = 0
+    async for uid in users(sample):
+        try:
+            await send(uid)
+            sent += 1
+            if sent % 10 == 0:
+                await asyncio.sleep(0.1)
+        except TelegramError:
+            pass
+    elapsed = time.perf_counter() - started
+    results["sequential"] = {"recipients": sample, "seconds": round(elapsed, 2),
+                             "per_second": round(sent / elapsed, 1)}
+    
+    results["engine"] = await BroadcastEngine(fake_sender([])).run(users(recipients))
+    # المحظورون يستهلكون من الحد أيضاً
+    engine = results["engine"]
+    results["limit_utilization"] = round(engine["total"] / engine["seconds"] / server_limit, 3)
+    results["speedup"] = round(results["engine"]["per_second"] / results["sequential"]["per_second"], 2)
+    return results
+
+def latency_summary(samples: List[float]) -> Dict:
+    """عدد العينات ونسبها المئوية بالملّي ثانية (العينات بالثواني)"""
+    ordered = sorted(samples)
+    
+    def percentile(fraction: float) -> float:
+        if not ordered:
+            return 0.0
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 2)
+    
+    return {
+        "count": len(ordered),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0
+    }
+
+if WEBHOOK_AVAILABLE:
+    class FakeBotApiHandler(tornado.web.RequestHandler):
+        """/bot<token>/<method> في خادم Bot API الوهمي"""
+        
+        SUPPORTED_METHODS = ("GET", "POST")
+        
+        def initialize(self, api: "FakeBotApi"):
+            self.api = api
+        
+        async def post(self, method: str):
+            params = {key: self.get_argument(key) for key in self.request.arguments}
+            for key, files in self.request.files.items():
+                params[key] = files[0]["filename"]
+            ok, result = await self.api.handle(method, params)
+            if not ok:
+                self.set_status(result["error_code"])
+                self.write({"ok": False, **result})
+                return
+            self.write({"ok": True, "result": result})
+        
+        get = post
+
+class FakeBotApi:
+    """خادم Bot API وهمي على localhost للقياس دون تيليجرام
+    
+    يرد على getMe و setWebhook و getUpdates (انتظار طويل) ويسجل كل طلب مع
+    وقته في calls، وما أرسل لكل محادثة في outbox. push يرسل التحديث إلى
+    webhook المسجل بالرمز السري كما يفعل تيليجرام، أو يضعه في طابور
+    getUpdates إن لم يسجل webhook. set_latency و inject_error يضيفان زمن
+    شبكة وأخطاء Bot API لكل دالة ("*" لكل الدوال) بمولد عشوائي ثابت البذرة.
+    """
+    
+    BOT = {"id": 1, "is_bot": True, "first_name": "Malik Bench", "username": "malik_bench_bot"}
+    # دوال ترد برسالة
+    MESSAGE_METHODS = frozenset({
+        "sendMessage", "editMessageText", "editMessageMedia", "editMessageCaption",
+        "sendDocument", "sendPhoto"
+    })
+    
+    def __init__(self, seed: int = 7):
+        if not WEBHOOK_AVAILABLE:
+            raise RuntimeError("الخادم الوهمي يتطلب: pip install python-telegram-bot[webhooks]")
+        self.calls: List[Tuple[float, str, Dict]] = []
+        self.outbox: Dict[int, List[Tuple[str, Dict]]] = {}
+        self.listeners = []
+        self.webhook: Optional[Dict] = None
+        self.port: Optional[int] = None
+        self.injected: Dict[str, int] = {}
+        self._latency: Dict[str, Tuple[float, float]] = {}
+        self._errors: Dict[str, List[Tuple[float, int, str, Optional[int]]]] = {}
+        self._rng = random.Random(seed)
+        self._updates: List[Dict] = []
+        self._arrived = asyncio.Event()
+        self._message_id = 0
+        self._server = None
+        self._client = None
+    
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+    
+    async def start(self) -> str:
+        """فتح الخادم على منفذ حر وإرجاع عنوانه"""
+        app = tornado.web.Application(
+            [(r"/bot[^/]+/(\w+)", FakeBotApiHandler, {"api": self})],
+            log_function=lambda handler: None
+        )
+        self.port = free_port()
+        self._server = HTTPServer(app)
+        self._server.listen(self.port, address="127.0.0.1")
+        self._client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100))
+        return self.base_url
+    
+    async def stop(self):
+        self._arrived.set()
+        self._server.stop()
+        await self._server.close_all_connections()
+        await self._client.aclose()
+    
+    def on_call(self, listener):
+        """listener(method, params) يستدعى مع كل طلب قبل الرد"""
+        self.listeners.append(listener)
+    
+    def set_latency(self, method: str, low_ms: float, high_ms: float = None):
+        """زمن رد عشوائي بين low_ms و high_ms لدالة (أو "*")"""
+        self._latency[method] = (low_ms / 1000, (high_ms if high_ms is not None else low_ms) / 1000)
+    
+    def inject_error(self, method: str, probability: float, error_code: int = 400,
+                     description: str = "Bad Request: chat not found", retry_after: int = None):
+        """رد خطأ Bot API بنسبة probability (429 مع retry_after يصبح RetryAfter)"""
+        self._errors.setdefault(method, []).append((probability, error_code, description, retry_after))
+    
+    def _fault(self, method: str) -> Optional[Dict]:
+        for probability, error_code, description, retry_after in (
+                self._errors.get(method, []) + self._errors.get("*", [])):
+            if self._rng.random() < probability:
+                self.injected[method] = self.injected.get(method, 0) + 1
+                error = {"error_code": error_code, "description": description}
+                if retry_after is not None:
+                    error["parameters"] = {"retry_after": retry_after}
+                return error
+        return None
+    
+    async def handle(self, method: str, params: Dict) -> Tuple[bool, Any]:
+        """(نجاح، النتيجة أو الخطأ) لطلب واحد"""
+        self.calls.append((time.perf_counter(), method, params))
+        for listener in self.listeners:
+            listener(method, params)
+        if method == "getUpdates":
+            return True, await self._get_updates(params)
+        
+        latency = self._latency.get(method) or self._latency.get("*")
+        if latency:
+            await asyncio.sleep(self._rng.uniform(*latency))
+        error = self._fault(method)
+        if error:
+            return False, error
+        if params.get("chat_id"):
+            self.outbox.setdefault(int(params["chat_id"]), []).append((method, params))
+        
+        if method == "getMe":
+            return True, self.BOT
+        if method == "setWebhook":
+            self.webhook = {"url": params["url"], "secret_token": params.get("secret_token")}
+            return True, True
+        if method == "deleteWebhook":
+            self.webhook = None
+            return True, True
+        if method in self.MESSAGE_METHODS:
+            self._message_id += 1
+            return True, {
+                "message_id": int(params.get("message_id") or self._message_id),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+                "text": params.get("text", "")
+            }
+        return True, True
+    
+    async def _get_updates(self, params: Dict) -> List[Dict]:
+        offset = int(params.get("offset") or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and float(params.get("timeout") or 0):
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get("limit") or 100)]
+    
+    async def push(self, update: Dict) -> int:
+        """تسليم تحديث للبوت؛ يعيد رمز HTTP لرد webhook"""
+        if self.webhook:
+            secret = self.webhook["secret_token"]
+            response = await self._client.post(
+                self.webhook["url"], json=update,
+                headers={"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+            )
+            return response.status_code
+        self._updates.append(update)
+        self._arrived.set()
+        return 200
+    
+    @staticmethod
+    def message_update(update_id: int, user_id: int, text: str) -> Dict:
+        """تحديث رسالة نصية خاصة من user_id (الأوامر مع entity)"""
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+    
+    @staticmethod
+    def callback_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> Dict:
+        """ضغطة زر callback_data على رسالة البوت message_id"""
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "menu"
+                }
+            }
+        }
+
+def free_port() -> int:
+    """منفذ TCP حر على localhost"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def benchmark_webhook(updates: int = 1000, rate: float = 200) -> Dict:
+    """قياس الاستقبال من طرف لطرف: polling مقابل webhook على خادم Bot API وهمي
+    
+    التحديثات تصل بمعدل rate في الثانية، والزمن من تسليمها لتيليجرام
+    (الوهمي) حتى وصول رد sendMessage منه. التطبيق بمعالج صدى فقط ليقاس
+    النقل والتوزيع لا منطق المعالجات.
+    """
+    async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.message.reply_text(update.message.text)
+    
+    results = {}
+    for mode in ("polling", "webhook"):
+        api = FakeBotApi()
+        base_url = await api.start()
+        pushed: Dict[int, float] = {}
+        latencies: List[float] = []
+        finished = asyncio.Event()
+        
+        def on_call(method: str, params: Dict):
+            if method == "sendMessage":
+                latencies.append(time.perf_counter() - pushed.pop(int(params["chat_id"])))
+                if len(latencies) == updates:
+                    finished.set()
+        api.on_call(on_call)
+        
+        application = Application.builder().token("1:bench").base_url(f"{base_url}/bot").build()
+        application.add_handler(MessageHandler(filters.TEXT, echo))
+        if mode == "webhook":
+            port = free_port()
+            service = WebhookService(application, {
+                "url": f"http://127.0.0.1:{port}", "listen": "127.0.0.1", "port": port,
+                "path": "telegram", "secret_token": "bench"
+            })
+            await service.start()
+        else:
+            await application.initialize()
+            await application.updater.start_polling(poll_interval=0, timeout=10)
+            await application.start()
+        
+        # تيليجرام يفتح حتى max_connections طلب webhook متزامن
+        connections = asyncio.Semaphore(Config.WEBHOOK["max_connections"])
+        
+        async def deliver(update: Dict):
+            async with connections:
+                await api.push(update)
+        
+        started = time.perf_counter()
+        pushes = []
+        for update_id in range(1, updates + 1):
+            delay = started + (update_id - 1) / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            pushed[update_id] = time.perf_counter()
+            pushes.append(asyncio.create_task(
+                deliver(FakeBotApi.message_update(update_id, update_id, f"ping {update_id}"))
+            ))
+        await asyncio.gather(*pushes)
+        try:
+            await asyncio.wait_for(finished.wait(), timeout=30)
+        except asyncio.TimeoutError:
+            logger.warning(f"قياس {mode}: وصل {len(latencies)} رد من {updates}")
+        elapsed = time.perf_counter() - started
+        
+        if mode == "webhook":
+            await service.stop()
+        else:
+            await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+        api_calls = len(api.calls)
+        await api.stop()
+        
+        results[mode] = {
+            **latency_summary(latencies),
+            "seconds": round(elapsed, 2),
+            "per_second": round(len(latencies) / elapsed, 1),
+            "api_requests": api_calls
+        }
+    return results
+
+class LoadHarness:
+    """مستخدمون افتراضيون يمرون بمسارات BotHandlers الحقيقية عبر webhook و FakeBotApi
+    
+    كل مستخدم يرسل تحديثاً وينتظر انتهاء معالجته (معالج في مجموعة بعد
+    المعالجات يعلن ذلك)، ثم يقرأ ما أرسله البوت لمحادثته ليختار الخطوة
+    التالية: كود الإحالة من قائمة النقاط، زر الإعلان، واتجاه التخمين.
+    الخادم الوهمي والمستخدمون في نفس العملية: إذا قارب cpu_seconds المدة
+    فالحد هو المعالج لا البوت وحده.
+    """
+    
+    def __init__(self, api: FakeBotApi, timeout: float = 30, seed: int = 7):
+        self.api = api
+        self.timeout = timeout
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.referral_codes: List[str] = []
+        self._rng = random.Random(seed)
+        self._update_id = 0
+        self._cpu_started = time.process_time()
+        self._waiting: Dict[int, Tuple[str, asyncio.Future]] = {}
+    
+    def attach(self, application: Application):
+        """معالج نهاية المعالجة ومعالج الأخطاء على التطبيق المختبر"""
+        application.add_handler(TypeHandler(Update, self._processed), group=1)
+        application.add_error_handler(self._failed)
+    
+    async def _processed(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        _, future = self._waiting.pop(update.update_id, (None, None))
+        if future and not future.done():
+            future.set_result(None)
+    
+    async def _failed(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        if isinstance(update, Update) and update.update_id in self._waiting:
+            name = self._waiting[update.update_id][0]
+            self.errors[name] = self.errors.get(name, 0) + 1
+    
+    async def step(self, name: str, user_id: int, make_update) -> str:
+        """تحديث واحد حتى انتهاء معالجته؛ يعيد ما أرسله البوت للمحادثة (JSON)"""
+        self._update_id += 1
+        update_id = self._update_id
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[update_id] = (name, future)
+        self.api.outbox.pop(user_id, None)
+        started = time.perf_counter()
+        try:
+            status = await self.api.push(make_update(update_id))
+            if status != 200:
+                raise ConnectionError(f"webhook رد {status}")
+            await asyncio.wait_for(future, self.timeout)
+            self.samples.setdefault(name, []).append(time.perf_counter() - started)
+        except (asyncio.TimeoutError, ConnectionError, httpx.HTTPError):
+            self._waiting.pop(update_id, None)
+            self.errors[name] = self.errors.get(name, 0) + 1
+        return json.dumps(self.api.outbox.pop(user_id, []), ensure_ascii=False)
+    
+    async def message(self, name: str, user_id: int, text: str) -> str:
+        return await self.step(name, user_id, lambda update_id: FakeBotApi.message_update(update_id, user_id, text))
+    
+    async def press(self, name: str, user_id: int, data: str) -> str:
+        return await self.step(name, user_id, lambda update_id: FakeBotApi.callback_update(update_id, user_id, data))
+    
+    async def session(self, user_id: int):
+        """/start (بإحالة أحياناً) ← النقاط ← إعلان ← تخمين حتى الفوز ← نص إلى PDF"""
+        if self.referral_codes and self._rng.random() < 0.5:
+            await self.message("start_referral", user_id, f"/start {self._rng.choice(self.referral_codes)}")
+        else:
+            await self.message("start", user_id, "/start")
+        
+        code = re.search(r"start=(\w+)", await self.press("points_menu", user_id, "points_menu"))
+        if code:
+            self.referral_codes.append(code.group(1))
+        
+        ad = re.search(r"ad_watched_(\d+)", await self.press("view_ad", user_id, "view_ad"))
+        if ad:
+            await self.press("ad_watched", user_id, f"ad_watched_{ad.group(1)}")
+        
+        await self.press("game_numbers", user_id, "game_numbers")
+        low, high = 1, 100
+        for _ in range(8):
+            guess = (low + high) // 2
+            reply = await self.message("guess", user_id, str(guess))
+            if "أكبر من" in reply:
+                low = guess + 1
+            elif "أصغر من" in reply:
+                high = guess - 1
+            else:
+                break
+        
+        await self.press("pdf_text", user_id, "pdf_text")
+        await self.message("pdf_send", user_id, "Malik load test document " * 20)
+    
+    def report(self, elapsed: float) -> Dict:
+        steps = {
+            name: {**latency_summary(samples), "errors": self.errors.get(name, 0)}
+            for name, samples in self.samples.items()
+        }
+        for name, errors in self.errors.items():
+            steps.setdefault(name, {**latency_summary([]), "errors": errors})
+        return {
+            "updates": self._update_id,
+            "seconds": round(elapsed, 2),
+            "cpu_seconds": round(time.process_time() - self._cpu_started, 2),
+            "updates_per_second": round(self._update_id / elapsed, 1) if elapsed else 0.0,
+            "handlers": steps
+        }
+
+async def benchmark_load(users: int = 1000, concurrency: int = 100, latency_ms: float = 0,
+                         error_rate: float = 0, concurrent_updates: int = 1) -> Dict:
+    """اختبار حمل من طرف لطرف لمعالجات البوت على قاعدة مؤقتة وخادم Bot API وهمي
+    
+    users مستخدم افتراضي، منهم concurrency في نفس الوقت. latency_ms زمن
+    كل طلب من البوت إلى Bot API، و error_rate نسبة ردود الخطأ المحقونة
+    (نصفها 429 RetryAfter ونصفها 400) على sendMessage و editMessageText.
+    """
+    global db, adb, ledger
+    saved = (db, adb, ledger)
+    api = FakeBotApi()
+    base_url = await api.start()
+    if latency_ms:
+        api.set_latency("*", latency_ms * 0.5, latency_ms * 1.5)
+    if error_rate:
+        for method in ("sendMessage", "editMessageText"):
+            api.inject_error(method, error_rate / 2, 429, "Too Many Requests: retry after 1", retry_after=1)
+            api.inject_error(method, error_rate / 2, 400, "Bad Request: message is not modified")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = Database(os.path.join(tmp_dir, "load.db"))
+        ledger = LedgerWriter(db)
+        adb = AsyncDatabase(db)
+        try:
+            application = build_application("1:load", base_url, concurrent_updates)
+            harness = LoadHarness(api)
+            harness.attach(application)
+            port = free_port()
+            service = WebhookService(application, {
+                "url": f"http://127.0.0.1:{port}", "listen": "127.0.0.1", "port": port,
+                "path": "telegram", "secret_token": "load"
+            })
+            await service.start()
+            
+            active = asyncio.Semaphore(concurrency)
+            
+            async def virtual_user(user_id: int):
+                async with active:
+                    await harness.session(user_id)
+            
+            started = time.perf_counter()
+            await asyncio.gather(*(virtual_user(10 ** 9 + index) for index in range(users)))
+            elapsed = time.perf_counter() - started
+            await service.stop()
+        finally:
+            db.close()
+            db, adb, ledger = saved
+            await api.stop()
+    
+    methods: Dict[str, int] = {}
+    for _, method, _ in api.calls:
+        methods[method] = methods.get(method, 0) + 1
+    return {
+        "users": users,
+        "concurrency": concurrency,
+        **harness.report(elapsed),
+        "api_calls": methods,
+        "injected_errors": api.injected
+    }
+
+def benchmark_ad_views(views: int = 5000, users: int = 200) -> Dict:
+    """قياس مشاهدات الإعلانات في الثانية: تحديث مباشر مقابل التجميع"""
+    results = {}
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in ("per_view_commit", "batched"):
+            bench_db = Database(os.path.join(tmp_dir, f"{mode}.db"))
+            ad_ids = [ad['id'] for ad in bench_db.ad_inventory._ads] or [1]
+            flush_every = max(views // 10, 1)
+            
+            started = time.perf_counter()
+            for i in range(views):
+                user_id, ad_id = i % users + 1, ad_ids[i % len(ad_ids)]
+                if mode == "per_view_commit":
+                    # المسار القديم: إدراج وتحديث العداد وcommit لكل مشاهدة
+                    bench_db.cursor.execute(
+                        "INSERT INTO ad_views (user_id, ad_id, clicked) VALUES (?, ?, ?)",
+                        (user_id, ad_id, False)
+                    )
+                    bench_db._bump_daily_totals(user_id, ads=1)
+                    bench_db.cursor.execute("UPDATE ads SET views = views + 1 WHERE id = ?", (ad_id,))
+                    bench_db.conn.commit()
+                else:
+                    bench_db.record_ad_view(user_id, ad_id)
+                    if (i + 1) % flush_every == 0:
+                        bench_db.flush_ad_views()
+            bench_db.flush_ad_views()
+            elapsed = time.perf_counter() - started
+            
+            stored = bench_db.conn.execute("SELECT COUNT(*) FROM ad_views").fetchone()[0]
+            results[mode] = {
+                "views": views,
+                "stored": stored,
+                "seconds": round(elapsed, 3),
+                "views_per_sec": round(views / elapsed, 1)
+            }
+            bench_db.close()
+    
+    results["speedup"] = round(
+        results["batched"]["views_per_sec"] / results["per_view_commit"]["views_per_sec"], 2
+    )
+    return results
+
+def benchmark_menus(renders: int = 20000) -> Dict:
+    """قياس بناء الشاشات: format وبناء الأزرار لكل طلب مقابل القوالب واللوحات المخزنة"""
+    values = {"first_name": "مالك", "points": format_points(to_milli(12.5))}
+    screens = {
+        "welcome": (Menus.WELCOME, Menus.main_keyboard, (False,)),
+        "welcome_back": (Menus.WELCOME_BACK, Menus.main_keyboard, (True,)),
+        "tools": (Menus.TOOLS, Menus.tools_keyboard, ()),
+        "help": (Menus.HELP, Menus.help_keyboard, ()),
+        "games": (Menus.GAMES, Menus.games_keyboard, ()),
+        "pdf": (Menus.PDF, Menus.pdf_keyboard, ()),
+    }
+    results = {}
+    
+    for name, (template, keyboard, args) in screens.items():
+        # المسار القديم: نص يُنسّق من جديد ولوحة تبنى كائناً كائناً في كل استدعاء
+        source = "".join(
+            part if index % 2 == 0 else "{" + part + "}" for index, part in enumerate(template.parts)
+        )
+        build = keyboard.__wrapped__
+        assert source.format_map(values) == template.render(**values)
+        
+        timings = {}
+        for mode in ("per_request", "cached"):
+            started = time.perf_counter()
+            if mode == "per_request":
+                for _ in range(renders):
+                    source.format_map(values)
+                    build(*args)
+            else:
+                for _ in range(renders):
+                    template.render(**values)
+                    keyboard(*args)
+            timings[mode] = time.perf_counter() - started
+        
+        results[name] = {
+            "per_request_us": round(timings["per_request"] / renders * 1e6, 2),
+            "cached_us": round(timings["cached"] / renders * 1e6, 2),
+            "speedup": round(timings["per_request"] / timings["cached"], 1)
+        }
+    
+    return {"renders": renders, "screens": results}
+
+# ==================== فحص خطط الاستعلامات ====================
+def load_synthetic_dataset(bench_db: Database, users: int, days: int = 60):
+    """بيانات مصطنعة بأحجام متناسبة مع الإنتاج لفحص خطط الاستعلامات"""
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    
+    def stamp() -> str:
+        return (now - timedelta(seconds=rng.randint(0, days * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+    
+    bench_db.cursor.executemany(
+        """INSERT INTO users (user_id, first_name, referral_code, points, total_earned, join_date) 
+        VALUES (?, ?, ?, ?, ?, ?)""",
+        [(uid, f"user{uid}", f"R{uid:07d}", rng.randint(0, 5000) * MILLI_POINTS, rng.randint(0, 9000) * MILLI_POINTS, stamp())
+         for uid in range(1, users + 1)]
+    )
+    bench_db.cursor.executemany(
+        "INSERT INTO transactions (user_id, amount, type, description, created_at) VALUES (?, ?, ?, '', ?)",
+        [(rng.randint(1, users), rng.choice((3000, 5000, 10000, -500)), rng.choice(("ad_view", "daily", "game", "pdf")), stamp())
+         for _ in range(users * 10)]
+    )
+    bench_db.cursor.executemany(
+        "INSERT INTO ad_views (user_id, ad_id, clicked, viewed_at) VALUES (?, ?, ?, ?)",
+        [(rng.randint(1, users), rng.randint(1, 2), rng.random() < 0.1, stamp()) for _ in range(users * 5)]
+    )
+    bench_db.cursor.executemany(
+        "INSERT INTO games (user_id, game_type, score, points_earned, duration, created_at) VALUES (?, ?, ?, ?, 0, ?)",
+        [(rng.randint(1, users), rng.choice(("number_guess", "quiz")), rng.randint(1, 10), 5000, stamp())
+         for _ in range(users * 2)]
+    )
+    bench_db.cursor.executemany(
+        """INSERT INTO files (user_id, file_name, file_type, file_size, operation_type, points_cost, created_at) 
+        VALUES (?, 'f.pdf', 'pdf', 1024, 'text_to_pdf', 500, ?)""",
+        [(rng.randint(1, users), stamp()) for _ in range(users // 2)]
+    )
+    bench_db.conn.commit()
+    bench_db.conn.execute("ANALYZE")
+
+def query_plan_workload(bench_db: Database, users: int) -> List[Tuple]:
+    """(الاسم، الدالة، الجداول المسموح بمسحها كاملاً) لكل مسار استعلام في البوت
+    
+    المسح الكامل مسموح فقط لجداول صغيرة بطبيعتها أو لعمليات صيانة تمر
+    على الجدول كله عمداً؛ أي استعلام جديد يمسح جدولاً كبيراً يفشل الفحص.
+    """
+    uid = users // 2
+    job_id = bench_db.create_broadcast_job("plan", None, 1, 1, 1)
+    today = datetime.now().strftime('%Y-%m-%d')
+    cutoff = (datetime.utcnow() - timedelta(days=30)).strftime('%Y-%m-%d')
+    
+    def cold_get_user():
+        bench_db.user_cache.clear()
+        return bench_db.get_user(uid)
+    
+    def ad_view_and_flush():
+        bench_db.record_ad_view(uid, 1)
+        return bench_db.flush_ad_views()
+    
+    return [
+        # مسارات الطلبات
+        ("get_user", cold_get_user, ()),
+        ("get_user_id_by_referral_code", lambda: bench_db.get_user_id_by_referral_code(f"R{uid:07d}"), ()),
+        ("decode_referral_code",
+         lambda: bench_db.get_user_id_by_referral_code(bench_db.generate_referral_code(uid)), ()),
+        ("create_user", lambda: bench_db.create_user(users + 1, "", "new", referred_by=uid), ()),
+        ("update_user", lambda: bench_db.update_user(uid, last_active=datetime.now()), ()),
+        ("add_points", lambda: bench_db.add_points(uid, 3000, "ad_view", "plan"), ()),
+        ("debit_points", lambda: bench_db.debit_points(uid, 500, "pdf_conversion", "plan"), ()),
+        ("apply_batch", lambda: bench_db.apply_batch([(bench_db._apply_points, (uid, 1, "bench"), {})]), ()),
+        ("get_user_stats", lambda: bench_db.get_user_stats(uid), ()),
+        ("broadcast_checkpoint", lambda: (
+            bench_db.claim_broadcast_recipients(job_id, [uid, uid + 1]),
+            bench_db.save_broadcast_progress(job_id, [(uid, "sent"), (uid + 1, "unsent")], uid)
+        ), ()),
+        ("recover_broadcast_job", lambda: bench_db.recover_broadcast_job(job_id), ()),
+        ("get_users_page", lambda: bench_db.get_users_page(uid, 100, exclude_banned=True, language="ar",
+                                                           active_since=cutoff), ()),
+        ("broadcast_users_page", lambda: bench_db.get_users_page(uid, 100, exclude_banned=True, reachable=True,
+                                                                 columns=("user_id",)), ()),
+        ("mark_undeliverable", lambda: bench_db.mark_undeliverable([(uid + 2, "blocked", "plan")]), ()),
+        ("mark_reachable", lambda: bench_db.mark_reachable(uid + 2), ()),
+        ("get_transactions", lambda: bench_db.get_transactions(uid, 10, 5), ("archive_segments",)),
+        ("count_transactions", lambda: bench_db.count_transactions(uid), ("archive_segments",)),
+        ("get_leaderboard", lambda: bench_db.get_leaderboard(uid), ()),
+        ("record_ad_view", ad_view_and_flush, ()),
+        ("record_game", lambda: bench_db.record_game(uid, "number_guess", 3, 5000, 0, "{}"), ()),
+        ("get_last_game", lambda: bench_db.get_last_game(uid, "number_guess"), ()),
+        ("record_file", lambda: bench_db.record_file(uid, "f.pdf", "pdf", 1024, "text_to_pdf", 500), ()),
+        # مهام دورية وصيانة
+        ("flush_daily_stats", bench_db.flush_daily_stats, ()),
+        ("compute_daily_stats", lambda: bench_db.compute_daily_stats(today), ("users",)),
+        ("reconcile_daily_stats", bench_db.reconcile_daily_stats, ("users",)),
+        ("get_system_stats", bench_db.get_system_stats, ("users", "transactions", "games", "ads")),
+        ("count_audience", bench_db.count_audience, ("users",)),
+        ("reload_ads", bench_db.reload_ads, ("ads",)),
+        ("rebuild_leaderboard", bench_db.rebuild_leaderboard, ("users",)),
+        ("oldest_transaction_time", bench_db.oldest_transaction_time, ()),
+        ("fetch_transactions_range", lambda: bench_db.fetch_transactions_range((cutoff, 0), today, 500), ()),
+        ("compact_chunk", lambda: [bench_db.compact_chunk(table, cutoff, 500) for table in Database.COMPACTION],
+         ("compact_ids",)),
+        ("backfill_daily_totals", bench_db.backfill_daily_totals, ("transactions", "ad_views", "games", "user_daily_totals")),
+    ]
+
+def check_query_plans(users: int = 20000) -> Dict:
+    """تشغيل كل استعلامات البوت على بيانات مصطنعة وفحص خطة كل منها
+    
+    الاستعلام يفشل إذا مسحت خطته (SCAN) جدولاً غير مسموح له بمسحه.
+    """
+    report = {"users": users, "queries": [], "violations": 0}
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bench_db = Database(os.path.join(tmp_dir, "plans.db"))
+        # حد بطء لا نهائي: الخطط تُفحص هنا لا في السجل
+        profiler = bench_db.conn.profiler = QueryProfiler(float("inf"))
+        
+        started = time.perf_counter()
+        load_synthetic_dataset(bench_db, users)
+        report["load_seconds"] = round(time.perf_counter() - started, 2)
+        
+        for label, func, allowed in query_plan_workload(bench_db, users):
+            profiler.reset()
+            started = time.perf_counter()
+            func()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            
+            for entry in profiler.entries():
+                plan = bench_db.conn.explain(*entry["sample"])
+                scanned = [line.split()[1] for line in plan
+                           if line.startswith("SCAN ") and not line.startswith(("SCAN CONSTANT", "SCAN ("))]
+                bad = [table for table in scanned if table not in allowed]
+                report["violations"] += bool(bad)
+                report["queries"].append({
+                    "path": label,
+                    "status": "SCAN" if bad else ("ALLOWED" if scanned else "OK"),
+                    "path_ms": round(elapsed_ms, 3),
+                    "query_ms": round(entry["total_ms"] / max(entry["calls"], 1), 3),
+                    "sql": entry["sql"][:160],
+                    "plan": plan
+                })
+        bench_db.close()
+    
+    return report
+
+# جداول المستخدمين (تتبع جزء user_id) والجداول العامة (في الجزء 0 فقط)
+SHARDED_TABLES = ("users", "transactions", "games", "files", "ad_views", "withdrawals",
+                  "user_daily_totals", "transactions_daily")
+HOME_TABLES = ("ads", "settings", "statistics", "ad_views_daily", "errors",
+               "broadcast_jobs", "broadcast_deliveries")
+# حد الضغط ينسخ لكل الأجزاء، وكذلك archive_segments (ملفات الأرشيف للقراءة فقط)
+REPLICATED_SETTINGS = ("compacted_before",)
+
+def reshard_database(source: Database, count: int) -> Dict:
+    """نسخ قاعدة بملف واحد إلى count جزءاً (أداة غير متصلة: البوت متوقف)
+    
+    لا يعدل المصدر، ويرفض الكتابة فوق أجزاء موجودة. يتحقق في النهاية من
+    أن عدد صفوف كل جدول ومجموع النقاط في الأجزاء يساوي المصدر.
+    """
+    paths = [shard_path(index) for index in range(count)]
+    existing = [path for path in paths if os.path.exists(path)]
+    if existing:
+        raise FileExistsError(f"أجزاء موجودة مسبقاً: {', '.join(existing)}")
+    
+    # حفظ المشاهدات المعلقة في المصدر قبل النسخ
+    source._call_locked(source.flush_ad_views)
+    started = time.perf_counter()
+    copied = {table: 0 for table in SHARDED_TABLES + HOME_TABLES}
+    expected = {}
+    points = {"source": 0, "shards": 0}
+    for index, path in enumerate(paths):
+        # المخطط والفهارس والترحيلات من Database نفسها
+        Database(path, shard=(index, count)).close()
+        conn = sqlite3.connect(path)
+        try:
+            conn.create_function("shard_of", 1, lambda user_id: shard_index(user_id, count),
+                                 deterministic=True)
+            conn.execute("ATTACH DATABASE ? AS src", (source.path,))
+            tables = SHARDED_TABLES + (HOME_TABLES if index == 0 else ()) + ("archive_segments",)
+            for table in tables:
+                target = {row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")}
+                columns = ", ".join(
+                    row[1] for row in conn.execute(f"PRAGMA src.table_info({table})") if row[1] in target
+                )
+                if table in SHARDED_TABLES:
+                    where, params = "WHERE shard_of(user_id) = ?", (index,)
+                elif table == "settings":
+                    # رقم سجل المشاهدات خاص بملف المصدر
+                    where, params = "WHERE key != 'ad_views_flushed_seq'", ()
+                else:
+                    where, params = "", ()
+                if table in HOME_TABLES:
+                    # بيانات البذور في الجزء الجديد تُستبدل بقيم المصدر
+                    conn.execute(f"DELETE FROM main.{table}")
+                    expected[table] = conn.execute(f"SELECT COUNT(*) FROM src.{table} {where}").fetchone()[0]
+                conn.execute(
+                    f"INSERT OR REPLACE INTO main.{table} ({columns}) SELECT {columns} FROM src.{table} {where}",
+                    params
+                )
+            if index > 0:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO main.settings SELECT * FROM src.settings WHERE key = ?",
+                    [(key,) for key in REPLICATED_SETTINGS]
+                )
+            conn.commit()
+            conn.execute("ANALYZE")
+            
+            for table in tables:
+                if table in copied:
+                    copied[table] += conn.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0]
+            points["shards"] += conn.execute("SELECT COALESCE(SUM(points), 0) FROM main.users").fetchone()[0]
+            if index == 0:
+                for table in SHARDED_TABLES:
+                    expected[table] = conn.execute(f"SELECT COUNT(*) FROM src.{table}").fetchone()[0]
+                points["source"] = conn.execute("SELECT COALESCE(SUM(points), 0) FROM src.users").fetchone()[0]
+        finally:
+            conn.close()
+    
+    mismatched = [table for table in copied if copied[table] != expected[table]]
+    if points["shards"] != points["source"]:
+        mismatched.append("users.points")
+    return {
+        "shards": count,
+        "rows": copied,
+        "points": points["shards"],
+        "mismatched": mismatched,
+        "seconds": round(time.perf_counter() - started, 2)
+    }
+
+# ==================== أوامر سطر الأوامر ====================
+def cli_compact(argv: List[str]) -> int:
+    """compact [horizon_days] [--vacuum]"""
+    if "--vacuum" in argv:
+        argv = [arg for arg in argv if arg != "--vacuum"]
+        print("⏳ تحويل القاعدة إلى auto_vacuum=INCREMENTAL ...")
+        if not db.enable_incremental_vacuum():
+            return 1
+    horizon = int(argv[0]) if argv else None
+    failed = False
+    for shard in db.shards:
+        report = asyncio.run(HistoryCompactor(shard, horizon).run())
+        print(f"{shard.path}: {json.dumps(report, ensure_ascii=False, indent=2)}")
+        failed = failed or bool(report["failed"])
+    return 1 if failed else 0
+
+def cli_reshard(argv: List[str]) -> int:
+    """reshard <shards> [source.db]"""
+    if isinstance(db, ShardedDatabase):
+        print("❌ شغّل الأمر دون DB_SHARDS (القاعدة الحالية مقسمة مسبقاً)")
+        return 2
+    count = int(argv[0]) if argv else 0
+    if count < 2:
+        print("❌ عدد الأجزاء يجب أن يكون 2 أو أكثر")
+        return 2
+    source = Database(argv[1]) if len(argv) > 1 else db
+    try:
+        report = reshard_database(source, count)
+    except (FileExistsError, sqlite3.Error) as e:
+        print(f"❌ {e}")
+        return 1
+    finally:
+        if source is not db:
+            source.close()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if report["mismatched"]:
+        return 1
+    print(f"✅ شغّل البوت مع DB_SHARDS={count}")
+    return 0
+
+EXPORT_COLUMNS = ("user_id", "username", "first_name", "last_name", "language_code", "points",
+                  "total_earned", "referral_count", "join_date", "last_active", "is_banned")
+
+def cli_export_users(argv: List[str]) -> int:
+    """export-users <file.csv> [--active-days N] [--language xx] [--no-banned]"""
+    if not argv:
+        print(cli_export_users.__doc__)
+        return 2
+    path, options = argv[0], argv[1:]
+    filters = {"exclude_banned": "--no-banned" in options}
+    if "--language" in options:
+        filters["language"] = options[options.index("--language") + 1]
+    if "--active-days" in options:
+        days = int(options[options.index("--active-days") + 1])
+        filters["active_since"] = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in db.iter_users(columns=EXPORT_COLUMNS, **filters):
+            row["points"] = format_points(row["points"])
+            row["total_earned"] = format_points(row["total_earned"])
+            writer.writerow([row[column] for column in EXPORT_COLUMNS])
+            count += 1
+    print(f"✅ تم تصدير {count} مستخدم إلى {path}")
+    return 0
+
+def cli_bench_broadcast(argv: List[str]) -> int:
+    """bench-broadcast [recipients] [latency_ms]"""
+    recipients = int(argv[0]) if argv else 600
+    latency_ms = float(argv[1]) if len(argv) > 1 else 80
+    result = asyncio.run(benchmark_broadcast(recipients, latency_ms))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+def cli_bench_webhook(argv: List[str]) -> int:
+    """bench-webhook [updates] [rate]"""
+    updates = int(argv[0]) if argv else 1000
+    rate = float(argv[1]) if len(argv) > 1 else 200
+    result = asyncio.run(benchmark_webhook(updates, rate))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+def cli_load_test(argv: List[str]) -> int:
+    """load-test [users] [--concurrency N] [--latency-ms X] [--error-rate P] [--concurrent-updates N]"""
+    users = int(argv[0]) if argv and not argv[0].startswith("--") else 1000
+    options = {}
+    for flag, key, cast in (("--concurrency", "concurrency", int), ("--latency-ms", "latency_ms", float),
+                            ("--error-rate", "error_rate", float),
+                            ("--concurrent-updates", "concurrent_updates", int)):
+        if flag in argv:
+            options[key] = cast(argv[argv.index(flag) + 1])
+    result = asyncio.run(benchmark_load(users, **options))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0 if not any(step["errors"] for step in result["handlers"].values()) else 1
+
+def cli_bench_ad_views(argv: List[str]) -> int:
+    """bench-ad-views [views]"""
+    views = int(argv[0]) if argv else 5000
+    print(json.dumps(benchmark_ad_views(views), ensure_ascii=False, indent=2))
+    return 0
+
+def cli_bench_menus(argv: List[str]) -> int:
+    """bench-menus [renders]"""
+    renders = int(argv[0]) if argv else 20000
+    print(json.dumps(benchmark_menus(renders), ensure_ascii=False, indent=2))
+    return 0
+
+def cli_plan_check(argv: List[str]) -> int:
+    """plan-check [users]"""
+    users = int(argv[0]) if argv else 20000
+    report = check_query_plans(users)
+    for query in report["queries"]:
+        if query["plan"]:
+            print(f"{query['status']:<8} {query['query_ms']:>9.3f}ms  {query['path']:<26} {query['sql'][:90]}")
+            print(f"{'':<21}↳ {'; '.join(query['plan'])}")
+    print(f"\n{len(report['queries'])} استعلام، {report['violations']} مخالفة "
+          f"(تحميل البيانات: {report['load_seconds']}s)")
+    return 1 if report["violations"] else 0
+
+def cli_backfill_daily_totals(argv: List[str]) -> int:
+    """backfill-daily-totals"""
+    rows = db.backfill_daily_totals()
+    print(f"✅ تم بناء {rows} صف في user_daily_totals" if rows >= 0 else "❌ فشل البناء")
+    return 0 if rows >= 0 else 1
+
+def cli_bench_ledger(argv: List[str]) -> int:
+    """bench-ledger [operations]"""
+    operations = int(argv[0]) if argv else 2000
+    result = asyncio.run(benchmark_ledger(operations))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+CLI_COMMANDS = {
+    "bench-ledger": (cli_bench_ledger, "قياس إنتاجية كتابة النقاط مقابل commit لكل عملية"),
+    "backfill-daily-totals": (cli_backfill_daily_totals, "إعادة بناء المجاميع اليومية من السجلات"),
+    "bench-broadcast": (cli_bench_broadcast, "قياس الإعلان الجماعي على مرسل وهمي بحد 30 رسالة/ثانية"),
+    "bench-webhook": (cli_bench_webhook, "قياس زمن الاستقبال polling مقابل webhook على خادم Bot API وهمي"),
+    "load-test": (cli_load_test, "اختبار حمل لمعالجات البوت بمستخدمين افتراضيين على خادم Bot API وهمي"),
+    "bench-ad-views": (cli_bench_ad_views, "قياس مشاهدات الإعلانات في الثانية مقابل التحديث المباشر"),
+    "bench-menus": (cli_bench_menus, "قياس بناء شاشات القوائم مقابل القوالب واللوحات المخزنة"),
+    "compact": (cli_compact, "ضغط السجلات الأقدم من الأفق في الجداول اليومية"),
+    "plan-check": (cli_plan_check, "فحص خطط كل الاستعلامات على بيانات مصطنعة (يفشل عند SCAN)"),
+    "export-users": (cli_export_users, "تصدير المستخدمين إلى CSV بذاكرة ثابتة (صفحات بالمفتاح)"),
+    "reshard": (cli_reshard, "نسخ القاعدة الحالية إلى أجزاء DB_SHARDS (والبوت متوقف)"),
+}
+
+def run_cli(argv: List[str]) -> int:
+    """تشغيل أوامر الصيانة وقياس الأداء: python bot.py <command> [args]"""
+    command = CLI_COMMANDS.get(argv[0])
+    if not command:
+        print("الأوامر المتاحة:")
+        for name, (func, description) in CLI_COMMANDS.items():
+            print(f"  {func.__doc__:<30} {description}")
+        return 2
+    return command[0](argv[1:])
+
 # ==================== الدالة الرئيسية ====================
 def main():
     """الدالة الرئيسية لتشغيل البوت"""
@@ -2720,8 +7240,36 @@ def main():
     print(f"💾 قاعدة البيانات: {Config.PATHS['database']}")
     print("⏳ جاري التهيئة...")
     
-    # إنشاء التطبيق
-    application = Application.builder().token(Config.BOT_TOKEN).build()
+    application = build_application()
+    
+    # بدء البوت
+    print("✅ البوت جاهز للتشغيل!")
+    print("📱 اذهب إلى تيليجرام وجرب البوت الآن!")
+    
+    # تشغيل البوت
+    if Config.WEBHOOK["url"]:
+        print(f"🌐 وضع webhook: {Config.WEBHOOK['url']} (المنفذ {Config.WEBHOOK['port']})")
+        asyncio.run(WebhookService(application).serve())
+    else:
+        application.run_polling(
+            allowed_updates=Config.ALLOWED_UPDATES,
+            drop_pending_updates=True
+        )
+
+def build_application(token: str = None, api_url: str = None, concurrent_updates: int = 1) -> Application:
+    """التطبيق بكل المعالجات والمهام الدورية (للتشغيل واختبار الحمل)"""
+    api_url = api_url or Config.TELEGRAM_API
+    application = (
+        Application.builder()
+        .token(token or Config.BOT_TOKEN)
+        .base_url(f"{api_url}/bot")
+        .base_file_url(f"{api_url}/file/bot")
+        .concurrent_updates(concurrent_updates)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # محادثات متقدمة
     conv_handler = ConversationHandler(
@@ -2756,22 +7304,23 @@ def main():
     # أوامر مباشرة
     application.add_handler(CommandHandler("help", BotHandlers.help_menu))
     application.add_handler(CommandHandler("admin", BotHandlers.admin_menu, filters.User(Config.ADMIN_IDS)))
+    application.add_handler(CommandHandler("history", BotHandlers.admin_history, filters.User(Config.ADMIN_IDS)))
+    application.add_handler(CommandHandler("queries", BotHandlers.admin_queries, filters.User(Config.ADMIN_IDS)))
     
     # معالجة Callback Queries
     application.add_handler(CallbackQueryHandler(BotHandlers.handle_callback))
     
-    # بدء البوت
-    print("✅ البوت جاهز للتشغيل!")
-    print("📱 اذهب إلى تيليجرام وجرب البوت الآن!")
-    
-    # تشغيل البوت
-    application.run_polling(
-        allowed_updates=["message", "callback_query"],
-        drop_pending_updates=True
-    )
+    # المهام الدورية
+    ScheduledJobs.register(application)
+    return application
 
 # ==================== تشغيل البرنامج ====================
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        exit_code = run_cli(sys.argv[1:])
+        db.close()
+        sys.exit(exit_code)
+    
     try:
         main()
     except KeyboardInterrupt: